@@ -10,6 +10,9 @@ import argparse
 from AAFTF.version import __version__
 myversion = __version__
 from AAFTF.utility import status
+from AAFTF.utility import emit
+from AAFTF.utility import open_event_log
+from AAFTF.utility import close_event_log
 
 def run_subtool(parser, args):
     if args.command == 'runall':
@@ -18,12 +21,16 @@ def run_subtool(parser, args):
         import AAFTF.trim as submodule
     elif args.command == 'filter':
         import AAFTF.filter as submodule
+    elif args.command == 'kmers':
+        import AAFTF.kmers as submodule
     elif args.command == 'assemble':
         import AAFTF.assemble as submodule
     elif args.command == 'vecscreen':
         import AAFTF.vecscreen as submodule
     elif args.command == 'sourpurge':
         import AAFTF.sourpurge as submodule
+    elif args.command == 'lcaserver':
+        import AAFTF.lcaserver as submodule
     elif args.command == 'rmdup':
         import AAFTF.rmdup as submodule
     elif args.command == 'pilon':
@@ -34,6 +41,8 @@ def run_subtool(parser, args):
         import AAFTF.sort as submodule
     elif args.command == 'pipeline':
         import AAFTF.pipeline as submodule
+    elif args.command == 'batch':
+        import AAFTF.batch as submodule
     else:
         parser.parse_args('')
         return
@@ -60,6 +69,12 @@ def main():
     parser.add_argument("-q", "--quiet", help="Do not output warnings to stderr",
                         action="store_true",
                         dest="quiet")
+    parser.add_argument("--events", help="Append a JSON lines log of status messages, commands, processes and stages to this file",
+                        dest="events")
+    parser.add_argument("--profile", help="Profile the python code of each stage, writes cProfile stats, folded stacks and tracemalloc peaks to files starting with this prefix",
+                        dest="profile")
+    parser.add_argument("--profile_interval", help="Seconds between samples of the python stacks with --profile",
+                        type=float, default=0.01, dest="profile_interval")
     parser.add_argument("-v", "--version", help="Installed AAFTF version",
                         action="version",
                         version="%(prog)s " + str(myversion))
@@ -196,6 +211,20 @@ def main():
                                nargs="*",
                                help="URLs to download and screen out initial reads.")
 
+    parser_filter.add_argument('--accession_cache',type=str,
+                               required=False,
+                               help="Shared cache of downloaded accessions, defaults to $AAFTF_DB/accessions")
+
+    parser_filter.add_argument('--accession_url',type=str,
+                               required=False,
+                               help="efetch URL template for accessions (%%s replaced by comma separated IDs), defaults to $AAFTF_EFETCH_URL or NCBI")
+
+    parser_filter.add_argument('--accession_batch',type=int,default=100,
+                               help="Number of accessions to download per request")
+
+    parser_filter.add_argument('--download_threads',type=int,default=3,
+                               help="Number of concurrent accession download requests")
+
     parser_filter.add_argument('-l', '--left',required=True,
                              help="Left (Forward) reads")
 
@@ -218,6 +247,36 @@ def main():
                              help="AAFTF is running in pipeline mode")
     
 
+    ##########
+    # kmers
+    ##########
+    # arguments
+    # -l / --left, -r / --right: reads
+    # -k / --kmer: k-mer size
+    # -o / --out: json output
+
+    parser_kmers = subparsers.add_parser('kmers',
+                                         description="Estimate genome size, coverage and heterozygosity from the read k-mer spectrum",
+                                         help='K-mer spectrum of reads')
+
+    parser_kmers.add_argument('-l', '--left',required=True,
+                             help="Left (Forward) reads")
+
+    parser_kmers.add_argument('-r', '--right',required=False,
+                             help="Right (Reverse) reads")
+
+    parser_kmers.add_argument('-k', '--kmer',type=int,default=21,
+                             help="K-mer size (up to 31)")
+
+    parser_kmers.add_argument('-s', '--sample',type=int,default=16,
+                             help="Count 1 in this many k-mers, selected by hash")
+
+    parser_kmers.add_argument('--max_reads',type=int,required=False,
+                             help="Stop after this many reads from each file")
+
+    parser_kmers.add_argument('-o','--out',type=str,required=False,
+                             help="Output JSON with estimates, histogram is written next to it")
+
     ##########
     # assemble
     ##########
@@ -246,7 +305,13 @@ def main():
 
     parser_asm.add_argument('-m','--memory',type=str,
                             dest='memory',required=False,default='32',
-                            help="Memory (in GB) setting for SPAdes. Default is 32")
+                            help="Memory (in GB) setting for the assembler. Default is 32")
+
+    parser_asm.add_argument('--method',default='spades',choices=['spades','megahit','skesa'],
+                            help="Assembler to use, megahit and skesa are faster and use less memory than spades")
+
+    parser_asm.add_argument('-k','--kmers',type=str,required=False,
+                            help="Comma separated k-mer sizes, default lets the assembler choose (skesa uses the first as minimum)")
 
     parser_asm.add_argument('-l', '--left',required=False,
                              help="Left (Forward) reads")
@@ -257,7 +322,7 @@ def main():
     parser_asm.add_argument('-v','--debug',action='store_true',
                              help="Print Spades stdout to terminal")
 
-    parser_asm.add_argument('--spades_tmpdir',type=str,required=False,help="Spades temporary dir")
+    parser_asm.add_argument('--spades_tmpdir',type=str,required=False,help="Temporary dir for spades or megahit")
 
     parser_asm.add_argument('--pipe',action='store_true',
                              help="AAFTF is running in pipeline mode")
@@ -343,9 +408,27 @@ def main():
     parser_sour.add_argument('--sourdb',required=False,
                              help="SourMash LCA k-31 taxonomy database")
 
+    parser_sour.add_argument('--write_bam',action='store_true',
+                             help="Also save sorted BAM of reads mapped to the assembly (remapped.bam in workdir)")
+
+    parser_sour.add_argument('--align_cache',type=str,required=False,
+                             help="Directory to save read alignments for reuse by AAFTF pilon")
+
+    parser_sour.add_argument('--sour_socket',required=False,
+                             help="Unix socket of a running AAFTF lcaserver, defaults to $AAFTF_LCA_SOCKET")
+
+    parser_sour.add_argument('--taxcache',required=False,
+                             help="SQLite cache of contig taxonomy, defaults to sourpurge-taxonomy.sqlite next to --sourdb")
+
+    parser_sour.add_argument('--no_taxcache',action='store_true',
+                             help="Do not use the contig taxonomy cache")
+
     parser_sour.add_argument('-m', '--mincovpct',default=5,type=int,
                              help="Minimum percent of N50 coverage to remove")
 
+    parser_sour.add_argument('--expected_coverage',type=float,required=False,
+                             help="Genome read coverage to apply --mincovpct to, instead of the N50 contig average")
+
     parser_sour.add_argument('-c','--cpus',type=int,metavar="cpus",default=1,
                                   help="Number of CPUs/threads to use.")
 
@@ -367,6 +450,30 @@ def main():
                              help="AAFTF is running in pipeline mode")
 
         
+    ##########
+    # lcaserver
+    ##########
+    # arguments
+    # --sourdb: sourmash LCA database to keep loaded
+    # --socket: Unix socket to listen on
+    # --shutdown: stop a running service
+    parser_lca = subparsers.add_parser('lcaserver',
+                                       description="Keep the sourmash LCA database loaded and classify sourpurge queries over a Unix socket",
+                                       help='Run sourmash LCA classification service')
+
+    parser_lca.add_argument('--sourdb',required=False,
+                            help="SourMash LCA k-31 taxonomy database")
+
+    parser_lca.add_argument('--AAFTF_DB',type=str,
+                            required=False,
+                            help="Path to AAFTF resources, defaults to $AAFTF_DB")
+
+    parser_lca.add_argument('-s','--socket',type=str,required=False,
+                            help="Unix socket to listen on, defaults to $AAFTF_LCA_SOCKET or aaftf-lca.sock")
+
+    parser_lca.add_argument('--shutdown',action='store_true',
+                            help="Stop the service running on --socket")
+
     ##########
     # rmdup
     ##########
@@ -450,6 +557,33 @@ def main():
     parser_pilon.add_argument('-it','--iterations', type=int, default=5,
                               help="Number of Polishing iterations to run")
 
+    parser_pilon.add_argument('--converge',action='store_true',
+                              help="Stop before --iterations once Pilon changes converge")
+
+    parser_pilon.add_argument('--min_changes',type=int,default=0,
+                              help="With --converge, stop when an iteration makes this many changes or fewer")
+
+    parser_pilon.add_argument('--max_changes_per_mb',type=float,required=False,
+                              help="With --converge, stop when changes per Mb of assembly is at or below this")
+
+    parser_pilon.add_argument('--incremental',action='store_true',
+                              help="After the first iteration only re-polish contigs changed in the previous iteration")
+
+    parser_pilon.add_argument('--aligner',default='bwa',choices=['bwa','minimap2'],
+                              help="Aligner used to map reads each iteration")
+
+    parser_pilon.add_argument('--max_coverage',type=float,required=False,
+                              help="Subsample read pairs to about this coverage before polishing")
+
+    parser_pilon.add_argument('--seed',type=int,default=1,
+                              help="Seed for --max_coverage read subsampling")
+
+    parser_pilon.add_argument('--shards',type=int,default=1,
+                              help="Split contigs into this many groups of balanced length and run a Pilon process on each")
+
+    parser_pilon.add_argument('-m','--memory',type=float,required=False,
+                              help="Total Java heap in GB shared by the Pilon processes [default: 80%% of available memory]")
+
     parser_pilon.add_argument('-l', '--left',type=str,
                               required=True,
             help='The name of the left/forward reads of paired-end FASTQ formatted reads.')
@@ -463,6 +597,9 @@ def main():
                               required=False,
                               help="Temporary directory to store datafiles and processes in")
 
+    parser_pilon.add_argument('--align_cache',type=str,required=False,
+                              help="Directory of read alignments saved by AAFTF sourpurge to reuse in the first iteration")
+
     parser_pilon.add_argument('--pipe',action='store_true',
                              help="AAFTF is running in pipeline mode")
 
@@ -549,15 +686,62 @@ def main():
     parser_pipeline.add_argument('-u','--screen_urls',type = str,
                                nargs="*",
                                help="URLs to download and screen out initial reads.")
+
+    parser_pipeline.add_argument('--accession_cache',type=str,
+                               required=False,
+                               help="Shared cache of downloaded accessions, defaults to $AAFTF_DB/accessions")
+
+    parser_pipeline.add_argument('--accession_url',type=str,
+                               required=False,
+                               help="efetch URL template for accessions (%%s replaced by comma separated IDs), defaults to $AAFTF_EFETCH_URL or NCBI")
+
+    parser_pipeline.add_argument('--accession_batch',type=int,default=100,
+                               help="Number of accessions to download per request")
+
+    parser_pipeline.add_argument('--download_threads',type=int,default=3,
+                               help="Number of concurrent accession download requests")
                                
     parser_pipeline.add_argument('-it','--iterations', type=int, default=5,
                               help="Number of Pilon Polishing iterations to run")
+
+    parser_pipeline.add_argument('--incremental',action='store_true',
+                              help="After the first Pilon iteration only re-polish contigs changed in the previous iteration")
+
+    parser_pipeline.add_argument('--aligner',default='bwa',choices=['bwa','minimap2'],
+                              help="Aligner used to map reads for Pilon")
+
+    parser_pipeline.add_argument('--max_coverage',type=float,required=False,
+                              help="Subsample reads to about this coverage for Pilon polishing")
+
+    parser_pipeline.add_argument('--seed',type=int,default=1,
+                              help="Seed for --max_coverage read subsampling")
+
+    parser_pipeline.add_argument('--shards',type=int,default=1,
+                              help="Number of Pilon processes to split contigs across")
+
+    parser_pipeline.add_argument('--converge',action='store_true',
+                              help="Stop Pilon before --iterations once changes converge")
+
+    parser_pipeline.add_argument('--min_changes',type=int,default=0,
+                              help="With --converge, stop when an iteration makes this many changes or fewer")
+
+    parser_pipeline.add_argument('--max_changes_per_mb',type=float,required=False,
+                              help="With --converge, stop when changes per Mb of assembly is at or below this")
                               
     parser_pipeline.add_argument('-mc','--mincontiglen',type=int,
                              default=500,
                              required=False,
                              help="Minimum length of contigs to keep")
 
+    parser_pipeline.add_argument('-pid','--percent_id',type=int,default=95,
+                             help="Percent identity for rmdup to call a contig a duplicate")
+
+    parser_pipeline.add_argument('-pcov','--percent_cov',type=int,default=95,
+                             help="Percent coverage for rmdup to call a contig a duplicate")
+
+    parser_pipeline.add_argument('-g','--grid',type=str,nargs='+',
+                             help="Sweep downstream options, i.e. mincovpct=2,5,10 iterations=3,5. Upstream stages run once, results in <out>.sweep.tsv")
+
     parser_pipeline.add_argument('--AAFTF_DB',type=str,
                                required=False,
                                help="Path to AAFTF resources, defaults to $AAFTF_DB")
@@ -577,7 +761,159 @@ def main():
     parser_pipeline.add_argument('--mincovpct',default=5,type=int,
                              help="Minimum percent of N50 coverage to remove")
 
+    parser_pipeline.add_argument('--assembler',default='spades',choices=['spades','megahit','skesa'],
+                             help="Assembler to use")
+
+    parser_pipeline.add_argument('--no_kmer_profile',action='store_true',
+                             help="Do not size SPAdes and sourpurge cutoffs from the read k-mer spectrum")
+
+    parser_pipeline.add_argument('--sour_socket',required=False,
+                             help="Unix socket of a running AAFTF lcaserver, defaults to $AAFTF_LCA_SOCKET")
+
+    parser_pipeline.add_argument('--taxcache',required=False,
+                             help="SQLite cache of contig taxonomy, defaults to sourpurge-taxonomy.sqlite next to --sourdb")
+
+    parser_pipeline.add_argument('--no_taxcache',action='store_true',
+                             help="Do not use the contig taxonomy cache")
+
+    parser_pipeline.add_argument('--metrics_textfile',required=False,
+                             help="Write Prometheus metrics to this file, i.e. in the node-exporter textfile collector folder")
+
+    parser_pipeline.add_argument('--metrics_listen',required=False,
+                             help="Serve Prometheus metrics on [host:]port/metrics, host defaults to 127.0.0.1")
+
+    parser_pipeline.add_argument('--metrics_interval',type=float,default=10,
+                             help="Seconds between updates of the process metrics")
+
                         
+    ##########
+    # batch run the pipeline on many samples
+    ##########
+    # arguments
+    # -i / --samples: tab delimited sample sheet (sample, left, right, phylum)
+    # -o / --outdir: output folder, one subfolder per sample
+    # -c / --cpus, -m / --memory: total budget shared by all samples
+
+    parser_batch = subparsers.add_parser('batch',
+                            description="Run the AAFTF pipeline on many samples sharing one CPU and memory budget",
+                            help='Run AAFTF pipeline on a sample sheet')
+
+    parser_batch.add_argument('-i', '--samples',type=str,required=True,
+            help='Tab delimited sample sheet with header: sample, left, right and optional phylum (comma separated)')
+
+    parser_batch.add_argument('-o','--outdir',type=str,required=True,
+                             help="Output folder, each sample is written to outdir/sample")
+
+    parser_batch.add_argument('-c','--cpus',type=int,metavar="cpus",required=False,default=1,
+                              help="Total number of CPUs/threads to use across all samples")
+
+    parser_batch.add_argument('-m','--memory',type=str,
+                            dest='memory',required=False,
+                            help="Total memory (in GB) to use across all samples. Default is 90%% of system memory")
+
+    parser_batch.add_argument('--sample_cpus',type=int,default=4,
+                              help="Number of CPUs/threads for each stage of a sample")
+
+    parser_batch.add_argument('--sample_memory',type=str,required=False,
+                              help="Memory (in GB) for SPAdes and Pilon of each sample. Default is from the k-mer spectrum or a share of --memory")
+
+    parser_batch.add_argument('-p', '--phylum', nargs="+",
+                             help="Phylum or Phyla to keep matches for samples without a phylum column, i.e. Ascomycota")
+
+    parser_batch.add_argument('-ml','--minlength',type=int,
+                             default=75,
+                             help="Minimum read length after trimming, default: 75")
+
+    parser_batch.add_argument('-a','--screen_accessions',type = str,
+                               nargs="*",
+                               help="Genbank accession number(s) to screen out from initial reads.")
+
+    parser_batch.add_argument('-u','--screen_urls',type = str,
+                               nargs="*",
+                               help="URLs to download and screen out initial reads.")
+
+    parser_batch.add_argument('--accession_cache',type=str,
+                               required=False,
+                               help="Shared cache of downloaded accessions, defaults to $AAFTF_DB/accessions")
+
+    parser_batch.add_argument('--accession_url',type=str,
+                               required=False,
+                               help="efetch URL template for accessions (%%s replaced by comma separated IDs), defaults to $AAFTF_EFETCH_URL or NCBI")
+
+    parser_batch.add_argument('--accession_batch',type=int,default=100,
+                               help="Number of accessions to download per request")
+
+    parser_batch.add_argument('--download_threads',type=int,default=3,
+                               help="Number of concurrent accession download requests")
+
+    parser_batch.add_argument('-it','--iterations', type=int, default=5,
+                              help="Number of Pilon Polishing iterations to run")
+
+    parser_batch.add_argument('--incremental',action='store_true',
+                              help="After the first Pilon iteration only re-polish contigs changed in the previous iteration")
+
+    parser_batch.add_argument('--aligner',default='bwa',choices=['bwa','minimap2'],
+                              help="Aligner used to map reads for Pilon")
+
+    parser_batch.add_argument('--max_coverage',type=float,required=False,
+                              help="Subsample reads to about this coverage for Pilon polishing")
+
+    parser_batch.add_argument('--seed',type=int,default=1,
+                              help="Seed for --max_coverage read subsampling")
+
+    parser_batch.add_argument('--shards',type=int,default=1,
+                              help="Number of Pilon processes to split contigs across")
+
+    parser_batch.add_argument('--converge',action='store_true',
+                              help="Stop Pilon before --iterations once changes converge")
+
+    parser_batch.add_argument('--min_changes',type=int,default=0,
+                              help="With --converge, stop when an iteration makes this many changes or fewer")
+
+    parser_batch.add_argument('--max_changes_per_mb',type=float,required=False,
+                              help="With --converge, stop when changes per Mb of assembly is at or below this")
+
+    parser_batch.add_argument('-mc','--mincontiglen',type=int,
+                             default=500,
+                             help="Minimum length of contigs to keep")
+
+    parser_batch.add_argument('--AAFTF_DB',type=str,
+                               required=False,
+                               help="Path to AAFTF resources, defaults to $AAFTF_DB")
+
+    parser_batch.add_argument('-v','--debug',action='store_true',
+                             help="Provide debugging messages")
+
+    parser_batch.add_argument('--sourdb',required=False,
+                             help="SourMash LCA k-31 taxonomy database")
+
+    parser_batch.add_argument('--mincovpct',default=5,type=int,
+                             help="Minimum percent of N50 coverage to remove")
+
+    parser_batch.add_argument('--assembler',default='spades',choices=['spades','megahit','skesa'],
+                             help="Assembler to use")
+
+    parser_batch.add_argument('--no_kmer_profile',action='store_true',
+                             help="Do not size SPAdes and sourpurge cutoffs from the read k-mer spectrum")
+
+    parser_batch.add_argument('--sour_socket',required=False,
+                             help="Unix socket of a running AAFTF lcaserver, defaults to $AAFTF_LCA_SOCKET")
+
+    parser_batch.add_argument('--taxcache',required=False,
+                             help="SQLite cache of contig taxonomy, defaults to sourpurge-taxonomy.sqlite next to --sourdb")
+
+    parser_batch.add_argument('--no_taxcache',action='store_true',
+                             help="Do not use the contig taxonomy cache")
+
+    parser_batch.add_argument('--metrics_textfile',required=False,
+                             help="Write Prometheus metrics to this file, i.e. in the node-exporter textfile collector folder")
+
+    parser_batch.add_argument('--metrics_listen',required=False,
+                             help="Serve Prometheus metrics on [host:]port/metrics, host defaults to 127.0.0.1")
+
+    parser_batch.add_argument('--metrics_interval',type=float,default=10,
+                             help="Seconds between updates of the process metrics")
+
     #set defaults
     parser.set_defaults(func=run_subtool)
 
@@ -589,12 +925,27 @@ def main():
         
     args = parser.parse_args()
 
+    if args.events:
+        open_event_log(args.events)
+    emit('run_start', argv=sys.argv, version=myversion, command=args.command)
+    if args.profile:
+        import AAFTF.pyprofile as pyprofile
+        pyprofile.start(args.profile, interval=args.profile_interval)
     try:
         status('Running AAFTF v{:}'.format(myversion))
-        args.func(parser, args)
+        if args.profile:
+            with pyprofile.stage(args.command or 'AAFTF'):
+                args.func(parser, args)
+        else:
+            args.func(parser, args)
     except IOError as e:
          if e.errno != 32:  # ignore SIGPIPE
              raise
+    finally:
+        if args.profile:
+            pyprofile.stop()
+        emit('run_end', exit=str(sys.exc_info()[1]) if sys.exc_info()[1] else None)
+        close_event_log()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,161 @@
+# cache of read alignments shared between stages
+# sourpurge maps all of the filtered reads to the assembly and pilon would
+# map the same reads to nearly the same sequences again. Alignments are
+# stored with the identity of the reads, the hash of every contig they
+# were aligned to and the contigs sourpurge dropped. A later stage reuses
+# them when all of its contigs are present and unchanged and the only
+# contigs missing are ones sourpurge dropped. Reads on contigs removed
+# for any other reason, ie duplicates removed by rmdup, would align to
+# the contigs kept in their place, so those alignments are not reused.
+
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import subprocess
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from AAFTF.utility import seq_hash
+from AAFTF.utility import status
+from AAFTF.utility import run_traced
+from AAFTF.utility import TracedPopen
+from AAFTF.utility import printCMD
+from AAFTF.utility import atomic_write
+from AAFTF.utility import file_lock
+
+def reads_key(reads):
+    '''
+    identity of a set of read files from path, size and modification time
+    '''
+    ident = []
+    for x in reads:
+        if not x:
+            continue
+        st = os.stat(x)
+        ident.append([os.path.abspath(x), st.st_size, st.st_mtime])
+    return hashlib.sha1(json.dumps(ident).encode('utf-8')).hexdigest()
+
+def contig_hashes(fasta):
+    Hashes = {}
+    with open(fasta, 'r') as infile:
+        for Header, Seq in SimpleFastaParser(infile):
+            Hashes[Header.split()[0]] = seq_hash(Seq)
+    return Hashes
+
+def load_manifest(cache_dir):
+    manifest = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.isfile(manifest):
+        return {}
+    with open(manifest, 'r') as infile:
+        return json.load(infile)
+
+def store(cache_dir, bam, reads, reference, dropped=[]):
+    '''
+    save coordinate sorted bam of reads aligned to reference in the cache,
+    dropped are the contigs of reference the aligning stage removed
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    contigs = contig_hashes(reference)
+    key = reads_key(reads)
+    refkey = hashlib.sha1(json.dumps(sorted(contigs.items())).encode('utf-8')).hexdigest()
+    cachebam = key[:16]+'.'+refkey[:16]+'.bam'
+    # copy and rename so other samples never find a partial bam
+    for src, dest in [(bam, cachebam), (bam+'.bai', cachebam+'.bai')]:
+        if not os.path.isfile(src):
+            continue
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.'+dest+'.')
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, os.path.join(cache_dir, dest))
+    if not os.path.isfile(os.path.join(cache_dir, cachebam+'.bai')):
+        run_traced(['samtools', 'index', cachebam], cwd=cache_dir)
+    manifestFile = os.path.join(cache_dir, 'manifest.json')
+    with file_lock(manifestFile+'.lock'):
+        manifest = load_manifest(cache_dir)
+        manifest[cachebam] = {'reads': key, 'contigs': contigs,
+                              'dropped': sorted(set([x.split()[0] for x in dropped]))}
+        atomic_write(manifestFile, json.dumps(manifest))
+    return os.path.join(cache_dir, cachebam)
+
+def lookup(cache_dir, reads, reference):
+    '''
+    find cached alignments of the same reads that include every contig in
+    reference with identical sequence and no other contigs than the ones
+    dropped by the stage that stored them, returns absolute path to the
+    bam or None, the bam is read by commands run in other folders
+    '''
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return None
+    key = reads_key(reads)
+    contigs = contig_hashes(reference)
+    for cachebam, entry in load_manifest(cache_dir).items():
+        if entry['reads'] != key:
+            continue
+        removed = set(entry['contigs']) - set(contigs)
+        if not removed.issubset(entry.get('dropped', [])):
+            continue
+        if all(entry['contigs'].get(k) == v for k,v in contigs.items()):
+            if os.path.isfile(os.path.join(cache_dir, cachebam)):
+                return os.path.abspath(os.path.join(cache_dir, cachebam))
+    return None
+
+def subset_sam(lines, keep):
+    '''
+    filter SAM lines to alignments on the contigs in keep, the header is
+    reduced to those contigs and mates placed on dropped contigs are
+    marked as unmapped so the output is a valid SAM
+    '''
+    for line in lines:
+        if line.startswith('@SQ'):
+            name = [x for x in line.rstrip('\n').split('\t') if x.startswith('SN:')][0][3:]
+            if name in keep:
+                yield line
+            continue
+        if line.startswith('@'):
+            yield line
+            continue
+        cols = line.rstrip('\n').split('\t')
+        if cols[2] != '*' and not cols[2] in keep:
+            continue
+        if cols[6] != '=' and cols[6] != '*' and not cols[6] in keep:
+            flag = (int(cols[1]) | 0x8) & ~0x2 & ~0x20
+            cols[1] = str(flag)
+            cols[6] = '='
+            cols[7] = cols[3]
+            cols[8] = '0'
+            line = '\t'.join(cols)+'\n'
+        yield line
+
+def reuse(cache_dir, reads, reference, outbam, workdir, threads=1):
+    '''
+    write alignments for the contigs in reference from a compatible cached
+    bam to outbam (relative to workdir), returns True if reused
+    '''
+    cachebam = lookup(cache_dir, reads, reference)
+    if not cachebam:
+        return False
+    status('Reusing cached read alignments: {:}'.format(cachebam))
+    keep = set(contig_hashes(reference).keys())
+    view_cmd = ['samtools', 'view', '-h', cachebam]
+    write_cmd = ['samtools', 'view', '-b', '-@', str(threads), '-o', outbam, '-']
+    printCMD(view_cmd)
+    DEVNULL = open(os.devnull, 'w')
+    p1 = TracedPopen(view_cmd, cwd=workdir, stdout=subprocess.PIPE,
+                     stderr=DEVNULL, universal_newlines=True)
+    p2 = TracedPopen(write_cmd, cwd=workdir, stdin=subprocess.PIPE,
+                     stderr=DEVNULL, universal_newlines=True)
+    for line in subset_sam(p1.stdout, keep):
+        p2.stdin.write(line)
+    p2.stdin.close()
+    p1.stdout.close()
+    p1.wait()
+    p2.wait()
+    if p1.returncode or p2.returncode or run_traced(['samtools', 'index', outbam], cwd=workdir).returncode:
+        # a partial bam would be taken as finished alignments
+        status('Unable to reuse cached alignments, realigning reads')
+        for x in [outbam, outbam+'.bai']:
+            if os.path.isfile(os.path.join(workdir, x)):
+                os.remove(os.path.join(workdir, x))
+        return False
+    return True
@@ -1,25 +1,222 @@
 # run a set of default genome assembly using
-# SPAdes. Additional tools could be supported or
-# users may prefer to run their custom assembly and skip this step
+# SPAdes, MEGAHIT or SKESA. Each assembler is an engine that maps the
+# AAFTF options to its command line, knows how to resume an interrupted
+# run and where the final contigs are written. Users may prefer to run
+# their custom assembly and skip this step
 
 
-import sys, os, subprocess, shutil
+import sys, os, subprocess, shutil, time, resource, json, re
 from AAFTF.utility import status
+from AAFTF.utility import TracedPopen
 from AAFTF.utility import printCMD
 from AAFTF.utility import fastastats
+from AAFTF.utility import ProcessSampler
+from AAFTF.metrics import record_contigs
+
+SPADES_STAGE = re.compile(r'^===== (.+) started\.')
+MEGAHIT_STAGE = re.compile(r'--- \[.*?\] (.+?)(?: for k = (\d+))?(?: \.\.\.)?$')
+
+def follow_log(logfile, position, engine, stages):
+    '''
+    read new lines of an assembler log from position, a line starting a
+    stage closes the previous one, returns new position
+    '''
+    if not logfile or not os.path.isfile(logfile):
+        return position
+    with open(logfile, 'r') as infile:
+        infile.seek(position)
+        while True:
+            line = infile.readline()
+            if not line.endswith('\n'):
+                break
+            position = infile.tell()
+            name = engine.stage(line.rstrip())
+            if not name:
+                continue
+            now = time.time()
+            if stages and stages[-1]['end'] is None:
+                stages[-1]['end'] = now
+            stages.append({'stage': name, 'start': now, 'end': None})
+            status('{:} stage: {:}'.format(engine.name, name))
+    return position
+
+def log_tail(logfile, lines=50):
+    if not logfile or not os.path.isfile(logfile):
+        return []
+    with open(logfile, 'r') as infile:
+        return [x.rstrip('\n') for x in infile.readlines()[-lines:]]
+
+def input_signature(engine, args, reads):
+    '''
+    what the assembly in workdir was made from: the assembler, the k-mers
+    and the path, size and mtime of the reads, hashing them would take
+    minutes on every run
+    '''
+    files = []
+    for x in reads:
+        if x:
+            st = os.stat(x)
+            files.append([os.path.abspath(x), st.st_size, st.st_mtime_ns])
+    return {'engine': engine.name, 'kmers': getattr(args, 'kmers', None),
+            'reads': files}
+
+def signature_file(args):
+    # next to the workdir, megahit refuses to start in an existing folder
+    return os.path.normpath(args.workdir)+'.inputs.json'
+
+def same_inputs(args, signature):
+    sigfile = signature_file(args)
+    if not os.path.isfile(sigfile):
+        return False
+    with open(sigfile, 'r') as infile:
+        return json.load(infile) == signature
+
+def write_profile(jsonfile, engine, cmd, returncode, start, end, sampler, stages, before, after, logfile):
+    '''
+    JSON resource profile of an assembly run, times are seconds since start
+    '''
+    for x in stages:
+        if x['end'] is None:
+            x['end'] = end
+    # peak and cpu are of the assembler's own process tree, the rusage of
+    # children covers every child of AAFTF: earlier stages and, with the
+    # scheduler, other stages and samples running at the same time
+    if sys.platform == 'darwin':
+        maxrss = after.ru_maxrss
+    else:
+        maxrss = after.ru_maxrss * 1024
+    profile = {'engine': engine.name, 'command': cmd,
+               'returncode': returncode,
+               'wall_seconds': round(end - start, 1),
+               'peak_rss_bytes': sampler.peak_rss,
+               'cpu_seconds': round(sampler.cpu, 1),
+               'process_wide_rusage': {'children_maxrss_bytes': maxrss,
+                                       'children_cpu_seconds': round(after.ru_utime + after.ru_stime -
+                                                                     before.ru_utime - before.ru_stime, 1)},
+               'stages': [{'stage': x['stage'],
+                           'start': round(x['start'] - start, 1),
+                           'seconds': round(x['end'] - x['start'], 1)} for x in stages],
+               'samples': [{'time': x[0], 'rss_bytes': x[1], 'cpu_seconds': x[2], 'processes': x[3]}
+                           for x in sampler.samples],
+               'log': logfile,
+               'log_tail': log_tail(logfile)}
+    with open(jsonfile, 'w') as outfile:
+        json.dump(profile, outfile, indent=2)
+    return profile
+
+class SPAdes(object):
+    name = 'spades'
+    exe = 'spades.py'
+
+    def command(self, args, forReads, revReads):
+        cmd = ['spades.py','--threads', str(args.cpus),
+               '--cov-cutoff', 'auto',
+               '--mem', str(args.memory), '--careful', '-o', args.workdir]
+        if args.spades_tmpdir:
+            cmd.extend(['--tmp-dir',args.spades_tmpdir])
+        if getattr(args, 'kmers', None):
+            cmd.extend(['-k', args.kmers])
+        if not revReads:
+            cmd = cmd + ['-s', forReads]
+        else:
+            cmd = cmd + ['--pe1-1', forReads, '--pe1-2', revReads]
+        return cmd
+
+    def resume(self, args):
+        if os.path.isdir(args.workdir):
+            return ['spades.py', '-o', args.workdir, '--continue']
+        return None
+
+    def output(self, args):
+        return os.path.join(args.workdir, 'scaffolds.fasta')
+
+    def log(self, args):
+        return os.path.join(args.workdir, 'spades.log')
+
+    def stage(self, line):
+        # ===== K21 started.
+        m = SPADES_STAGE.match(line)
+        if m:
+            return m.group(1)
+        return None
+
+class MEGAHIT(object):
+    name = 'megahit'
+    exe = 'megahit'
+
+    def command(self, args, forReads, revReads):
+        # megahit takes memory in bytes and creates the output folder itself
+        cmd = ['megahit', '-t', str(args.cpus),
+               '-m', str(int(float(args.memory) * 1e9)),
+               '-o', args.workdir]
+        if args.spades_tmpdir:
+            cmd.extend(['--tmp-dir', args.spades_tmpdir])
+        if getattr(args, 'kmers', None):
+            cmd.extend(['--k-list', args.kmers])
+        if not revReads:
+            cmd = cmd + ['-r', forReads]
+        else:
+            cmd = cmd + ['-1', forReads, '-2', revReads]
+        return cmd
+
+    def resume(self, args):
+        if os.path.isfile(os.path.join(args.workdir, 'checkpoints.txt')):
+            return ['megahit', '-o', args.workdir, '--continue']
+        return None
+
+    def output(self, args):
+        return os.path.join(args.workdir, 'final.contigs.fa')
+
+    def log(self, args):
+        return os.path.join(args.workdir, 'log')
+
+    def stage(self, line):
+        # --- [STEP 2] Assemble contigs from SdBG for k = 21
+        m = MEGAHIT_STAGE.search(line)
+        if m:
+            return m.group(1) + (' k' + m.group(2) if m.group(2) else '')
+        return None
+
+class SKESA(object):
+    name = 'skesa'
+    exe = 'skesa'
+
+    def command(self, args, forReads, revReads):
+        if not os.path.isdir(args.workdir):
+            os.makedirs(args.workdir)
+        cmd = ['skesa', '--cores', str(args.cpus),
+               '--memory', str(int(float(args.memory))),
+               '--contigs_out', self.output(args)]
+        if getattr(args, 'kmers', None):
+            cmd.extend(['--kmer', args.kmers.split(',')[0]])
+        if not revReads:
+            cmd = cmd + ['--reads', forReads]
+        else:
+            cmd = cmd + ['--reads', forReads+','+revReads, '--use_paired_ends']
+        return cmd
+
+    def resume(self, args):
+        # skesa has no checkpoints, start over
+        return None
+
+    def output(self, args):
+        return os.path.join(args.workdir, 'skesa.contigs.fasta')
+
+    def log(self, args):
+        # skesa only logs to stderr
+        return None
+
+    def stage(self, line):
+        return None
+
+ENGINES = {x.name: x for x in [SPAdes(), MEGAHIT(), SKESA()]}
 
 def run(parser,args):
 
+    engine = ENGINES[getattr(args, 'method', 'spades')]
     if not args.workdir:
-        args.workdir = 'spades_'+str(os.getpid())
-        
-    spadescmd = ['spades.py','--threads', str(args.cpus), 
-                 '--cov-cutoff', 'auto',
-                 '--mem', args.memory, '--careful', '-o', args.workdir]
-
-    if args.spades_tmpdir:
-        spadescmd.extend(['--tmp-dir',args.spades_tmpdir])
-        
+        args.workdir = engine.name+'_'+str(os.getpid())
+
     #find reads -- use --left/right or look for cleaned in tmpdir
     forReads, revReads = (None,)*2
     if args.left:
@@ -29,37 +226,76 @@ def run(parser,args):
     if not forReads:
         status('Unable to located FASTQ raw reads, provide --left')
         sys.exit(1)
-    
-    if not revReads:
-        spadescmd = spadescmd + ['-s', forReads]
-    else:
-        spadescmd = spadescmd + ['--pe1-1', forReads, '--pe1-2', revReads]
-# this basically overrides everything above and only runs --continue option
-    if os.path.isdir(args.workdir):
-        spadescmd = [ 'spades.py', '-o', args.workdir, '--continue' ]
-
-    # now run the spades job
-    status('Assembling FASTQ data using Spades')
-    printCMD(spadescmd)
-    DEVNULL = open(os.devnull, 'w')
-    if args.debug:
-        subprocess.run(spadescmd)
-    else:
-        subprocess.run(spadescmd, stdout=DEVNULL, stderr=DEVNULL)
+
+    # resume an interrupted run if the assembler supports it and it was
+    # started on the same reads, otherwise its partial results are stale
+    signature = input_signature(engine, args, [forReads, revReads])
+    cmd = None
+    if same_inputs(args, signature):
+        cmd = engine.resume(args)
+    elif os.path.isdir(args.workdir):
+        status('Inputs of {:} changed, removing previous assembly'.format(args.workdir))
+        shutil.rmtree(args.workdir)
+    if not cmd:
+        # ie megahit killed before its first checkpoint, it will not start
+        # in the folder it left behind
+        if os.path.isdir(args.workdir):
+            shutil.rmtree(args.workdir)
+        cmd = engine.command(args, forReads, revReads)
+        with open(signature_file(args), 'w') as outfile:
+            json.dump(signature, outfile, indent=2)
+
     #pull out assembly
     if args.out:
         finalOut = args.out
     else:
-        finalOut = prefix+'.spades.fasta'
+        finalOut = engine.name+'.fasta'
+    prefix = finalOut.rsplit('.f', 1)[0]
+    profileFile = prefix+'.assembly-profile.json'
 
-    if os.path.isfile(os.path.join(args.workdir, 'scaffolds.fasta')):
-        shutil.copyfile(os.path.join(args.workdir,'scaffolds.fasta'), finalOut)
-        status('Spades assembly finished: {:}'.format(finalOut))
+    # now run the assembly job
+    status('Assembling FASTQ data using {:}'.format(engine.name))
+    printCMD(cmd)
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    if args.debug:
+        errlog = None
+        proc = TracedPopen(cmd)
+    else:
+        errlog = prefix+'.assembly-stderr.log'
+        with open(errlog, 'w') as stderr:
+            proc = TracedPopen(cmd, stdout=subprocess.DEVNULL, stderr=stderr)
+    # sample the process tree and follow the log for stage progress
+    sampler = ProcessSampler(proc.pid)
+    sampler.start()
+    logfile = engine.log(args)
+    position = 0
+    stages = []
+    while proc.poll() is None:
+        position = follow_log(logfile, position, engine, stages)
+        time.sleep(1)
+    sampler.stop()
+    follow_log(logfile, position, engine, stages)
+    end = time.time()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if not logfile or not os.path.isfile(logfile):
+        logfile = errlog
+    profile = write_profile(profileFile, engine, cmd, proc.returncode, start, end,
+                            sampler, stages, before, after, logfile)
+    status('{:} finished in {:.1f} minutes with peak memory of {:.2f} GB, resource profile: {:}'.format(
+            engine.name, profile['wall_seconds'] / 60, profile['peak_rss_bytes'] / (1024.**3), profileFile))
+    if proc.returncode:
+        status('{:} exited with code {:}, last lines of log:\n{:}'.format(
+                engine.name, proc.returncode, '\n'.join(profile['log_tail'][-10:])))
+    if os.path.isfile(engine.output(args)):
+        shutil.copyfile(engine.output(args), finalOut)
+        status('{:} assembly finished: {:}'.format(engine.name, finalOut))
         numSeqs, assemblySize = fastastats(finalOut)
+        record_contigs('kept', numSeqs)
         status('Assembly is {:,} scaffolds and {:,} bp'.format(numSeqs, assemblySize))
     else:
-        status('Spades assembly output missing -- check Spades logfile.')
-        
+        status('{:} assembly output missing -- check {:} logfile.'.format(engine.name, engine.name))
+
     if not args.pipe:
         status('Your next command might be:\n\tAAFTF vecscreen -i {:} -c {:}\n'.format(finalOut, args.cpus))
-    
+
@@ -32,6 +32,11 @@ def genome_asm_stats(fasta_file,output_handle):
             l90 = i
             
         i += 1
+    stats = {'contigs': len(lengths), 'total_length': total_len,
+             'min': lengths[0], 'max': lengths[-1],
+             'median': lengths[int(len(lengths)/2)],
+             'mean': round(total_len/len(lengths), 2),
+             'L50': l50, 'N50': n50, 'L90': l90, 'N90': n90}
     report = "Assembly statistics for: %s\n" % (fasta_file)
     report += "%15s  =  %d\n" % ('CONTIG COUNT',len(lengths))
     report += "%15s  =  %d\n" % ('TOTAL LENGTH',total_len)
@@ -47,6 +52,7 @@ def genome_asm_stats(fasta_file,output_handle):
     print(report)
     if output_handle:
         output_handle.write(report)
+    return stats
 
 def run(parser,args):
 
@@ -58,5 +64,5 @@ def run(parser,args):
     if args.report:
         output_handle = open(args.report,"w")
 
-    genome_asm_stats(args.input, output_handle)
+    return genome_asm_stats(args.input, output_handle)
     
@@ -0,0 +1,129 @@
+# run the AAFTF pipeline over many samples from one process
+# the stages of every sample are added to a single scheduler so the
+# samples share one cpu and memory budget instead of each pipeline
+# assuming it owns the machine. Assembly asks for the memory estimated
+# from the sample's k-mer spectrum, so large genomes get a slot of their
+# own while small ones assemble side by side. A failed sample does not
+# stop the others.
+
+import sys
+import os
+import csv
+from argparse import Namespace
+from AAFTF.utility import status
+from AAFTF.utility import getRAM
+from AAFTF.scheduler import Scheduler
+from AAFTF.runprofile import RunProfile
+import AAFTF.metrics as metrics
+import AAFTF.pipeline as pipeline
+
+STAGES = ['trim', 'filter_db', 'filter', 'kmers', 'assemble', 'vecscreen_db', 'vecscreen',
+          'sourpurge', 'rmdup', 'pilon', 'sort', 'assess']
+
+def read_samples(samplesheet):
+    '''
+    tab delimited sample sheet with a header line of sample, left, right
+    and optionally phylum (comma separated), returns list of dictionaries
+    '''
+    samples = []
+    names = set()
+    with open(samplesheet, 'r') as infile:
+        rows = [x for x in infile if x.strip() and not x.startswith('#')]
+    for row in csv.DictReader(rows, delimiter='\t'):
+        row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+        if not row.get('sample') or not row.get('left'):
+            status('Sample sheet row is missing sample or left: {:}'.format(row))
+            sys.exit(1)
+        if row['sample'] in names:
+            status('Sample {:} is listed more than once in {:}'.format(row['sample'], samplesheet))
+            sys.exit(1)
+        names.add(row['sample'])
+        for x in ['left', 'right']:
+            if row.get(x) and not os.path.isabs(row[x]):
+                row[x] = os.path.join(os.path.dirname(os.path.abspath(samplesheet)), row[x])
+        samples.append(row)
+    return samples
+
+def sample_args(args, sample):
+    '''
+    pipeline options for one sample, outputs go to outdir/sample
+    '''
+    sampleDict = dict(vars(args))
+    folder = os.path.join(args.outdir, sample['sample'])
+    sampleDict['left'] = sample['left']
+    sampleDict['right'] = sample.get('right') or None
+    sampleDict['basename'] = os.path.join(folder, sample['sample'])
+    sampleDict['workdir'] = os.path.join(folder, 'work')
+    sampleDict['cpus'] = min(args.sample_cpus, args.cpus)
+    sampleDict['memory'] = args.sample_memory
+    if sample.get('phylum'):
+        sampleDict['phylum'] = [x.strip() for x in sample['phylum'].split(',') if x.strip()]
+    if not sampleDict['phylum']:
+        status('No phylum given for sample {:}, provide --phylum or a phylum column'.format(sample['sample']))
+        sys.exit(1)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return Namespace(**sampleDict)
+
+def write_status(filename, samples, dag):
+    '''
+    combined table of the state of every stage of every sample
+    '''
+    results = {}
+    with open(filename, 'w') as outfile:
+        outfile.write('sample\tstage\tstatus\tseconds\n')
+        for s in samples:
+            for stage in STAGES:
+                name = s['sample']+':'+stage
+                if not name in dag.state:
+                    continue
+                state, seconds = dag.state[name]
+                outfile.write('{:}\t{:}\t{:}\t{:}\n'.format(
+                    s['sample'], stage, state, '' if seconds is None else round(seconds, 1)))
+            states = [v[0] for k, v in dag.state.items() if k.startswith(s['sample']+':')]
+            if 'failed' in states:
+                result = 'failed'
+            elif 'not run' in states:
+                result = 'incomplete'
+            else:
+                result = 'finished'
+            results[s['sample']] = result
+    return results
+
+def run(parser, args):
+    samples = read_samples(args.samples)
+    if not samples:
+        status('No samples found in {:}'.format(args.samples))
+        sys.exit(1)
+    totalRAM = getRAM()
+    if args.memory:
+        budget = int(float(args.memory))
+    else:
+        budget = int(0.9*totalRAM)
+    # without --sample_memory each sample's memory hungry stages get an
+    # equal share of the budget between the samples that can run at once
+    slots = max(1, args.cpus // max(1, args.sample_cpus))
+    defaultMemory = max(1, budget // slots)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    status('Running {:,} samples with {:} cpus and {:} GB of memory, {:} cpus per stage'.format(
+            len(samples), args.cpus, budget, min(args.sample_cpus, args.cpus)))
+    dag = Scheduler(args.cpus, budget, keep_going=True, profile=RunProfile(),
+                    metrics=metrics.start(args))
+    for s in samples:
+        sampleargs = sample_args(args, s)
+        log = sampleargs.basename+'.log'
+        status('{:} log: {:}'.format(s['sample'], log))
+        pipeline.add_tasks(parser, sampleargs, dag, label=s['sample'], log=log,
+                           defaultMemory=defaultMemory)
+    pipeline.run_dag(dag, os.path.join(args.outdir, 'run_profile.json'))
+
+    statusFile = os.path.join(args.outdir, 'batch-status.tsv')
+    results = write_status(statusFile, samples, dag)
+    failed = sorted([k for k, v in results.items() if v != 'finished'])
+    status('{:,} of {:,} samples finished, stage status written to {:}'.format(
+            len(samples) - len(failed), len(samples), statusFile))
+    if failed:
+        status('Samples failed or incomplete: {:}'.format(', '.join(failed)))
+        sys.exit(1)
@@ -1,5 +1,10 @@
 import sys, os, shutil, gzip, subprocess
+import json, hashlib, datetime, time
 import urllib.request
+import urllib.error
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 
 # this runs rountines to remove sequence reads
 # which match contaminant databases and sources
@@ -15,18 +20,145 @@ from AAFTF.resources import SeqDBs
 from AAFTF.resources import DB_Links
 from AAFTF.utility import bam_read_count
 from AAFTF.utility import countfastq
+from AAFTF.metrics import record_reads
 from AAFTF.utility import status
+from AAFTF.utility import run_traced
+from AAFTF.utility import TracedPopen
 from AAFTF.utility import printCMD
 from AAFTF.utility import SafeRemove
 from AAFTF.utility import getRAM
+from AAFTF.utility import atomic_write
+from AAFTF.utility import file_lock
 
-def run(parser,args):
-    custom_workdir = 1
-    if not args.workdir:
-        custom_workdir = 0
-        args.workdir = 'aaftf-filter_'+str(os.getpid())
+# seconds to wait before the first retry of a failed efetch request
+RETRY_WAIT = 10
+
+def load_accession_manifest(cache_dir):
+    manifest = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.isfile(manifest):
+        return {}
+    with open(manifest, 'r') as infile:
+        return json.load(infile)
+
+def save_accession_manifest(cache_dir, entries):
+    '''
+    merge new entries into the cache manifest, re-reading it under a lock
+    first so that samples screening at the same time do not drop each
+    others records
+    '''
+    manifest = os.path.join(cache_dir, 'manifest.json')
+    with file_lock(manifest+'.lock'):
+        current = load_accession_manifest(cache_dir)
+        current.update(entries)
+        atomic_write(manifest, json.dumps(current, indent=2, sort_keys=True))
+
+def split_fasta_records(text):
+    records = []
+    for chunk in text.split('\n>'):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        if not chunk.startswith('>'):
+            chunk = '>'+chunk
+        records.append((chunk.split('\n',1)[0][1:].split()[0], chunk+'\n'))
+    return records
+
+def match_accession(seqid, batch):
+    # efetch returns versioned IDs, ie NC_001422.1, user may pass NC_001422
+    for acc in batch:
+        if seqid == acc or seqid.split('.')[0] == acc.split('.')[0]:
+            return acc
+    return None
+
+def fetch_accession_batch(batch, url):
+    '''
+    download a set of accessions with a single efetch request,
+    returns dictionary of accession: FASTA text
+    '''
+    request = url % (','.join(batch))
+    with urllib.request.urlopen(request) as response:
+        text = response.read().decode('utf-8')
+    results = {}
+    for seqid, record in split_fasta_records(text):
+        acc = match_accession(seqid, batch)
+        if not acc:
+            continue
+        if acc in results:
+            results[acc] += record
+        else:
+            results[acc] = record
+    return results
+
+def fetch_accessions(accessions, cache_dir, url, batch_size=100, threads=3, retries=2):
+    '''
+    return dictionary of accession: FASTA file from a content-addressed
+    cache, downloading only the accessions not yet in the manifest in
+    batched efetch requests. Failed requests are retried, exits if any
+    accession is still missing rather than screen without it
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest = load_accession_manifest(cache_dir)
+    found = {}
+    missing = []
+    for acc in accessions:
+        if acc in manifest and os.path.isfile(os.path.join(cache_dir, manifest[acc]['file'])):
+            found[acc] = os.path.join(cache_dir, manifest[acc]['file'])
+        elif not acc in missing:
+            missing.append(acc)
+    if not missing:
+        return found
+
+    batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
+    status('Downloading {:,} accessions in {:,} batched requests'.format(len(missing), len(batches)))
+    new_entries = {}
+    try:
+        for attempt in range(retries+1):
+            if attempt:
+                status('Retrying {:,} failed requests in {:} seconds'.format(len(batches), RETRY_WAIT*attempt))
+                time.sleep(RETRY_WAIT*attempt)
+            failed = []
+            with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                jobs = {executor.submit(fetch_accession_batch, x, url): x for x in batches}
+                for job in as_completed(jobs):
+                    try:
+                        results = job.result()
+                    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                        # one failed request should not lose the other batches
+                        status('Download of {:,} accessions failed: {:}\n{:}'.format(
+                            len(jobs[job]), e, ','.join(jobs[job])))
+                        failed.append(jobs[job])
+                        continue
+                    for acc, record in results.items():
+                        checksum = hashlib.sha256(record.encode('utf-8')).hexdigest()
+                        cachefile = checksum+'.fna'
+                        if not os.path.isfile(os.path.join(cache_dir, cachefile)):
+                            atomic_write(os.path.join(cache_dir, cachefile), record)
+                        new_entries[acc] = {'file': cachefile, 'sha256': checksum,
+                                            'url': url % (acc),
+                                            'fetched': datetime.datetime.now().isoformat()}
+                        found[acc] = os.path.join(cache_dir, cachefile)
+            batches = failed
+            if not batches:
+                break
+    finally:
+        # keep what was downloaded even when a later batch raised
+        if new_entries:
+            save_accession_manifest(cache_dir, new_entries)
+    notFound = [x for x in missing if not x in found]
+    if notFound:
+        status('Unable to download {:,} accessions, the contaminant database would be incomplete: {:}'.format(
+            len(notFound), ', '.join(notFound)))
+        sys.exit(1)
+    return found
+
+def prepare_contamdb(args):
+    '''
+    download the contaminant sequences and combine them into
+    contamdb.fa in the workdir, returns its path
+    '''
     if not os.path.exists(args.workdir):
-        os.mkdir(args.workdir)
+        os.makedirs(args.workdir)
 
     #parse database locations
     DB = None
@@ -41,10 +173,6 @@ def run(parser,args):
     else:
         DB = args.AAFTF_DB
         
-    bamthreads = 4
-    if args.cpus < 4:
-        bamthreads = args.cpus
-            
     earliest_file_age = -1
     contam_filenames = []
     # db of contaminant (PhiX)
@@ -76,17 +204,32 @@ def run(parser,args):
             earliest_file_age = os.path.getctime(acc_file)
     
     if args.screen_accessions:
+        # accessions already saved in AAFTF_DB are used as is, rest come from the cache
+        acc_files = {}
+        to_fetch = []
         for acc in args.screen_accessions:
-            if DB:
-                acc_file = os.path.join(DB, acc+".fna")
-                if not os.path.exists(acc_file):
-                    acc_file = os.path.join(args.workdir,acc+".fna")
+            if DB and os.path.exists(os.path.join(DB, acc+".fna")):
+                acc_files[acc] = os.path.join(DB, acc+".fna")
+            else:
+                to_fetch.append(acc)
+        if to_fetch:
+            if args.accession_cache:
+                cache_dir = args.accession_cache
+            elif DB:
+                cache_dir = os.path.join(DB, 'accessions')
             else:
-                acc_file = os.path.join(args.workdir,acc+".fna")
+                cache_dir = os.path.join(os.path.expanduser('~'), '.AAFTF', 'accessions')
+            url = args.accession_url
+            if not url:
+                url = os.environ.get('AAFTF_EFETCH_URL', SeqDBs['nucleotide'])
+            acc_files.update(fetch_accessions(to_fetch, cache_dir, url,
+                                              batch_size=args.accession_batch,
+                                              threads=args.download_threads))
+        for acc in args.screen_accessions:
+            if not acc in acc_files:
+                continue
+            acc_file = acc_files[acc]
             contam_filenames.append(acc_file)
-            if not os.path.exists(acc_file):
-                url = SeqDBs['nucleotide'] % (acc)
-                urllib.request.urlretrieve(url,acc_file)
             if ( earliest_file_age < 0 or
                  earliest_file_age < os.path.getctime(acc_file) ):
                 earliest_file_age = os.path.getctime(acc_file)
@@ -110,7 +253,22 @@ def run(parser,args):
              for fname in contam_filenames:
                  with open(fname,'rb') as fd: # reasonably fast copy for append
                      shutil.copyfileobj(fd, wfd)
-    
+    return contamdb
+
+def run(parser,args):
+    custom_workdir = 1
+    if not args.workdir:
+        custom_workdir = 0
+        args.workdir = 'aaftf-filter_'+str(os.getpid())
+    if not os.path.exists(args.workdir):
+        os.mkdir(args.workdir)
+
+    bamthreads = 4
+    if args.cpus < 4:
+        bamthreads = args.cpus
+            
+    contamdb = prepare_contamdb(args)
+
     #find reads
     forReads, revReads = (None,)*2
     if args.left:
@@ -124,6 +282,7 @@ def run(parser,args):
     if revReads:
         total = total*2
     status('Loading {:,} total reads'.format(total))
+    record_reads('in', total)
     
     # seems like this needs to be stripping trailing extension?
     if not args.basename:
@@ -155,9 +314,9 @@ def run(parser,args):
         cmd.extend(['prealloc','qhdist=1'])
         printCMD(cmd)
         if args.debug:
-            subprocess.run(cmd)
+            run_traced(cmd)
         else:
-            subprocess.run(cmd, stderr=DEVNULL)
+            run_traced(cmd, stderr=DEVNULL)
 
         if not args.debug and not custom_workdir:
             SafeRemove(args.workdir)
@@ -167,6 +326,7 @@ def run(parser,args):
             clean = clean*2
         status('{:,} reads mapped to contamination database'.format((total-clean)))
         status('{:,} reads unmapped and writing to file'.format(clean))
+        record_reads('out', clean)
 
         status('Filtering complete:\n\tFor: {:}\n\tRev: {:}'.format(
             clean_reads+'_1.fastq.gz',clean_reads+'_2.fastq.gz'))
@@ -186,7 +346,7 @@ def run(parser,args):
                 # the db
                 bowtie_index = ['bowtie2-build', contamdb, contamdb]
                 printCMD(bowtie_index)
-                subprocess.run(bowtie_index, stderr=DEVNULL, stdout=DEVNULL)
+                run_traced(bowtie_index, stderr=DEVNULL, stdout=DEVNULL)
 
             bowtie_cmd = ['bowtie2','-x', os.path.basename(contamdb),
                           '-p', str(args.cpus), '--very-sensitive']
@@ -197,13 +357,14 @@ def run(parser,args):
             
             #now run and write to BAM sorted
             printCMD(bowtie_cmd)
-            p1 = subprocess.Popen(bowtie_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
-            p2 = subprocess.Popen(['samtools', 'sort', '-@', str(bamthreads),
-                                   '-o', os.path.basename(alignBAM), '-'],
-                                   cwd=args.workdir, stdout=subprocess.PIPE, 
-                                   stderr=DEVNULL, stdin=p1.stdout)
+            p1 = TracedPopen(bowtie_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
+            p2 = TracedPopen(['samtools', 'sort', '-@', str(bamthreads),
+                              '-o', os.path.basename(alignBAM), '-'],
+                              cwd=args.workdir, stdout=subprocess.PIPE, 
+                              stderr=DEVNULL, stdin=p1.stdout)
             p1.stdout.close()
-            p2.communicate()        
+            p2.communicate()
+            p1.wait()
                 
     elif args.aligner == 'bwa':
         # likely less accurate than bbduk so may not be used
@@ -214,7 +375,7 @@ def run(parser,args):
                  os.path.getctime(contamdb)):
                 bwa_index = ['bwa','index', contamdb]
                 printCMD(bwa_index)
-                subprocess.run(bwa_index, stderr=DEVNULL, stdout=DEVNULL)
+                run_traced(bwa_index, stderr=DEVNULL, stdout=DEVNULL)
             
             bwa_cmd = ['bwa', 'mem', '-t', str(args.cpus), os.path.basename(contamdb), forReads]
             if revReads:
@@ -222,13 +383,14 @@ def run(parser,args):
             
             #now run and write to BAM sorted
             printCMD(bwa_cmd)
-            p1 = subprocess.Popen(bwa_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
-            p2 = subprocess.Popen(['samtools', 'sort', '-@', str(bamthreads),
-                                   '-o', os.path.basename(alignBAM), '-'],
-                                   cwd=args.workdir, stdout=subprocess.PIPE, 
-                                   stderr=DEVNULL, stdin=p1.stdout)
+            p1 = TracedPopen(bwa_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
+            p2 = TracedPopen(['samtools', 'sort', '-@', str(bamthreads),
+                              '-o', os.path.basename(alignBAM), '-'],
+                              cwd=args.workdir, stdout=subprocess.PIPE, 
+                              stderr=DEVNULL, stdin=p1.stdout)
             p1.stdout.close()
-            p2.communicate()                
+            p2.communicate()
+            p1.wait()
       
     elif args.aligner == 'minimap2':
          # likely not used but may be useful for pacbio/nanopore?
@@ -241,22 +403,24 @@ def run(parser,args):
             
             #now run and write to BAM sorted
             printCMD(minimap2_cmd)
-            p1 = subprocess.Popen(minimap2_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
-            p2 = subprocess.Popen(['samtools', 'sort', '-@', str(bamthreads),
-                                   '-o', os.path.basename(alignBAM), '-'],
-                                   cwd=args.workdir, stdout=subprocess.PIPE, 
-                                   stderr=DEVNULL, stdin=p1.stdout)
+            p1 = TracedPopen(minimap2_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
+            p2 = TracedPopen(['samtools', 'sort', '-@', str(bamthreads),
+                              '-o', os.path.basename(alignBAM), '-'],
+                              cwd=args.workdir, stdout=subprocess.PIPE, 
+                              stderr=DEVNULL, stdin=p1.stdout)
             p1.stdout.close()
-            p2.communicate()    
+            p2.communicate()
+            p1.wait()
     else:
         status("Must specify bowtie2, bwa, or minimap2 for filtering")
     
     if os.path.isfile(alignBAM):
         #display mapping stats in terminal
-        subprocess.run(['samtools', 'index', alignBAM])
+        run_traced(['samtools', 'index', alignBAM])
         mapped, unmapped = bam_read_count(alignBAM)
         status('{:,} reads mapped to contamination database'.format(mapped))
         status('{:,} reads unmapped and writing to file'.format(unmapped))
+        record_reads('out', unmapped)
         #now output unmapped reads from bamfile
         #this needs to be -f 5 so unmapped-pairs
         if forReads and revReads:
@@ -268,7 +432,7 @@ def run(parser,args):
             samtools_cmd = ['samtools', 'fastq', '-f', '4',
                             '-1', clean_reads+'.fastq.gz',
                             alignBAM]
-        subprocess.run(samtools_cmd, stderr=DEVNULL)
+        run_traced(samtools_cmd, stderr=DEVNULL)
         if not args.debug:
             SafeRemove(args.workdir)
         if revReads:
@@ -0,0 +1,226 @@
+# k-mer spectrum of sequencing reads
+# reads are 2-bit encoded with numpy and the canonical k-mers whose hash
+# falls in a fixed fraction of hash space are counted, which keeps every
+# occurrence of a sampled k-mer so the histogram has the same shape as the
+# full spectrum. The histogram gives estimates of genome size, coverage
+# and heterozygosity that are used to size the assembly and set the
+# sourpurge coverage cutoff.
+
+import sys
+import os
+import json
+import math
+import numpy
+from AAFTF.utility import status
+from AAFTF.utility import zopen
+from AAFTF.utility import getRAM
+
+ENCODE = numpy.full(256, 4, dtype=numpy.uint8)
+for i, b in enumerate(b'ACGT'):
+    ENCODE[b] = i
+    ENCODE[ord(chr(b).lower())] = i
+
+HASH_MULT = numpy.uint64(0x9E3779B97F4A7C15)
+MAX_COUNT = 10000
+
+def canonical_kmers(seq, k):
+    '''
+    numpy array of canonical 2-bit encoded k-mers (k <= 31) in seq bytes,
+    windows containing anything other than ACGT are skipped
+    '''
+    codes = ENCODE[numpy.frombuffer(seq, dtype=numpy.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    bad = numpy.concatenate(([0], numpy.cumsum(codes == 4)))
+    valid = (bad[k:] - bad[:n]) == 0
+    codes = numpy.where(codes == 4, 0, codes).astype(numpy.uint64)
+    fwd = numpy.zeros(n, dtype=numpy.uint64)
+    rev = numpy.zeros(n, dtype=numpy.uint64)
+    for i in range(k):
+        window = codes[i:i+n]
+        fwd = (fwd << numpy.uint64(2)) | window
+        rev = rev | ((numpy.uint64(3) - window) << numpy.uint64(2*i))
+    return numpy.minimum(fwd, rev)[valid]
+
+def sample_kmers(kmers, sample):
+    '''
+    keep k-mers whose hash falls in the lowest 1/sample of hash space
+    '''
+    if sample <= 1:
+        return kmers
+    with numpy.errstate(over='ignore'):
+        hashed = kmers * HASH_MULT
+    bound = numpy.uint64((2**64 - 1) // sample)
+    return kmers[hashed <= bound]
+
+def merge_counts(parts):
+    '''
+    merge a list of (sorted unique keys, counts) into one, summing the
+    counts of keys found in more than one
+    '''
+    allkeys = numpy.concatenate([x[0] for x in parts])
+    allcounts = numpy.concatenate([x[1] for x in parts])
+    if not len(allkeys):
+        return allkeys, allcounts
+    order = numpy.argsort(allkeys, kind='stable')
+    allkeys = allkeys[order]
+    allcounts = allcounts[order]
+    # start of each run of equal keys
+    idx = numpy.flatnonzero(numpy.concatenate(([True], allkeys[1:] != allkeys[:-1])))
+    return allkeys[idx], numpy.add.reduceat(allcounts, idx)
+
+def fastq_sequences(reads):
+    for x in reads:
+        if not x:
+            continue
+        handle = zopen(x, 'rb')
+        for i, line in enumerate(handle):
+            if i % 4 == 1:
+                yield line.rstrip()
+        handle.close()
+
+def count_kmers(reads, k=21, sample=16, max_reads=None, batch=4*1024*1024):
+    '''
+    stream FASTQ files and count sampled canonical k-mers, returns
+    histogram array (index is multiplicity), number of reads and bases
+    '''
+    # the unique k-mers of each batch are only merged into the totals once
+    # they outnumber them, re-sorting the totals every batch is quadratic
+    # in the number of batches
+    merged = (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64))
+    parts = []
+    partsize = 0
+    pending = []
+    buffered = 0
+    nreads, nbases = 0, 0
+    for seq in fastq_sequences(reads):
+        nreads += 1
+        nbases += len(seq)
+        pending.append(seq)
+        buffered += len(seq) + 1
+        if buffered >= batch:
+            kmers = sample_kmers(canonical_kmers(b'N'.join(pending), k), sample)
+            parts.append(numpy.unique(kmers, return_counts=True))
+            partsize += len(parts[-1][0])
+            pending, buffered = [], 0
+            if partsize > len(merged[0]):
+                merged = merge_counts([merged] + parts)
+                parts, partsize = [], 0
+        if max_reads and nreads >= max_reads:
+            break
+    if pending:
+        kmers = sample_kmers(canonical_kmers(b'N'.join(pending), k), sample)
+        parts.append(numpy.unique(kmers, return_counts=True))
+    keys, counts = merge_counts([merged] + parts)
+    hist = numpy.bincount(numpy.minimum(counts, MAX_COUNT), minlength=MAX_COUNT+1)
+    return hist, nreads, nbases
+
+def estimate(hist, k, read_length, sample=16):
+    '''
+    estimate genome size, coverage and heterozygosity from k-mer histogram,
+    the error valley is the first local minimum and the main peak is the
+    highest point after it, returns dictionary (values None if no peak)
+    '''
+    result = {'k': k, 'read_length': read_length, 'valley': None, 'peak': None,
+              'kmer_coverage': None, 'coverage': None, 'genome_size': None,
+              'heterozygosity': None}
+    hist = numpy.asarray(hist, dtype=numpy.float64)
+    valley = None
+    for i in range(2, len(hist)-1):
+        if hist[i] <= hist[i+1]:
+            valley = i
+            break
+    if valley is None or hist[valley:-1].sum() == 0:
+        return result
+    peak = valley + int(numpy.argmax(hist[valley:-1]))
+    multiplicity = numpy.arange(len(hist))
+    genome_kmers = float((multiplicity[valley:] * hist[valley:]).sum()) / peak
+    result['valley'] = valley
+    result['peak'] = peak
+    result['kmer_coverage'] = peak
+    result['genome_size'] = int(genome_kmers * sample)
+    if read_length > k:
+        result['coverage'] = round(peak * read_length / float(read_length - k + 1), 2)
+    #k-mers around half the main peak come from heterozygous sites, each
+    #SNP gives 2k distinct k-mers at half coverage
+    het_end = int(0.75 * peak)
+    if het_end > valley:
+        het_kmers = hist[valley:het_end].sum()
+        hom_kmers = hist[het_end:].sum()
+        if hom_kmers:
+            result['heterozygosity'] = round(float(het_kmers) / (2. * k) / (hom_kmers + het_kmers / 2.), 6)
+    return result
+
+def spades_memory(profile):
+    '''
+    SPAdes memory limit in GB, a rough allowance of 1 GB per 4 Mb of
+    genome scaled for coverage over 50X, at least 8 GB and at most 90%
+    of system memory
+    '''
+    available = max(8, int(0.9 * getRAM()))
+    if not profile.get('genome_size') or not profile.get('coverage'):
+        return available
+    need = 8 + (profile['genome_size'] / 4e6) * max(1, profile['coverage'] / 50.)
+    return int(min(available, math.ceil(need)))
+
+def spades_kmers(profile):
+    '''
+    SPAdes k-mer sizes below 80% of read length, larger k are dropped
+    when their k-mer coverage would fall under 10X
+    '''
+    ks = [21, 33, 55, 77, 99, 127]
+    read_length = profile.get('read_length') or 150
+    ks = [x for x in ks if x < 0.8 * read_length] or [21]
+    coverage = profile.get('coverage')
+    if coverage:
+        keep = [x for x in ks if coverage * (read_length - x + 1) / read_length >= 10]
+        ks = ks[:max(2, len(keep))]
+    return ks
+
+def profile_reads(reads, k=21, sample=16, max_reads=None, histfile=None):
+    hist, nreads, nbases = count_kmers(reads, k=k, sample=sample, max_reads=max_reads)
+    read_length = int(round(nbases / float(nreads))) if nreads else 0
+    result = estimate(hist, k, read_length, sample=sample)
+    result['reads'] = nreads
+    result['bases'] = nbases
+    result['sample'] = sample
+    if histfile:
+        with open(histfile, 'w') as outfile:
+            for i in range(1, len(hist)):
+                if hist[i]:
+                    outfile.write('{:}\t{:}\n'.format(i, int(hist[i])*sample))
+    return result
+
+def load_profile(jsonfile):
+    with open(jsonfile, 'r') as infile:
+        return json.load(infile)
+
+def report(result):
+    if not result.get('genome_size'):
+        status('Unable to find a coverage peak in the k-mer spectrum')
+        return
+    status('K-mer spectrum: peak at {:}X k-mer coverage, estimated {:.1f}X read coverage'.format(
+            result['kmer_coverage'], result['coverage'] or 0))
+    status('Estimated genome size is {:,} bp'.format(result['genome_size']))
+    if result.get('heterozygosity') is not None:
+        status('Estimated heterozygosity is {:.3f}%'.format(100*result['heterozygosity']))
+
+def run(parser, args):
+    if args.kmer > 31:
+        status('K-mer size must be 31 or less')
+        sys.exit(1)
+    if args.out:
+        jsonfile = args.out
+    else:
+        jsonfile = os.path.basename(args.left).split('.f')[0]+'.kmers.json'
+    histfile = jsonfile.rsplit('.json', 1)[0]+'.hist'
+    status('Counting {:}-mers in reads, sampling 1/{:} of k-mers'.format(args.kmer, args.sample))
+    result = profile_reads([args.left, args.right], k=args.kmer, sample=args.sample,
+                           max_reads=args.max_reads, histfile=histfile)
+    result['spades_memory'] = spades_memory(result)
+    result['spades_kmers'] = spades_kmers(result)
+    with open(jsonfile, 'w') as outfile:
+        json.dump(result, outfile, indent=2)
+    report(result)
+    status('K-mer profile written to {:} and histogram to {:}'.format(jsonfile, histfile))
@@ -0,0 +1,149 @@
+# long-lived sourmash LCA classification service
+# loading genbank-k31.lca.json.gz takes minutes and several GB of RAM,
+# so when processing many samples the database is loaded once here and
+# sourpurge sends its contig signatures over a Unix socket instead of
+# running sourmash lca classify for every assembly
+
+import sys, os, csv, io, json
+import socket
+import socketserver
+from AAFTF.utility import status
+
+DEFAULT_THRESHOLD = 5
+
+def find_sourdb(args):
+    if args.sourdb:
+        return os.path.abspath(args.sourdb)
+    DB = args.AAFTF_DB
+    if not DB:
+        DB = os.environ.get('AAFTF_DB')
+    if not DB:
+        status("$AAFTF_DB/genbank-k31.lca.json.gz not found, pass --sourdb")
+        sys.exit(1)
+    return os.path.join(DB, 'genbank-k31.lca.json.gz')
+
+def default_socket():
+    return os.environ.get('AAFTF_LCA_SOCKET', 'aaftf-lca.sock')
+
+def load_database(dbfile):
+    from sourmash.lca import lca_utils
+    dblist, ksize, scaled = lca_utils.load_databases([dbfile], None)
+    return dblist, ksize, scaled
+
+def classify_sigfile(sigfile, dblist, ksize, scaled, threshold=DEFAULT_THRESHOLD):
+    '''
+    classify every signature in sigfile, returns CSV text formatted
+    the same as sourmash lca classify output
+    '''
+    from sourmash import load_file_as_signatures
+    from sourmash.lca import lca_utils
+    from sourmash.lca.command_classify import classify_signature
+    out = io.StringIO()
+    csvfp = csv.writer(out)
+    csvfp.writerow(['ID', 'status'] + list(lca_utils.taxlist()))
+    for query_sig in load_file_as_signatures(sigfile, ksize=ksize):
+        if query_sig.minhash.scaled != scaled:
+            with query_sig.update() as query_sig:
+                query_sig.minhash = query_sig.minhash.downsample(scaled=scaled)
+        lineage, result = classify_signature(query_sig, dblist, threshold, False)
+        csvfp.writerow([str(query_sig), result] + lca_utils.zip_lineage(lineage))
+    return out.getvalue()
+
+class LCAHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            self.wfile.write(b'ERROR: malformed request\n')
+            return
+        if request.get('command') == 'ping':
+            self.wfile.write(b'OK\n')
+        elif request.get('command') == 'shutdown':
+            self.wfile.write(b'OK\n')
+            self.server.stopping = True
+        elif request.get('query'):
+            if not os.path.isfile(request['query']):
+                self.wfile.write('ERROR: {:} not found\n'.format(request['query']).encode('utf-8'))
+                return
+            status('Classifying {:}'.format(request['query']))
+            try:
+                result = classify_sigfile(request['query'], self.server.dblist,
+                                          self.server.ksize, self.server.scaled,
+                                          request.get('threshold', DEFAULT_THRESHOLD))
+            except Exception as e:
+                self.wfile.write('ERROR: {:}\n'.format(e).encode('utf-8'))
+                return
+            self.wfile.write(result.encode('utf-8'))
+        else:
+            self.wfile.write(b'ERROR: unknown request\n')
+
+class LCAServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def send_request(socket_path, request):
+    '''
+    send a JSON request to a running service, yields response lines
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    try:
+        client.sendall((json.dumps(request)+'\n').encode('utf-8'))
+        with client.makefile('r') as response:
+            for line in response:
+                if line.startswith('ERROR:'):
+                    raise RuntimeError(line.strip())
+                yield line
+    finally:
+        client.close()
+
+def classify_remote(socket_path, sigfile, threshold=DEFAULT_THRESHOLD):
+    return send_request(socket_path, {'query': os.path.abspath(sigfile),
+                                      'threshold': threshold})
+
+def service_running(socket_path):
+    if not socket_path or not os.path.exists(socket_path):
+        return False
+    try:
+        return list(send_request(socket_path, {'command': 'ping'})) == ['OK\n']
+    except (OSError, RuntimeError):
+        return False
+
+def run(parser, args):
+    if not args.socket:
+        args.socket = default_socket()
+    if args.shutdown:
+        if service_running(args.socket):
+            list(send_request(args.socket, {'command': 'shutdown'}))
+            status('Stopped LCA classification service on {:}'.format(args.socket))
+        else:
+            status('No LCA classification service running on {:}'.format(args.socket))
+        return
+    if service_running(args.socket):
+        status('LCA classification service already running on {:}'.format(args.socket))
+        return
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    SOUR = find_sourdb(args)
+    if not os.path.isfile(SOUR):
+        status("{:} sourmash database not found".format(SOUR))
+        sys.exit(1)
+    status('Loading sourmash LCA database {:}'.format(SOUR))
+    dblist, ksize, scaled = load_database(SOUR)
+    server = LCAServer(args.socket, LCAHandler)
+    server.dblist = dblist
+    server.ksize = ksize
+    server.scaled = scaled
+    server.stopping = False
+    server.timeout = 1
+    status('LCA classification service (k={:}, scaled={:}) listening on {:}'.format(
+        ksize, scaled, args.socket))
+    try:
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,140 @@
+# checkpoint manifest for pipeline resume
+# for every finished stage the manifest records the hashes of its input
+# files, its parameters, the versions of the tools it runs and the hashes
+# of its outputs. A stage is only skipped when all of these still match,
+# so truncated or stale outputs are rebuilt and changing an option reruns
+# that stage and, through the changed outputs, everything downstream.
+
+import os
+import re
+import json
+import subprocess
+from functools import lru_cache
+from AAFTF.utility import file_checksum
+from AAFTF.utility import which_path
+from AAFTF.version import __version__
+
+VERSION_RE = re.compile(r'[Vv]ersion:?\s*v?(\d[\w.\-]*)')
+
+@lru_cache(maxsize=None)
+def probe_version(tool, path, mtime):
+    '''
+    version string reported by a tool, run once per session for each
+    path and mtime however many samples and manifests ask for it
+    '''
+    version = None
+    for flag in [['--version'], ['-v'], []]:
+        try:
+            # no stdin, tools run bare would otherwise wait on the terminal
+            p = subprocess.run([tool] + flag, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, universal_newlines=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        m = VERSION_RE.search(p.stdout)
+        if m:
+            version = m.group(1)
+            break
+        lines = [x.strip() for x in p.stdout.splitlines() if re.search(r'\d', x)]
+        if p.returncode == 0 and lines:
+            version = lines[0]
+            break
+    return version
+
+class Manifest(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {'files': {}, 'tools': {}, 'tasks': {}}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as infile:
+                self.data.update(json.load(infile))
+
+    def file_hash(self, filename):
+        '''
+        sha256 of a file, only recomputed when its size or mtime changes
+        '''
+        if not os.path.isfile(filename):
+            return None
+        st = os.stat(filename)
+        key = os.path.abspath(filename)
+        cached = self.data['files'].get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        checksum = file_checksum(filename)
+        self.data['files'][key] = [st.st_size, st.st_mtime, checksum]
+        return checksum
+
+    def tool_version(self, tool):
+        '''
+        version string reported by a tool, cached by path and mtime
+        '''
+        if tool == 'AAFTF':
+            return __version__
+        path = which_path(tool)
+        if not path:
+            return None
+        st = os.stat(path)
+        cached = self.data['tools'].get(path)
+        if cached and cached[0] == st.st_mtime:
+            return cached[1]
+        version = probe_version(tool, path, st.st_mtime)
+        self.data['tools'][path] = [st.st_mtime, version]
+        return version
+
+    def signature(self, task):
+        return {'inputs': {x: self.file_hash(x) for x in task.inputs},
+                'params': json.loads(json.dumps(task.params, sort_keys=True)),
+                'tools': {x: self.tool_version(x) for x in ['AAFTF'] + task.tools}}
+
+    def valid(self, task):
+        '''
+        True if task outputs are recorded and nothing it depends on changed
+        '''
+        if not task.outputs:
+            return False
+        entry = self.data['tasks'].get(task.key)
+        if not entry:
+            return False
+        for x in task.outputs:
+            if entry['outputs'].get(x) is None or self.file_hash(x) != entry['outputs'][x]:
+                return False
+        sig = self.signature(task)
+        return all(entry.get(k) == sig[k] for k in ['inputs', 'params', 'tools'])
+
+    def changes(self, task):
+        '''
+        description of why a recorded task is out of date
+        '''
+        entry = self.data['tasks'].get(task.key)
+        if not entry:
+            return 'not in manifest'
+        sig = self.signature(task)
+        reasons = []
+        for x in task.outputs:
+            if self.file_hash(x) != entry['outputs'].get(x):
+                reasons.append('output {:} changed'.format(x))
+        for x, h in sig['inputs'].items():
+            if entry['inputs'].get(x) != h:
+                reasons.append('input {:} changed'.format(x))
+        for k, v in sig['params'].items():
+            if entry['params'].get(k) != v:
+                reasons.append('{:} changed'.format(k))
+        for k, v in sig['tools'].items():
+            if entry['tools'].get(k) != v:
+                reasons.append('{:} version changed'.format(k))
+        return ', '.join(reasons) or 'changed'
+
+    def record(self, task):
+        entry = self.signature(task)
+        entry['outputs'] = {x: self.file_hash(x) for x in task.outputs}
+        self.data['tasks'][task.key] = entry
+        self.save()
+
+    def forget(self, task):
+        if self.data['tasks'].pop(task.key, None):
+            self.save()
+
+    def save(self):
+        tmp = self.filename+'.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump(self.data, outfile, indent=2, sort_keys=True)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,220 @@
+# Prometheus metrics of a running pipeline
+# the scheduler marks stages as they start and finish, the stages record
+# the reads and contigs going in and out, and a background thread samples
+# the processes each running stage started. The metrics are written in the
+# Prometheus text format to a node-exporter textfile and/or served over
+# HTTP, so stalled assemblies or searches show up on dashboards. When no
+# metrics are active the record functions do nothing.
+
+import os
+import time
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from AAFTF.utility import status
+from AAFTF.utility import emit
+from AAFTF.utility import thread_children
+from AAFTF.utility import stage_processes
+from AAFTF.utility import process_tree
+from AAFTF.utility import process_usage
+
+METRICS = [('aaftf_run_start_timestamp_seconds', 'gauge', 'Time the run started'),
+           ('aaftf_last_update_timestamp_seconds', 'gauge', 'Time the metrics were last refreshed'),
+           ('aaftf_stage_running', 'gauge', 'Stage is running (1) or not (0)'),
+           ('aaftf_stage_success', 'gauge', 'Finished stage succeeded (1) or failed (0)'),
+           ('aaftf_stage_duration_seconds', 'gauge', 'Wall time of the stage so far or in total'),
+           ('aaftf_reads', 'gauge', 'Reads going into and out of a stage'),
+           ('aaftf_contigs', 'gauge', 'Contigs kept and removed by a stage'),
+           ('aaftf_child_rss_bytes', 'gauge', 'Resident memory of the processes a running stage started'),
+           ('aaftf_child_cpu_seconds', 'gauge', 'Cpu time of the processes a running stage started')]
+
+# the metrics of this run and the labels of the stage running in this
+# thread, handed on to its own worker threads by submit_in_context
+_active = None
+_stage = contextvars.ContextVar('metrics_stage', default=None)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def record(name, value, **labels):
+    '''
+    set metric name for the stage running in this thread, the value is
+    also written to the event log
+    '''
+    emit('count', metric=name, value=value, **labels)
+    metrics = _active
+    stage = _stage.get()
+    if metrics is None or stage is None:
+        return
+    values = dict(stage)
+    values.update(labels)
+    metrics.set(name, value, **values)
+
+def record_reads(direction, count):
+    record('aaftf_reads', count, direction=direction)
+
+def record_contigs(kind, count):
+    record('aaftf_contigs', count, kind=kind)
+
+class Metrics(object):
+    def __init__(self, textfile=None, listen=None, interval=10.0, labels={}):
+        '''
+        textfile is written atomically every interval, listen is a port or
+        host:port to serve /metrics on. labels are added to every metric
+        '''
+        self.textfile = textfile
+        self.interval = interval
+        self.labels = dict(labels)
+        self.values = {}
+        self.running = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.server = None
+        self.set('aaftf_run_start_timestamp_seconds', time.time())
+        if listen:
+            host, port = '127.0.0.1', listen
+            if ':' in str(listen):
+                host, port = str(listen).rsplit(':', 1)
+            self.server = ThreadingHTTPServer((host, int(port)), self.handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            status('Serving metrics on http://{:}:{:}/metrics'.format(host, self.server.server_address[1]))
+        self._done = threading.Event()
+        self.thread = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.thread.start()
+
+    def handler(self):
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def set(self, name, value, **labels):
+        values = dict(self.labels)
+        values.update({k: v for k, v in labels.items() if v is not None})
+        key = (name, tuple(sorted(values.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def start_stage(self, stage, sample=None):
+        '''
+        called in the thread running the stage
+        '''
+        labels = {'stage': stage, 'sample': sample}
+        _stage.set(labels)
+        with self.lock:
+            self.running[(stage, sample)] = (time.time(), threading.get_native_id())
+        self.set('aaftf_stage_running', 1, **labels)
+        self.set('aaftf_stage_duration_seconds', 0, **labels)
+        self.write()
+
+    def end_stage(self, stage, sample=None, success=True):
+        labels = {'stage': stage, 'sample': sample}
+        with self.lock:
+            start, tid = self.running.pop((stage, sample))
+        self.set('aaftf_stage_running', 0, **labels)
+        self.set('aaftf_stage_success', int(success), **labels)
+        self.set('aaftf_stage_duration_seconds', round(time.time() - start, 1), **labels)
+        self.set('aaftf_child_rss_bytes', 0, **labels)
+        _stage.set(None)
+        self.write()
+
+    def refresh(self):
+        with self.lock:
+            running = dict(self.running)
+        for (stage, sample), (start, tid) in running.items():
+            rss, cpu = 0, 0
+            # the stage thread's children and what its worker threads started
+            roots = set(thread_children(tid))
+            roots.update(stage_processes(sample, stage))
+            if roots:
+                for p in set(process_tree(sorted(roots))):
+                    r, c = process_usage(p)
+                    rss += r
+                    cpu += c
+            labels = {'stage': stage, 'sample': sample}
+            self.set('aaftf_stage_duration_seconds', round(time.time() - start, 1), **labels)
+            self.set('aaftf_child_rss_bytes', rss, **labels)
+            self.set('aaftf_child_cpu_seconds', round(cpu, 2), **labels)
+        self.set('aaftf_last_update_timestamp_seconds', time.time())
+
+    def refresh_loop(self):
+        while not self._done.wait(self.interval):
+            try:
+                self.refresh()
+                self.write()
+            except (IOError, OSError) as e:
+                status('Unable to update metrics: {:}'.format(e))
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name, kind, help in METRICS:
+            series = sorted([(k[1], v) for k, v in values.items() if k[0] == name])
+            if not series:
+                continue
+            lines.append('# HELP {:} {:}'.format(name, help))
+            lines.append('# TYPE {:} {:}'.format(name, kind))
+            for labels, value in series:
+                if labels:
+                    lines.append('{:}{{{:}}} {:}'.format(name, ','.join(
+                            ['{:}="{:}"'.format(k, escape(v)) for k, v in labels]), value))
+                else:
+                    lines.append('{:} {:}'.format(name, value))
+        return '\n'.join(lines)+'\n'
+
+    def write(self):
+        '''
+        textfile collectors may read at any time, so write and rename,
+        one writer at a time as every stage thread writes to the same file
+        '''
+        if not self.textfile:
+            return
+        tmp = '{:}.{:}.tmp'.format(self.textfile, os.getpid())
+        with self.write_lock:
+            with open(tmp, 'w') as outfile:
+                outfile.write(self.render())
+            os.replace(tmp, self.textfile)
+
+    def close(self):
+        self._done.set()
+        self.thread.join()
+        self.refresh()
+        self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def start(args, labels={}):
+    '''
+    activate metrics from --metrics_textfile/--metrics_listen, None if
+    neither is given
+    '''
+    global _active
+    textfile = getattr(args, 'metrics_textfile', None)
+    listen = getattr(args, 'metrics_listen', None)
+    if not textfile and not listen:
+        return None
+    _active = Metrics(textfile=textfile, listen=listen,
+                      interval=getattr(args, 'metrics_interval', None) or 10.0, labels=labels)
+    return _active
+
+def stop():
+    global _active
+    if _active:
+        _active.close()
+    _active = None
@@ -1,11 +1,322 @@
 import sys
 import os
+import time
+import hashlib
 import shutil
 import subprocess
-from AAFTF.utility import line_count
 from AAFTF.utility import status
+from AAFTF.utility import run_traced
+from AAFTF.utility import TracedPopen
 from AAFTF.utility import printCMD
 from AAFTF.utility import SafeRemove
+from AAFTF.utility import fastastats
+from AAFTF.utility import softwrap
+from AAFTF.utility import execute
+from AAFTF.utility import getMemAvailable
+from AAFTF.utility import zopen
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+import AAFTF.aligncache as aligncache
+
+def parse_changes(changesfile):
+    '''
+    parse Pilon .changes file, lines look like
+    contig:100-101 contig_pilon:100 AC .
+    returns list of (input location, output location, ref, alt)
+    '''
+    changes = []
+    if not os.path.isfile(changesfile):
+        return changes
+    with open(changesfile, 'r') as infile:
+        for line in infile:
+            cols = line.split()
+            if len(cols) < 4:
+                continue
+            changes.append((cols[0], cols[1], cols[2], cols[3]))
+    return changes
+
+def change_stats(changes):
+    snps, insertions, deletions, other = (0,)*4
+    for x in changes:
+        if x[2] == '.':
+            insertions += 1
+        elif x[3] == '.':
+            deletions += 1
+        elif len(x[2]) == 1 and len(x[3]) == 1:
+            snps += 1
+        else:
+            other += 1
+    return snps, insertions, deletions, other
+
+def oscillating(previous, current):
+    '''
+    True if this iteration just reverts the changes of the previous one,
+    output locations of previous are input locations of current
+    '''
+    if not previous or len(previous) != len(current):
+        return False
+    reverted = set([(x[1], x[3], x[2]) for x in previous])
+    return set([(x[0], x[2], x[3]) for x in current]) == reverted
+
+def align_reads(args, reference, reads, bam, bamthreads):
+    '''
+    align reads to reference in workdir, writes sorted and indexed bam
+    returns the seconds spent indexing and aligning
+    '''
+    DEVNULL = open(os.devnull, 'w')
+    start = time.time()
+    reads = [x for x in reads if x]
+    if getattr(args, 'aligner', 'bwa') == 'minimap2':
+        #minimap2 builds its index in memory as it goes
+        align_cmd = ['minimap2', '-ax', 'sr', '-t', str(args.cpus), reference] + reads
+    else:
+        bwa_index = ['bwa', 'index', reference]
+        printCMD(bwa_index)
+        run_traced(bwa_index, cwd=args.workdir, stderr=DEVNULL)
+        align_cmd = ['bwa', 'mem', '-t', str(args.cpus), reference] + reads
+
+    #run aligner and pipe to samtools sort
+    printCMD(align_cmd)
+    p1 = TracedPopen(align_cmd, cwd=args.workdir, 
+                     stdout=subprocess.PIPE, stderr=DEVNULL)
+    p2 = TracedPopen(['samtools', 'sort', 
+                      '-@', str(bamthreads),'-o', bam, '-'], 
+                     cwd=args.workdir, stdout=subprocess.PIPE, 
+                     stderr=DEVNULL, stdin=p1.stdout)
+    p1.stdout.close()
+    p2.communicate()
+    p1.wait()
+
+    #BAM file needs to be indexed for Pilon
+    run_traced(['samtools', 'index', bam], cwd=args.workdir)
+    elapsed = time.time() - start
+    status('{:} alignment took {:.1f} seconds'.format(getattr(args, 'aligner', 'bwa'), elapsed))
+    return elapsed
+
+def balance_contigs(fasta, shards):
+    '''
+    split contigs into groups of similar total length, longest first
+    into whichever group is currently smallest
+    '''
+    lengths = []
+    with open(fasta, 'r') as infile:
+        for Header, Seq in SimpleFastaParser(infile):
+            lengths.append((len(Seq), Header.split()[0]))
+    groups = [[] for x in range(min(shards, len(lengths)))]
+    totals = [0] * len(groups)
+    for length, name in sorted(lengths, key=lambda x: (-x[0], x[1])):
+        smallest = totals.index(min(totals))
+        groups[smallest].append(name)
+        totals[smallest] += length
+    return groups
+
+def pilon_heap(args, jobs):
+    '''
+    java heap in GB for each of jobs concurrent pilon processes
+    '''
+    if args.memory:
+        total = float(args.memory)
+    else:
+        total = 0.8 * getMemAvailable()
+    return max(1, int(total / jobs))
+
+def run_pilon(args, genome, bam, output):
+    shards = getattr(args, 'shards', 1)
+    if shards > 1:
+        groups = balance_contigs(os.path.join(args.workdir, genome), shards)
+    else:
+        groups = []
+    if len(groups) < 2:
+        pilon_cmd = ['pilon', '-Xmx{:}g'.format(pilon_heap(args, 1)),
+                     '--genome', genome, 
+                     '--frags', bam, 
+                     '--output', output, 
+                     '--threads', str(args.cpus), 
+                     '--changes']
+        printCMD(pilon_cmd)
+        with open(os.path.join(args.workdir, output+'.log'), 'w') as logfile:
+            p = run_traced(pilon_cmd, cwd=args.workdir, stderr=logfile, 
+                           stdout=logfile)
+        if p.returncode:
+            status('Pilon failed, see {:}'.format(os.path.join(args.workdir, output+'.log')))
+            sys.exit(1)
+        return
+
+    #run a pilon process on each group of contigs at the same time
+    heap = pilon_heap(args, len(groups))
+    threads = max(1, args.cpus // len(groups))
+    status('Running Pilon on {:} shards with {:}g heap and {:} threads each'.format(len(groups), heap, threads))
+    procs = []
+    for n, group in enumerate(groups):
+        shard = '{:}.shard{:}'.format(output, n+1)
+        with open(os.path.join(args.workdir, shard+'.targets'), 'w') as targets:
+            targets.write('{:}\n'.format('\n'.join(group)))
+        pilon_cmd = ['pilon', '-Xmx{:}g'.format(heap),
+                     '--genome', genome, 
+                     '--frags', bam, 
+                     '--targets', shard+'.targets',
+                     '--output', shard, 
+                     '--threads', str(threads), 
+                     '--changes']
+        printCMD(pilon_cmd)
+        logfile = open(os.path.join(args.workdir, shard+'.log'), 'w')
+        procs.append((TracedPopen(pilon_cmd, cwd=args.workdir, stderr=logfile,
+                                  stdout=logfile), logfile))
+    for p, logfile in procs:
+        p.wait()
+        logfile.close()
+
+    #a failed shard fails the run, the same as a single Pilon process
+    failed = False
+    for n, group in enumerate(groups):
+        shard = os.path.join(args.workdir, '{:}.shard{:}'.format(output, n+1))
+        if procs[n][0].returncode or not os.path.isfile(shard+'.fasta'):
+            status('Pilon shard {:} failed, see {:}.log'.format(n+1, shard))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+    #merge the shards back in the original contig order
+    Polished = {}
+    for n, group in enumerate(groups):
+        shard = os.path.join(args.workdir, '{:}.shard{:}'.format(output, n+1))
+        keep = set(group)
+        with open(shard+'.fasta', 'r') as infile:
+            for Header, Seq in SimpleFastaParser(infile):
+                name = Header.split()[0]
+                if name.endswith('_pilon') and name[:-6] in keep:
+                    Polished[name[:-6]] = (name, Seq)
+                elif name in keep:
+                    Polished[name] = (name, Seq)
+    missing = 0
+    with open(os.path.join(args.workdir, genome), 'r') as infile:
+        with open(os.path.join(args.workdir, output+'.fasta'), 'w') as outfile:
+            for Header, Seq in SimpleFastaParser(infile):
+                contig = Header.split()[0]
+                if contig in Polished:
+                    contig, Seq = Polished[contig]
+                else:
+                    missing += 1
+                outfile.write('>{:}\n{:}\n'.format(contig, softwrap(Seq)))
+    if missing:
+        status('Pilon shards did not return {:,} contigs, these are unpolished in {:}.fasta'.format(missing, output))
+    with open(os.path.join(args.workdir, output+'.changes'), 'w') as outfile:
+        for n in range(len(groups)):
+            changes = os.path.join(args.workdir, '{:}.shard{:}.changes'.format(output, n+1))
+            if os.path.isfile(changes):
+                with open(changes, 'r') as infile:
+                    shutil.copyfileobj(infile, outfile)
+
+def write_subset(fasta, names, output):
+    with open(output, 'w') as outfile:
+        with open(fasta, 'r') as infile:
+            for Header, Seq in SimpleFastaParser(infile):
+                if Header.split()[0] in names:
+                    outfile.write('>{:}\n{:}\n'.format(Header.split()[0], softwrap(Seq)))
+
+def extract_reads(args, bam, contigs, prefix, paired, bamthreads):
+    '''
+    pull reads aligned to contigs out of bam as FASTQ, returns list of files
+    '''
+    DEVNULL = open(os.devnull, 'w')
+    bed = prefix+'.reads.bed'
+    with open(os.path.join(args.workdir, bed), 'w') as bedout:
+        for line in execute(['samtools', 'idxstats', bam], args.workdir):
+            cols = line.split('\t')
+            if cols[0] in contigs:
+                bedout.write('{:}\t0\t{:}\n'.format(cols[0], cols[1]))
+    view_cmd = ['samtools', 'view', '-u', '-F', '0x900', '-L', bed, bam]
+    collate_cmd = ['samtools', 'collate', '-u', '-O', '-@', str(bamthreads), '-', prefix+'.collate']
+    if paired:
+        reads = [prefix+'_R1.fastq', prefix+'_R2.fastq']
+        fastq_cmd = ['samtools', 'fastq', '-1', reads[0], '-2', reads[1],
+                     '-0', '/dev/null', '-s', '/dev/null', '-']
+    else:
+        reads = [prefix+'_R1.fastq']
+        fastq_cmd = ['samtools', 'fastq', '-0', reads[0], '-']
+    printCMD(view_cmd)
+    p1 = TracedPopen(view_cmd, cwd=args.workdir, stdout=subprocess.PIPE, stderr=DEVNULL)
+    p2 = TracedPopen(collate_cmd, cwd=args.workdir, stdin=p1.stdout,
+                     stdout=subprocess.PIPE, stderr=DEVNULL)
+    p3 = TracedPopen(fastq_cmd, cwd=args.workdir, stdin=p2.stdout,
+                     stdout=DEVNULL, stderr=DEVNULL)
+    p1.stdout.close()
+    p2.stdout.close()
+    p3.communicate()
+    p2.wait()
+    p1.wait()
+    return reads
+
+def merge_polished(fasta, polished, output, changes, mergedchanges):
+    '''
+    replace the contigs in fasta with their polished versions, names are
+    kept as they are in fasta and the changes file is rewritten to match
+    '''
+    Polished = {}
+    with open(polished, 'r') as infile:
+        for Header, Seq in SimpleFastaParser(infile):
+            name = Header.split()[0]
+            if name.endswith('_pilon'):
+                name = name[:-6]
+            Polished[name] = Seq
+    with open(output, 'w') as outfile:
+        with open(fasta, 'r') as infile:
+            for Header, Seq in SimpleFastaParser(infile):
+                name = Header.split()[0]
+                if name in Polished:
+                    Seq = Polished[name]
+                outfile.write('>{:}\n{:}\n'.format(name, softwrap(Seq)))
+    with open(mergedchanges, 'w') as outfile:
+        for x in parse_changes(changes):
+            contig, loc = x[1].rsplit(':', 1)
+            if contig.endswith('_pilon'):
+                contig = contig[:-6]
+            outfile.write('{:} {:}:{:} {:} {:}\n'.format(x[0], contig, loc, x[2], x[3]))
+
+def fastq_records(handle):
+    while True:
+        record = [handle.readline() for x in range(4)]
+        if not record[0]:
+            break
+        yield record
+
+def subsample_reads(args, reads, assemblySize):
+    '''
+    keep read pairs by a hash of the seed and read name so the subset is
+    the same every run, returns list of reads to align as absolute paths
+    since the aligner runs inside workdir
+    '''
+    bases = 0
+    for x in reads:
+        handle = zopen(x, 'rb')
+        for record in fastq_records(handle):
+            bases += len(record[1].rstrip())
+        handle.close()
+    coverage = bases / float(assemblySize)
+    if coverage <= args.max_coverage:
+        status('Estimated read coverage is {:.1f}X, not subsampling reads'.format(coverage))
+        return reads
+    fraction = args.max_coverage / coverage
+    threshold = int(fraction * 2**32)
+    seed = str(args.seed).encode('utf-8')
+    subset = ['pilon_subsample_R{:}.fastq'.format(n+1) for n in range(len(reads))]
+    handles = [zopen(x, 'rb') for x in reads]
+    outfiles = [open(os.path.join(args.workdir, x), 'wb') for x in subset]
+    total, kept = 0, 0
+    for records in zip(*[fastq_records(x) for x in handles]):
+        total += 1
+        name = records[0][0].split()[0]
+        if name.endswith(b'/1') or name.endswith(b'/2'):
+            name = name[:-2]
+        digest = hashlib.blake2b(name, digest_size=4, key=seed).digest()
+        if int.from_bytes(digest, 'big') < threshold:
+            kept += 1
+            for outfile, record in zip(outfiles, records):
+                outfile.writelines(record)
+    for x in handles + outfiles:
+        x.close()
+    status('Subsampled {:,} of {:,} reads from {:.1f}X to ~{:}X coverage for polishing'.format(
+            kept, total, coverage, args.max_coverage))
+    return [os.path.abspath(os.path.join(args.workdir, x)) for x in subset]
 
 def run(parser,args):
     
@@ -31,7 +342,18 @@ def run(parser,args):
     if args.cpus < 4:
         bamthreads = args.cpus
 
-    DEVNULL = open(os.devnull, 'w')
+    #align a fixed subset of reads every iteration if coverage is excessive
+    if args.max_coverage:
+        numSeqs, assemblySize = fastastats(args.infile)
+        reads = subsample_reads(args, [x for x in [forReads, revReads] if x], assemblySize)
+        forReads = reads[0]
+        if len(reads) > 1:
+            revReads = reads[1]
+
+    summary = []
+    previous = None
+    lastBAM = None
+    completed = 0
     for i in range(1, args.iterations+1):
         status('Starting Pilon polishing iteration {:}'.format(i))
         correctedFasta = 'pilon'+str(i)+'.fasta'
@@ -42,65 +364,93 @@ def run(parser,args):
                                          os.path.basename(args.infile)))
         else:
             initialFasta = os.path.join(args.workdir, 'pilon'+str(i-1)+'.fasta')
-                                        
         pilonBAM = os.path.basename(initialFasta)+'.bwa.bam'
-        if not os.path.isfile(os.path.join(args.workdir, pilonBAM)):
-            bwa_index = ['bwa', 'index', os.path.basename(initialFasta)]
-            printCMD(bwa_index)
-            subprocess.run(bwa_index, cwd=args.workdir, stderr=DEVNULL)
-            bwa_cmd = ['bwa', 'mem', '-t', str(args.cpus), os.path.basename(initialFasta), forReads]
-            if revReads:
-                bwa_cmd.append(revReads)
-    
-            #run BWA and pipe to samtools sort
-            printCMD(bwa_cmd)
-            p1 = subprocess.Popen(bwa_cmd, cwd=args.workdir, 
-                                  stdout=subprocess.PIPE, stderr=DEVNULL)
-            p2 = subprocess.Popen(['samtools', 'sort', 
-                                   '-@', str(bamthreads),'-o', pilonBAM, '-'], 
-                                  cwd=args.workdir, stdout=subprocess.PIPE, 
-                                  stderr=DEVNULL, stdin=p1.stdout)
-            p1.stdout.close()
-            p2.communicate()
-            
-            #BAM file needs to be indexed for Pilon
-            subprocess.run(['samtools', 'index', pilonBAM], cwd=args.workdir)
-        
-        #run Pilon
-        pilon_cmd = ['pilon', '--genome', os.path.basename(initialFasta), 
-                     '--frags', pilonBAM, 
-                     '--output', correctedFasta.split('.fasta')[0], 
-                     '--threads', str(args.cpus), 
-                     '--changes']
-        pilon_log = 'pilon'+str(i)+'.log'
-        printCMD(pilon_cmd)
-        with open(os.path.join(args.workdir, pilon_log), 'w') as logfile:
-            subprocess.run(pilon_cmd, cwd=args.workdir, stderr=logfile, 
-                           stdout=logfile)
-        num_changes = line_count(os.path.join(args.workdir, 'pilon'+str(i)+'.changes'))
-                                              
-        status('Found {:,} changes in Pilon iteration {:}'.format(num_changes, i))
+
+        if args.incremental and i > 1:
+            #only polish contigs changed in the last iteration, using the reads
+            #that aligned to them in the last iteration
+            if not previous:
+                status('No contigs changed in iteration {:}, nothing left to polish'.format(i-1))
+                break
+            readContigs = set([x[0].split(':')[0] for x in previous])
+            targets = set([x[1].split(':')[0] for x in previous])
+            status('Polishing {:,} contigs changed in iteration {:}'.format(len(targets), i-1))
+            targetFasta = 'pilon'+str(i)+'.subset.fasta'
+            write_subset(initialFasta, targets, os.path.join(args.workdir, targetFasta))
+            reads = extract_reads(args, lastBAM, readContigs, 'pilon'+str(i),
+                                  revReads is not None, bamthreads)
+            pilonBAM = targetFasta+'.bwa.bam'
+            align_time = align_reads(args, targetFasta, reads, pilonBAM, bamthreads)
+            run_pilon(args, targetFasta, pilonBAM, 'pilon'+str(i)+'.targets')
+            merge_polished(initialFasta,
+                           os.path.join(args.workdir, 'pilon'+str(i)+'.targets.fasta'),
+                           os.path.join(args.workdir, correctedFasta),
+                           os.path.join(args.workdir, 'pilon'+str(i)+'.targets.changes'),
+                           os.path.join(args.workdir, 'pilon'+str(i)+'.changes'))
+            dirty = [targetFasta+x for x in ['.sa', '.amb', '.ann', '.pac', '.bwt']] + reads
+        else:
+            if i == 1 and args.align_cache and not os.path.isfile(os.path.join(args.workdir, pilonBAM)):
+                #reuse alignments from sourpurge if the contigs are unchanged
+                aligncache.reuse(args.align_cache, [forReads, revReads], args.infile,
+                                 pilonBAM, args.workdir, bamthreads)
+            align_time = 0
+            if not os.path.isfile(os.path.join(args.workdir, pilonBAM)):
+                align_time = align_reads(args, os.path.basename(initialFasta), [forReads, revReads],
+                            pilonBAM, bamthreads)
+            run_pilon(args, os.path.basename(initialFasta), pilonBAM, 'pilon'+str(i))
+            dirty = [os.path.basename(initialFasta)+x for x in ['.sa', '.amb', '.ann', '.pac', '.bwt']]
+
+        changes = parse_changes(os.path.join(args.workdir, 'pilon'+str(i)+'.changes'))
+        num_changes = len(changes)
+        snps, insertions, deletions, other = change_stats(changes)
+        numSeqs, assemblySize = fastastats(os.path.join(args.workdir, correctedFasta))
+        per_mb = num_changes / (assemblySize / 1e6) if assemblySize else 0
+        status('Found {:,} changes in Pilon iteration {:} ({:.2f} per Mb)'.format(num_changes, i, per_mb))
+        summary.append([i, num_changes, snps, insertions, deletions, other,
+                        '{:.3f}'.format(per_mb), assemblySize,
+                        len(set([x[1].split(':')[0] for x in changes])),
+                        '{:.1f}'.format(align_time)])
+        completed = i
         
-        #clean-up as we iterate to prevent tmp directory from blowing up
-        dirty = [initialFasta+'.sa', initialFasta+'.amb', initialFasta+'.ann',
-                 initialFasta+'.pac', initialFasta+'.bwt', os.path.join(args.workdir, pilonBAM), 
-                 os.path.join(args.workdir, pilonBAM+'.bai')]
+        #clean-up as we iterate to prevent tmp directory from blowing up,
+        #incremental mode needs the last alignments to pick reads for the next round
+        if args.incremental:
+            if i > 1:
+                dirty += [lastBAM, lastBAM+'.bai']
+            lastBAM = pilonBAM
+        else:
+            dirty += [pilonBAM, pilonBAM+'.bai']
         for f in dirty:
-            if i == 1:
-                if os.path.isfile(os.path.join(args.workdir, f)):
-                    os.remove(os.path.join(args.workdir, f))
-            else:
-                if os.path.isfile(f):
-                    os.remove(f)
+            if os.path.isfile(os.path.join(args.workdir, f)):
+                os.remove(os.path.join(args.workdir, f))
+
+        #stop early once polishing has converged
+        if args.converge:
+            if num_changes <= args.min_changes:
+                status('Pilon converged: {:,} changes <= {:,}'.format(num_changes, args.min_changes))
+                break
+            if args.max_changes_per_mb is not None and per_mb <= args.max_changes_per_mb:
+                status('Pilon converged: {:.2f} changes per Mb <= {:}'.format(per_mb, args.max_changes_per_mb))
+                break
+            if oscillating(previous, changes):
+                status('Pilon converged: iteration {:} reverted the changes of iteration {:}'.format(i, i-1))
+                break
+        previous = changes
     
     #copy last iteration to output
     if args.outfile:
         polishedFasta = args.outfile
     else:
         polishedFasta = os.path.basename(args.infile).split('.f')[0]+'.pilon.fasta'
-    shutil.copyfile(os.path.join(args.workdir, 'pilon'+str(args.iterations)+'.fasta'), polishedFasta)
-                                 
-    status('AAFTF pilon completed {:} iterations.'.format(args.iterations))
+    shutil.copyfile(os.path.join(args.workdir, 'pilon'+str(completed)+'.fasta'), polishedFasta)
+    summaryFile = polishedFasta.rsplit('.f', 1)[0]+'.pilon-summary.tsv'
+    with open(summaryFile, 'w') as outfile:
+        outfile.write('iteration\tchanges\tsnps\tinsertions\tdeletions\tother\tchanges_per_Mb\tassembly_bp\tcontigs_changed\talign_seconds\n')
+        for x in summary:
+            outfile.write('{:}\n'.format('\t'.join([str(y) for y in x])))
+
+    status('AAFTF pilon completed {:} iterations.'.format(completed))
+    status('Pilon change summary: {:}'.format(summaryFile))
     status('Pilon polished assembly: {:}'.format(polishedFasta))
     if '_' in polishedFasta:
         nextOut = polishedFasta.split('_')[0]+'.final.fasta'
@@ -1,51 +1,143 @@
 import sys
 import os
-import shutil
-import subprocess
-from argparse import Namespace 
+import glob
+import itertools
+from argparse import Namespace
+from functools import partial
 from AAFTF.utility import status
-from AAFTF.utility import printCMD
 from AAFTF.utility import getRAM
 from AAFTF.utility import checkfile
-import AAFTF.trim as trim
-import AAFTF.filter as aaftf_filter
-import AAFTF.assemble as assemble
-import AAFTF.vecscreen as vecscreen
-import AAFTF.sourpurge as sourpurge
-import AAFTF.rmdup as rmdup
-import AAFTF.pilon as pilon
-import AAFTF.sort as aaftf_sort
-import AAFTF.assess as assess
+from AAFTF.utility import SafeRemove
+from AAFTF.scheduler import Scheduler
+from AAFTF.scheduler import Task
+from AAFTF.manifest import Manifest
+from AAFTF.runprofile import RunProfile
+import AAFTF.metrics as metrics
+# the stage modules are imported by the tasks that run them, so the
+# pipeline starts without loading Biopython and every stage up front
 
-def run(parser,args):
-    #script to run entire AAFTF pipeline
+# parameters of the stages after vecscreen that a sweep can vary, each
+# stage is tagged with the branch values of its own and upstream parameters
+BRANCH_PARAMS = [('sourpurge', ['mincovpct']),
+                 ('rmdup', ['mincontiglen', 'percent_id', 'percent_cov']),
+                 ('pilon', ['iterations'])]
+
+def branch_tags(branch):
+    '''
+    output tag of each downstream stage for a dictionary of branch
+    values, empty when nothing upstream of the stage is varied
+    '''
+    tags = {}
+    parts = []
+    for stage, keys in BRANCH_PARAMS:
+        parts.extend(['{:}{:}'.format(k, branch[k]) for k in keys if k in branch])
+        tags[stage] = '.'.join(parts)
+    return tags
+
+# options --grid can sweep and their types
+SWEEP_OPTIONS = {'mincovpct': int, 'mincontiglen': int, 'percent_id': int,
+                 'percent_cov': int, 'iterations': int}
+
+SWEEP_STATS = ['contigs', 'total_length', 'min', 'max', 'median', 'mean', 'L50', 'N50', 'L90', 'N90']
+
+def parse_grid(grid):
+    '''
+    option=value,value,... strings to list of (option, values) in the
+    order of the downstream stages
+    '''
+    values = {}
+    for x in grid:
+        if not '=' in x:
+            status('Grid {:} is not of the form option=value,value'.format(x))
+            sys.exit(1)
+        key, vals = x.split('=', 1)
+        key = key.strip().lstrip('-')
+        if not key in SWEEP_OPTIONS:
+            status('Unable to sweep {:}, choose from {:}'.format(key, ', '.join(sorted(SWEEP_OPTIONS))))
+            sys.exit(1)
+        try:
+            values[key] = [SWEEP_OPTIONS[key](v) for v in vals.split(',') if v.strip()]
+        except ValueError:
+            status('Grid values for {:} must be numbers: {:}'.format(key, vals))
+            sys.exit(1)
+    order = [k for stage, keys in BRANCH_PARAMS for k in keys]
+    return [(k, values[k]) for k in order if k in values]
+
+def grid_branches(grid):
+    keys = [k for k, v in grid]
+    return [dict(zip(keys, combo)) for combo in itertools.product(*[v for k, v in grid])]
+
+def write_sweep(filename, grid, branches, results):
+    '''
+    table of the assembly stats of every branch
+    '''
+    keys = [k for k, v in grid]
+    with open(filename, 'w') as outfile:
+        outfile.write('\t'.join(['branch'] + keys + SWEEP_STATS)+'\n')
+        for branch in branches:
+            tag = branch_tags(branch)['pilon']
+            stats = results.get(tag) or {}
+            outfile.write('\t'.join([tag] + [str(branch[k]) for k in keys] +
+                                    [str(stats.get(x, '')) for x in SWEEP_STATS])+'\n')
+
+def stage_workdir(args, stage):
+    '''
+    stages running at the same time each get their own folder in workdir
+    '''
+    if args.workdir:
+        return os.path.join(args.workdir, stage)
+    return None
+
+def add_tasks(parser, args, dag, label=None, log=None, defaultMemory=None, branches=[{}]):
+    '''
+    add the pipeline stages of one sample to scheduler dag, task names are
+    prefixed with label and status messages copied to log. defaultMemory
+    (GB) replaces 75% of system memory when --memory is not given. Each
+    dictionary in branches overrides options of the stages after vecscreen,
+    returns dictionary of branch tag: assembly stats filled in as the
+    assess stages finish
+    '''
     args_dict = vars(args)
     basename = args_dict['basename']
-    RAM = round(0.75*getRAM())
+    totalRAM = getRAM()
+    RAM = defaultMemory or int(0.75*totalRAM)
+    userMemory = args.memory
     if not args.memory:
         args_dict['memory'] = str(RAM)
-    
+    if args.workdir and not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    memory = int(float(args_dict['memory']))
+
+    reads = [args.left] + ([args.right] if args.right else [])
+    trimmed = [basename+'_1P.fastq.gz'] + ([basename+'_2P.fastq.gz'] if args.right else [])
+    filtered = [basename+'_filtered_1.fastq.gz'] + ([basename+'_filtered_2.fastq.gz'] if args.right else [])
+    kmerJSON = basename+'.kmers.json'
+
     #run trimming with bbduk
-    if not checkfile(basename+'_1P.fastq.gz'):
+    def run_trim():
+        import AAFTF.trim as trim
         trimOpts = ['memory', 'left', 'right', 'basename', 'cpus', 'debug', 'minlength']
         trimDict = {k:v for (k,v) in args_dict.items() if k in trimOpts}
         trimDict['method'] = 'bbduk'
         trimDict['pipe'] = True
         trimargs = Namespace(**trimDict)
         trim.run(parser, trimargs)
-    else:
-    	if args.right:
-    		status('AAFTF trim output found: {:} {:}'.format(basename+'_1P.fastq.gz', basename+'_2P.fastq.gz'))
-    	else:
-    		status('AAFTF trim output found: {:}'.format(basename+'_1P.fastq.gz'))
-    if not checkfile(basename+'_1P.fastq.gz'):
-        status('AATFT trim failed')
-        sys.exit(1)
-        
+
+    #download contaminant sequences for filtering while trimming
+    filterOpts = ['screen_accessions', 'screen_urls', 'basename', 'cpus', 'debug', 'memory', 'AAFTF_DB',
+                  'accession_cache', 'accession_url', 'accession_batch', 'download_threads']
+    filterWorkdir = stage_workdir(args, 'filter')
+    def run_filter_db():
+        import AAFTF.filter as aaftf_filter
+        filterDict = {k:v for (k,v) in args_dict.items() if k in filterOpts}
+        filterDict['workdir'] = filterWorkdir or 'aaftf-filter_'+str(os.getpid())
+        aaftf_filter.prepare_contamdb(Namespace(**filterDict))
+
     #run filtering with bbduk
-    if not checkfile(basename+'_filtered_1.fastq.gz'):
-        filterOpts = ['screen_accessions', 'screen_urls', 'basename', 'cpus', 'debug', 'memory', 'AAFTF_DB', 'workdir']
+    def run_filter():
+        import AAFTF.filter as aaftf_filter
         filterDict = {k:v for (k,v) in args_dict.items() if k in filterOpts}
+        filterDict['workdir'] = filterWorkdir
         filterDict['aligner'] = 'bbduk'
         filterDict['left'] = basename+'_1P.fastq.gz'
         if args.right:
@@ -53,19 +145,36 @@ def run(parser,args):
         filterDict['pipe'] = True
         filterargs = Namespace(**filterDict)
         aaftf_filter.run(parser, filterargs)
-    else:
-    	if args.right:
-    		status('AAFTF filter output found: {:} {:}'.format(basename+'_filtered_1.fastq.gz', basename+'_filtered_2.fastq.gz'))
-    	else:
-    		status('AAFTF filter output found: {:}'.format(basename+'_filtered_1.fastq.gz'))
-    if not checkfile(basename+'_filtered_1.fastq.gz'):
-        status('AATFT filter failed')
-        sys.exit(1)
-        
+
+    #size assembly and coverage cutoffs from the read k-mer spectrum
+    def run_kmers():
+        import AAFTF.kmers as kmers
+        kmerDict = {'left': basename+'_filtered_1.fastq.gz', 'right': None,
+                    'kmer': 21, 'sample': 16, 'max_reads': None,
+                    'out': kmerJSON}
+        if args.right:
+            kmerDict['right'] = basename+'_filtered_2.fastq.gz'
+        kmers.run(parser, Namespace(**kmerDict))
+
+    def kmer_profile():
+        import AAFTF.kmers as kmers
+        if not args.no_kmer_profile and checkfile(kmerJSON):
+            return kmers.load_profile(kmerJSON)
+        return {}
+
     #run assembly with spades
-    if not checkfile(basename+'.spades.fasta'):
-        assembleOpts = ['memory', 'cpus', 'debug', 'workdir']
+    def run_assemble():
+        import AAFTF.assemble as assemble
+        kmerProfile = kmer_profile()
+        assembleOpts = ['memory', 'cpus', 'debug']
         assembleDict = {k:v for (k,v) in args_dict.items() if k in assembleOpts}
+        assembleDict['workdir'] = stage_workdir(args, 'assemble')
+        assembleDict['method'] = args.assembler
+        assembleDict['kmers'] = None
+        if kmerProfile.get('genome_size'):
+            if not userMemory:
+                assembleDict['memory'] = str(kmerProfile['spades_memory'])
+            assembleDict['kmers'] = ','.join([str(x) for x in kmerProfile['spades_kmers']])
         assembleDict['left'] = basename+'_filtered_1.fastq.gz'
         if args.right:
             assembleDict['right'] = basename+'_filtered_2.fastq.gz'
@@ -74,16 +183,21 @@ def run(parser,args):
         assembleDict['pipe'] = True
         assembleargs = Namespace(**assembleDict)
         assemble.run(parser, assembleargs)
-    else:
-    	status('AAFTF assemble output found: {:}'.format(basename+'.spades.fasta'))
-    if not checkfile(basename+'.spades.fasta'):
-        status('AATFT assemble failed')
-        sys.exit(1)
-        
+
+    #build the BLAST databases for vecscreen while assembling
+    vecOpts = ['cpus', 'debug', 'AAFTF_DB']
+    vecWorkdir = stage_workdir(args, 'vecscreen')
+    def run_vecscreen_db():
+        import AAFTF.vecscreen as vecscreen
+        vecDict = {k:v for (k,v) in args_dict.items() if k in vecOpts}
+        vecDict['workdir'] = vecWorkdir or 'aaftf-vecscreen_'+str(os.getpid())
+        vecscreen.prepare_blastdbs(Namespace(**vecDict))
+
     #run vecscreen
-    if not checkfile(basename+'.vecscreen.fasta'):
-        vecOpts = ['cpus', 'debug', 'workdir', 'AAFTF_DB']
+    def run_vecscreen():
+        import AAFTF.vecscreen as vecscreen
         vecDict = {k:v for (k,v) in args_dict.items() if k in vecOpts}
+        vecDict['workdir'] = vecWorkdir
         vecDict['percent_id'] = False
         vecDict['stringency'] = 'high'
         vecDict['infile'] = basename+'.spades.fasta'
@@ -91,83 +205,239 @@ def run(parser,args):
         vecDict['pipe'] = True
         vecargs = Namespace(**vecDict)
         vecscreen.run(parser, vecargs)
-    else:
-    	status('AAFTF vecscreen output found: {:}'.format(basename+'.vecscreen.fasta'))
-    if not checkfile(basename+'.vecscreen.fasta'):
-        status('AATFT vecscreen failed')
-        sys.exit(1)
-    
+
+    # sweep branches split the cpus and memory of the downstream stages
+    tagged = {}
+    for branch in branches:
+        tagged[branch_tags(branch)['pilon']] = branch
+    branches = list(tagged.values())
+    branchCpus = max(1, args.cpus // len(branches))
+    branchMemory = max(1, memory // len(branches))
+
+    def value(branch, key, default=None):
+        if key in branch:
+            return branch[key]
+        if args_dict.get(key) is None:
+            return default
+        return args_dict[key]
+
+    def branch_file(tag, suffix):
+        if tag:
+            return basename+'.'+tag+suffix
+        return basename+suffix
+
+    def branch_workdir(stage, tag):
+        if tag:
+            return stage_workdir(args, stage+'.'+tag)
+        return stage_workdir(args, stage)
+
     #run sourmash purge
-    if not checkfile(basename+'.sourpurge.fasta'):
-        sourOpts = ['cpus', 'debug', 'workdir', 'AAFTF_DB', 'phylum', 'sourdb', 'mincovpct']
+    def run_sourpurge(branch, tags):
+        import AAFTF.sourpurge as sourpurge
+        sourOpts = ['debug', 'AAFTF_DB', 'phylum', 'sourdb', 'sour_socket', 'taxcache', 'no_taxcache']
         sourDict = {k:v for (k,v) in args_dict.items() if k in sourOpts}
+        sourDict['cpus'] = branchCpus
+        sourDict['mincovpct'] = value(branch, 'mincovpct')
+        sourDict['workdir'] = branch_workdir('sourpurge', tags['sourpurge'])
         sourDict['left'] = basename+'_filtered_1.fastq.gz'
         if args.right:
             sourDict['right'] = basename+'_filtered_2.fastq.gz'
         sourDict['input'] = basename+'.vecscreen.fasta'
-        sourDict['outfile'] = basename+'.sourpurge.fasta'
+        sourDict['outfile'] = branch_file(tags['sourpurge'], '.sourpurge.fasta')
         sourDict['taxonomy'] = False
+        sourDict['write_bam'] = False
+        # alignments from sourpurge are reused by the first pilon iteration
+        sourDict['align_cache'] = branch_file(tags['sourpurge'], '.aligncache')
+        sourDict['expected_coverage'] = kmer_profile().get('coverage')
         sourDict['pipe'] = True
         sourargs = Namespace(**sourDict)
         sourpurge.run(parser, sourargs)
-    else:
-    	status('AAFTF sourpurge output found: {:}'.format(basename+'.sourpurge.fasta'))
-    if not checkfile(basename+'.sourpurge.fasta'):
-        status('AATFT sourpurge failed')
-        sys.exit(1)
 
     #run remove duplicates
-    if not checkfile(basename+'.rmdup.fasta'):
-        rmdupOpts = ['cpus', 'debug', 'workdir']
+    def run_rmdup(branch, tags):
+        import AAFTF.rmdup as rmdup
+        rmdupOpts = ['debug']
         rmdupDict = {k:v for (k,v) in args_dict.items() if k in rmdupOpts}
-        rmdupDict['input'] = basename+'.sourpurge.fasta'
-        rmdupDict['out'] = basename+'.rmdup.fasta'
-        rmdupDict['minlen'] = args_dict['mincontiglen']
-        rmdupDict['percent_id'] = 95
-        rmdupDict['percent_cov'] = 95
+        rmdupDict['cpus'] = branchCpus
+        rmdupDict['workdir'] = branch_workdir('rmdup', tags['rmdup'])
+        rmdupDict['input'] = branch_file(tags['sourpurge'], '.sourpurge.fasta')
+        rmdupDict['out'] = branch_file(tags['rmdup'], '.rmdup.fasta')
+        rmdupDict['minlen'] = value(branch, 'mincontiglen')
+        rmdupDict['percent_id'] = value(branch, 'percent_id', 95)
+        rmdupDict['percent_cov'] = value(branch, 'percent_cov', 95)
         rmdupDict['exhaustive'] = False
         rmdupDict['pipe'] = True
         rmdupargs = Namespace(**rmdupDict)
         rmdup.run(parser, rmdupargs)
-    else:
-    	status('AAFTF rmdup output found: {:}'.format(basename+'.rmdup.fasta'))
-    if not checkfile(basename+'.rmdup.fasta'):
-        status('AATFT rmdup failed')
-        sys.exit(1)
-            
+
     #run pilon to error-correct
-    if not checkfile(basename+'.pilon.fasta'):
-        pilonOpts = ['cpus', 'debug', 'workdir', 'iterations']
+    def run_pilon(branch, tags):
+        import AAFTF.pilon as pilon
+        pilonOpts = ['debug', 'converge', 'min_changes', 'max_changes_per_mb', 'incremental', 'shards', 'aligner', 'max_coverage', 'seed']
         pilonDict = {k:v for (k,v) in args_dict.items() if k in pilonOpts}
-        pilonDict['infile'] = basename+'.rmdup.fasta'
-        pilonDict['outfile'] = basename+'.pilon.fasta'
+        pilonDict['cpus'] = branchCpus
+        pilonDict['iterations'] = value(branch, 'iterations')
+        pilonDict['workdir'] = branch_workdir('pilon', tags['pilon'])
+        pilonDict['infile'] = branch_file(tags['rmdup'], '.rmdup.fasta')
+        pilonDict['outfile'] = branch_file(tags['pilon'], '.pilon.fasta')
         pilonDict['left'] = basename+'_filtered_1.fastq.gz'
         if args.right:
             pilonDict['right'] = basename+'_filtered_2.fastq.gz'
         pilonDict['pipe'] = True
+        pilonDict['align_cache'] = branch_file(tags['sourpurge'], '.aligncache')
+        if len(branches) > 1:
+            pilonDict['memory'] = branchMemory
+        else:
+            pilonDict['memory'] = userMemory or defaultMemory
         pilonargs = Namespace(**pilonDict)
         pilon.run(parser, pilonargs)
-    else:
-    	status('AAFTF pilon output found: {:}'.format(basename+'.pilon.fasta'))
-    if not checkfile(basename+'.pilon.fasta'):
-        status('AATFT pilon failed')
-        sys.exit(1)
-        
+        # other branches may still need the cached alignments
+        if not args.debug and len(branches) == 1:
+            SafeRemove(pilonDict['align_cache'])
+
     #sort and rename
-    if not checkfile(basename+'.final.fasta'):
-        sortDict = {'input': basename+'.pilon.fasta', 'out': basename+'.final.fasta', 'name': 'scaffold'}
+    def run_sort(branch, tags):
+        import AAFTF.sort as aaftf_sort
+        sortDict = {'input': branch_file(tags['pilon'], '.pilon.fasta'),
+                    'out': branch_file(tags['pilon'], '.final.fasta'), 'name': 'scaffold'}
         sortargs = Namespace(**sortDict)
         aaftf_sort.run(parser, sortargs)
-    else:
-    	status('AAFTF sort output found: {:}'.format(basename+'.final.fasta'))
-    if not checkfile(basename+'.final.fasta'):
-        status('AATFT sort failed')
-        sys.exit(1)
-   
+
     #assess the assembly
-    assessDict = {'input': basename+'.final.fasta', 'report': False}
-    assessargs = Namespace(**assessDict)
-    assess.run(parser, assessargs)
-        
-        
-    
\ No newline at end of file
+    results = {}
+    def run_assess(branch, tags):
+        import AAFTF.assess as assess
+        assessDict = {'input': branch_file(tags['pilon'], '.final.fasta'), 'report': False}
+        assessargs = Namespace(**assessDict)
+        results[tags['pilon']] = assess.run(parser, assessargs)
+
+    def params(keys, branch={}, **extra):
+        values = {k: value(branch, k) for k in keys}
+        values.update(extra)
+        return values
+
+    assemblers = {'spades': 'spades.py', 'megahit': 'megahit', 'skesa': 'skesa'}
+    pilonAligner = 'minimap2' if args.aligner == 'minimap2' else 'bwa'
+
+    # the assembler is given the memory estimated from the k-mer spectrum
+    # once it is known, so several small genomes can assemble at once
+    def assembly_memory():
+        kmerProfile = kmer_profile()
+        if not userMemory and kmerProfile.get('genome_size'):
+            return kmerProfile['spades_memory']
+        return memory
+
+    manifest = Manifest(basename+'.manifest.json')
+    def task(stage, func, after=[], **kwargs):
+        name = label+':'+stage if label else stage
+        after = [label+':'+x if label else x for x in after]
+        return dag.add(Task(name, func, after=after, key=stage, manifest=manifest,
+                            log=log, label=label, **kwargs))
+
+    # database preparation is mostly downloading so it is given no cpus
+    # and overlaps with the compute stages, the manifest records what each
+    # stage was run with so only changed stages are rerun
+    task('trim', run_trim, inputs=reads, outputs=trimmed, cpus=args.cpus, mem=memory,
+         params=params(['minlength'], method='bbduk'), tools=['bbduk.sh'])
+    task('filter_db', run_filter_db, cpus=0, mem=1)
+    task('filter', run_filter, inputs=trimmed, outputs=filtered, cpus=args.cpus, mem=memory,
+         after=['filter_db'], tools=['bbduk.sh'],
+         params=params(['screen_accessions', 'screen_urls', 'accession_url'], aligner='bbduk'))
+    assemblyInputs = list(filtered)
+    sourInputs = [basename+'.vecscreen.fasta']+filtered
+    if not args.no_kmer_profile:
+        task('kmers', run_kmers, inputs=filtered, outputs=[kmerJSON], cpus=1, mem=2,
+             params={'kmer': 21, 'sample': 16})
+        assemblyInputs.append(kmerJSON)
+        sourInputs.append(kmerJSON)
+    task('assemble', run_assemble, inputs=assemblyInputs, outputs=[basename+'.spades.fasta'],
+         cpus=args.cpus, mem=assembly_memory, params=params(['assembler']),
+         tools=[assemblers[args.assembler]])
+    task('vecscreen_db', run_vecscreen_db, cpus=0, mem=1)
+    task('vecscreen', run_vecscreen, inputs=[basename+'.spades.fasta'],
+         outputs=[basename+'.vecscreen.fasta'], cpus=args.cpus, mem=2, after=['vecscreen_db'],
+         params={'percent_id': False, 'stringency': 'high'}, tools=['blastn', 'makeblastdb'])
+
+    # downstream stages are added once for every distinct set of values
+    # they depend on, so branches share what they have in common
+    def branch_stage(name, tag):
+        return name+'.'+tag if tag else name
+
+    added = set()
+    for branch in branches:
+        tags = branch_tags(branch)
+        for name, func, tag, inputs, output, kwargs in [
+                ('sourpurge', run_sourpurge, tags['sourpurge'], sourInputs,
+                 branch_file(tags['sourpurge'], '.sourpurge.fasta'),
+                 dict(cpus=branchCpus, mem=8, params=params(['phylum', 'sourdb', 'mincovpct'], branch),
+                      tools=['sourmash', 'bwa', 'samtools'])),
+                ('rmdup', run_rmdup, tags['rmdup'], [branch_file(tags['sourpurge'], '.sourpurge.fasta')],
+                 branch_file(tags['rmdup'], '.rmdup.fasta'),
+                 dict(cpus=branchCpus, mem=2, tools=['minimap2'],
+                      params=params(['mincontiglen'], branch, percent_id=value(branch, 'percent_id', 95),
+                                    percent_cov=value(branch, 'percent_cov', 95), exhaustive=False))),
+                ('pilon', run_pilon, tags['pilon'], [branch_file(tags['rmdup'], '.rmdup.fasta')]+filtered,
+                 branch_file(tags['pilon'], '.pilon.fasta'),
+                 dict(cpus=branchCpus, mem=branchMemory, tools=['pilon', 'samtools', pilonAligner],
+                      params=params(['iterations', 'converge', 'min_changes', 'max_changes_per_mb', 'incremental',
+                                     'shards', 'aligner', 'max_coverage', 'seed'], branch))),
+                ('sort', run_sort, tags['pilon'], [branch_file(tags['pilon'], '.pilon.fasta')],
+                 branch_file(tags['pilon'], '.final.fasta'),
+                 dict(cpus=1, mem=1, params={'name': 'scaffold'}))]:
+            if branch_stage(name, tag) in added:
+                continue
+            added.add(branch_stage(name, tag))
+            task(branch_stage(name, tag), partial(func, branch, tags), inputs=inputs, outputs=[output], **kwargs)
+        task(branch_stage('assess', tags['pilon']), partial(run_assess, branch, tags),
+             inputs=[branch_file(tags['pilon'], '.final.fasta')], cpus=1, mem=1)
+    return results
+
+def run_dag(dag, profileFile):
+    '''
+    run the scheduler and write the resource profile of the stages that
+    ran, also when a stage fails, final metrics are written at the end
+    '''
+    try:
+        return dag.run()
+    finally:
+        dag.profile.write(profileFile)
+        status('Stage resource profile written to {:}'.format(profileFile))
+        metrics.stop()
+
+def sweep(parser, args):
+    '''
+    trim, filter, assemble and vecscreen once then run every combination
+    of the --grid values, branches share the stages whose values match
+    '''
+    grid = parse_grid(args.grid)
+    branches = grid_branches(grid)
+    status('Sweeping {:} parameter combinations of {:}'.format(
+            len(branches), ', '.join(['{:} ({:})'.format(k, ','.join(map(str, v))) for k, v in grid])))
+    if not args.workdir:
+        args.workdir = 'aaftf-sweep_'+str(os.getpid())
+
+    dag = Scheduler(args.cpus, int(getRAM()), keep_going=True, profile=RunProfile(),
+                    metrics=metrics.start(args))
+    results = add_tasks(parser, args, dag, branches=branches)
+    run_dag(dag, args.basename+'.run_profile.json')
+    if not args.debug:
+        for x in glob.glob(args.basename+'*.aligncache'):
+            SafeRemove(x)
+
+    table = args.basename+'.sweep.tsv'
+    write_sweep(table, grid, branches, results)
+    status('Assembly stats of {:,} of {:,} branches written to {:}'.format(
+            len(results), len(branches), table))
+    failed = [k for k, v in dag.state.items() if v[0] in ['failed', 'not run']]
+    if failed:
+        status('Stages failed or not run: {:}'.format(', '.join(failed)))
+        sys.exit(1)
+
+def run(parser,args):
+    #script to run entire AAFTF pipeline
+    if getattr(args, 'grid', None):
+        sweep(parser, args)
+        return
+    dag = Scheduler(args.cpus, int(getRAM()), profile=RunProfile(), metrics=metrics.start(args))
+    add_tasks(parser, args, dag)
+    run_dag(dag, args.basename+'.run_profile.json')
@@ -0,0 +1,190 @@
+# profile the python side of AAFTF
+# the external tools are measured by runprofile, this covers the work
+# AAFTF does itself: parsing FASTA and BLAST tables in vecscreen and
+# sourpurge, the rmdup comparisons, sort and assess. Every stage (the
+# subcommand, or each task of a pipeline) is run under cProfile, the
+# stacks of the stage threads are sampled into flamegraph folded stacks,
+# and tracemalloc is sampled for the peak python memory of the stage and
+# the lines that had allocated it. When no profile is active stage() does
+# nothing.
+
+import os
+import re
+import sys
+import time
+import cProfile
+import threading
+import tracemalloc
+from AAFTF.utility import status
+
+TOP_ALLOCATIONS = 25
+
+# the profiler of this run
+_active = None
+
+def stage_file(prefix, name, suffix):
+    return '{:}.{:}.{:}'.format(prefix, re.sub(r'[^\w.-]+', '_', name), suffix)
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{:}:{:}:{:}'.format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+def folded_stack(frame):
+    '''
+    root first, semicolon separated, as read by flamegraph.pl and speedscope
+    '''
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+class PyStage(object):
+    '''
+    context manager profiling one stage run in the current thread
+    '''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.stacks = {}
+        self.samples = 0
+        self.peak = 0
+        self.snapshot = None
+        self.snapshot_size = 0
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.start_traced = tracemalloc.get_traced_memory()[0]
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError:
+            # newer pythons allow one cProfile per process, the enclosing
+            # stage's profile already includes this one
+            self.profile = None
+        self.profiler.register(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.profile:
+            self.profile.disable()
+        self.profiler.unregister(self)
+        self.profiler.update(self, tracemalloc.get_traced_memory()[0])
+        self.profiler.write(self, time.time() - self.start)
+        return False
+
+class PyProfiler(object):
+    def __init__(self, prefix, interval=0.01, frames=1):
+        '''
+        outputs are written to prefix.<stage>.pstats, .folded and
+        .tracemalloc.txt, stacks are sampled every interval seconds
+        '''
+        self.prefix = prefix
+        self.interval = interval
+        self.stages = {}
+        self.files = []
+        self.lock = threading.Lock()
+        folder = os.path.dirname(prefix)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tracemalloc.start(frames)
+        self._done = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+
+    def register(self, stage):
+        with self.lock:
+            self.stages.setdefault(stage.thread, []).append(stage)
+
+    def unregister(self, stage):
+        with self.lock:
+            self.stages[stage.thread].remove(stage)
+            if not self.stages[stage.thread]:
+                del self.stages[stage.thread]
+
+    def update(self, stage, traced):
+        '''
+        keep a snapshot of the allocations when the stage reaches a new
+        peak, snapshots hold the GIL for a while so only after the traced
+        memory grew by half
+        '''
+        stage.peak = max(stage.peak, traced)
+        if traced > stage.snapshot_size * 1.5 + 256*1024:
+            stage.snapshot = tracemalloc.take_snapshot()
+            stage.snapshot_size = traced
+
+    def sample(self):
+        frames = sys._current_frames()
+        traced = tracemalloc.get_traced_memory()[0]
+        with self.lock:
+            running = [(t, list(s)) for t, s in self.stages.items()]
+        for thread, stages in running:
+            if thread in frames:
+                # the innermost stage of the thread gets the sample
+                stack = folded_stack(frames[thread])
+                stages[-1].stacks[stack] = stages[-1].stacks.get(stack, 0) + 1
+                stages[-1].samples += 1
+            for s in stages:
+                self.update(s, traced)
+
+    def sample_loop(self):
+        while not self._done.wait(self.interval):
+            self.sample()
+
+    def write(self, stage, seconds):
+        files = []
+        if stage.profile:
+            files.append(stage_file(self.prefix, stage.name, 'pstats'))
+            stage.profile.dump_stats(files[-1])
+        files.append(stage_file(self.prefix, stage.name, 'folded'))
+        with open(files[-1], 'w') as outfile:
+            for stack, count in sorted(stage.stacks.items()):
+                outfile.write('{:} {:}\n'.format(stack, count))
+        files.append(stage_file(self.prefix, stage.name, 'tracemalloc.txt'))
+        with open(files[-1], 'w') as outfile:
+            outfile.write('stage\t{:}\n'.format(stage.name))
+            outfile.write('wall_seconds\t{:.2f}\n'.format(seconds))
+            outfile.write('stack_samples\t{:}\n'.format(stage.samples))
+            outfile.write('start_traced_bytes\t{:}\n'.format(stage.start_traced))
+            outfile.write('peak_traced_bytes\t{:}\n'.format(stage.peak))
+            if stage.snapshot:
+                outfile.write('\n# top allocations at the peak (bytes, blocks, line)\n')
+                for stat in stage.snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    frame = stat.traceback[0]
+                    outfile.write('{:}\t{:}\t{:}:{:}\n'.format(stat.size, stat.count, frame.filename, frame.lineno))
+        with self.lock:
+            self.files.extend(files)
+
+    def close(self):
+        self._done.set()
+        self.thread.join()
+        tracemalloc.stop()
+
+def stage(name):
+    '''
+    profile the code run in the with block as stage name
+    '''
+    if _active is None:
+        return NoProfile()
+    return PyStage(_active, name)
+
+class NoProfile(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+def start(prefix, interval=0.01):
+    global _active
+    _active = PyProfiler(prefix, interval=interval)
+    return _active
+
+def stop():
+    global _active
+    if _active:
+        _active.close()
+        status('Python profile of {:,} stages written to {:}.*.pstats, .folded and .tracemalloc.txt'.format(
+                len([x for x in _active.files if x.endswith('.folded')]), _active.prefix))
+    _active = None
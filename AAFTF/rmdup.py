@@ -15,37 +15,53 @@ from AAFTF.utility import execute
 from AAFTF.utility import status
 from AAFTF.utility import printCMD
 from AAFTF.utility import SafeRemove
+from AAFTF.metrics import record_contigs
+
+def paf_identity(line):
+    '''
+    query, query length, target, percent identity and percent of the
+    query aligned from a minimap2 PAF line
+    '''
+    qID, qLen, qStart, qEnd, strand, tID, tLen, tStart, tEnd, matches, alnLen, mapQ = line.split('\t')[:12]
+    return qID, int(qLen), tID, float(matches) / int(alnLen) * 100, float(alnLen) / int(qLen) * 100
+
+def duplicated(lines, percent_id, percent_cov, debug=False):
+    '''
+    first alignment in minimap2 PAF lines of a contig against the rest of
+    the assembly above both percent identity and percent coverage, as
+    (query, length, target, identity, coverage), None if not a duplicate
+    '''
+    for line in lines:
+        qID, qLen, tID, pident, cov = paf_identity(line)
+        if debug:
+            print('\tquery={:} hit={:} pident={:.2f} coverage={:.2f}'.format(qID, tID, pident, cov))
+        if pident > percent_id and cov > percent_cov:
+            return (qID, qLen, tID, pident, cov)
+    return None
 
 def run(parser,args):
 
     def generateFastas(fasta, pref, query, reference):
         qfile = os.path.join(args.workdir, pref +'query.fasta')
         rfile = os.path.join(args.workdir, pref +'reference.fasta')
+        reference = set(reference)
         with open(qfile, 'w') as qout:
             with open(rfile, 'w') as rout:
-                with open(fasta, 'rU') as infile:
+                with open(fasta, 'r') as infile:
                     for Header,Seq in SimpleFastaParser(infile):
-                        if Header in query:
+                        if Header == query:
                             qout.write('>{:}\n{:}\n'.format(Header, softwrap(Seq)))
                         elif Header in reference:
                             rout.write('>{:}\n{:}\n'.format(Header, softwrap(Seq)))
         return qfile, rfile
     
     def runMinimap2(query, reference, name):
-        FNULL = open(os.devnull, 'w')
-        garbage = False #assume this is a good contig
-        for line in execute(['minimap2', '-t', str(args.cpus), '-x', 'asm5', '-N5', reference, query], '.'):
-            qID, qLen, qStart, qEnd, strand, tID, tLen, tStart, tEnd, matches, alnLen, mapQ = line.split('\t')[:12]
-            pident = float(matches) / int(alnLen) * 100
-            cov = float(alnLen) / int(qLen) * 100
-            if args.debug:
-                print('\tquery={:} hit={:} pident={:.2f} coverage={:.2f}'.format(qID, tID, pident, cov))
-            
-                if pident > args.percent_id and cov > args.percent_cov:
-                    print("{:} duplicated: {:.0f}% identity over {:.0f}% of the contig. length={:}".format(name, pident, cov, qLen))
-                    garbage = True
-                    break
-        return garbage #false is good, true is repeat
+        # read all of the few PAF lines so minimap2 is waited for
+        lines = list(execute(['minimap2', '-t', str(args.cpus), '-x', 'asm5', '-N5', reference, query], '.'))
+        hit = duplicated(lines, args.percent_id, args.percent_cov, debug=args.debug)
+        if hit and args.debug:
+            print("{:} duplicated: {:.0f}% identity over {:.0f}% of the contig. length={:}".format(name, hit[3], hit[4], hit[1]))
+        return hit is not None #false is good, true is repeat
 
 
     #start here -- functions nested so they can inherit the arguments
@@ -61,7 +77,7 @@ def run(parser,args):
     status('Looping through assembly shortest --> longest searching for duplicated contigs using minimap2')
     numSeqs, assemblySize = fastastats(args.input)
     fasta_lengths = []
-    with open(args.input, 'rU') as infile:
+    with open(args.input, 'r') as infile:
         for Header, Seq in SimpleFastaParser(infile):
             fasta_lengths.append(len(Seq))
     n50 = calcN50(fasta_lengths, num=0.75)
@@ -69,7 +85,7 @@ def run(parser,args):
     
     #get list of tuples of sequences sorted by size (shortest --> longest)
     AllSeqs = {}
-    with open(args.input, 'rU') as infile:
+    with open(args.input, 'r') as infile:
         for Header, Seq in SimpleFastaParser(infile):
             if not Header in AllSeqs:
                 AllSeqs[Header] = len(Seq)
@@ -105,11 +121,13 @@ def run(parser,args):
     
     ignore = set(ignore)
     with open(args.out, 'w') as clean_out:
-        with open(args.input, 'rU') as infile:
+        with open(args.input, 'r') as infile:
             for Header, Seq in SimpleFastaParser(infile):
                 if not Header in ignore:
                     clean_out.write('>{:}\n{:}\n'.format(Header, softwrap(Seq)))
     numSeqs, assemblySize = fastastats(args.out)
+    record_contigs('kept', numSeqs)
+    record_contigs('removed', len(ignore))
     status('Cleaned assembly is {:,} contigs and {:,} bp'.format(numSeqs, assemblySize))
     if '_' in args.out:
         nextOut = args.out.split('_')[0]+'.pilon.fasta'
@@ -0,0 +1,112 @@
+# resource profile of a pipeline run
+# every stage records its wall time, the cpu time and io of the thread it
+# runs in, and samples the processes that thread and its worker threads
+# start (bbduk, SPAdes, blastn, Pilon) from /proc for their peak RSS, cpu
+# time and io. Stages run concurrently, so getrusage(RUSAGE_CHILDREN)
+# deltas are recorded with the stages that overlapped them, and once for
+# the whole run.
+
+import sys
+import time
+import json
+import resource
+import threading
+from AAFTF.utility import ProcessSampler
+from AAFTF.utility import process_io
+from AAFTF.utility import stage_labels
+
+def maxrss_bytes(usage):
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+def rusage_delta(before, after):
+    return {'cpu_seconds': round(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime, 2),
+            'maxrss_bytes': maxrss_bytes(after),
+            'read_blocks': after.ru_inblock - before.ru_inblock,
+            'write_blocks': after.ru_oublock - before.ru_oublock}
+
+class StageProfile(object):
+    '''
+    context manager measuring one stage run in the current thread
+    '''
+    def __init__(self, run, name, interval=2.0):
+        self.run = run
+        self.name = name
+        self.interval = interval
+
+    def __enter__(self):
+        self.tid = threading.get_native_id()
+        self.thread_io = process_io('/proc/self/task/{:}/io'.format(self.tid))
+        self.thread_cpu = time.thread_time()
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.sampler = ProcessSampler(thread=self.tid, stage=stage_labels(), interval=self.interval)
+        self.start = time.time()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.sampler.stop()
+        end = time.time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        thread_io = process_io('/proc/self/task/{:}/io'.format(self.tid))
+        processes = sorted(self.sampler.processes.values(), key=lambda x: x['cpu_seconds'], reverse=True)
+        record = {'stage': self.name,
+                  'status': 'failed' if exc_type else 'done',
+                  'start': round(self.start - self.run.start, 2),
+                  'wall_seconds': round(end - self.start, 2),
+                  'python_cpu_seconds': round(time.thread_time() - self.thread_cpu, 2),
+                  'python_read_bytes': thread_io['read_bytes'] - self.thread_io['read_bytes'],
+                  'python_write_bytes': thread_io['write_bytes'] - self.thread_io['write_bytes'],
+                  'child_cpu_seconds': round(sum([x['cpu_seconds'] for x in processes]), 2),
+                  'child_peak_rss_bytes': self.sampler.peak_rss,
+                  'child_read_bytes': sum([x['read_bytes'] for x in processes]),
+                  'child_write_bytes': sum([x['write_bytes'] for x in processes]),
+                  'rusage_children': rusage_delta(self.children, children),
+                  'processes': [{'pid': x['pid'], 'command': x['command'],
+                                 'cpu_seconds': round(x['cpu_seconds'], 2),
+                                 'peak_rss_bytes': x['peak_rss_bytes'],
+                                 'read_bytes': x['read_bytes'],
+                                 'write_bytes': x['write_bytes']} for x in processes],
+                  'samples': [{'time': x[0], 'rss_bytes': x[1], 'cpu_seconds': x[2], 'processes': x[3]}
+                              for x in self.sampler.samples]}
+        self.run.add(record)
+        return False
+
+class RunProfile(object):
+    '''
+    collects the StageProfile records of a run and writes them as JSON
+    '''
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.start = time.time()
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        return StageProfile(self, name, interval=self.interval)
+
+    def add(self, record):
+        with self.lock:
+            self.stages.append(record)
+
+    def report(self):
+        end = time.time()
+        stages = sorted(self.stages, key=lambda x: x['start'])
+        # child rusage is only exact for stages nothing else overlapped
+        for x in stages:
+            x['overlapping'] = [y['stage'] for y in stages if y is not x and
+                                y['start'] < x['start'] + x['wall_seconds'] and
+                                x['start'] < y['start'] + y['wall_seconds']]
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {'wall_seconds': round(end - self.start, 2),
+                'python': {'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+                           'maxrss_bytes': maxrss_bytes(usage)},
+                'rusage_children': rusage_delta(self.children, resource.getrusage(resource.RUSAGE_CHILDREN)),
+                'stages': stages}
+
+    def write(self, filename):
+        with open(filename, 'w') as outfile:
+            json.dump(self.report(), outfile, indent=2)
+        return filename
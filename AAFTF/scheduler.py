@@ -0,0 +1,239 @@
+# task graph scheduler for the AAFTF pipeline
+# each task declares the files it reads and writes plus the cpus and
+# memory it needs. A task waits for the tasks producing its inputs and
+# starts as soon as they are done and it fits in the cpu and memory
+# budget, so independent work such as database downloads runs alongside
+# the read processing stages. With a manifest, finished tasks are only
+# skipped when their recorded inputs, parameters and tool versions match.
+# Tasks of several samples can share one scheduler, each writing its
+# status messages to its own log and checkpointing to its own manifest.
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from AAFTF.utility import status
+from AAFTF.utility import checkfile
+from AAFTF.utility import set_status_log
+from AAFTF.utility import emit
+import AAFTF.pyprofile as pyprofile
+
+class Task(object):
+    def __init__(self, name, func, inputs=[], outputs=[], cpus=1, mem=1, after=[],
+                 params={}, tools=[], key=None, manifest=None, log=None, label=None):
+        '''
+        func is called with no arguments, after lists names of tasks that
+        must finish first without sharing a file. params and tools (external
+        programs run) are recorded in the manifest under key (default name),
+        manifest replaces the scheduler manifest for this task. mem may be a
+        function called when the task is ready to start. Status messages are
+        appended to log and labelled with label. Tasks without outputs
+        always run.
+        '''
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cpus = cpus
+        self.mem = mem
+        self.after = list(after)
+        self.params = dict(params)
+        self.tools = list(tools)
+        self.key = key or name
+        self.manifest = manifest
+        self.log = log
+        self.label = label
+        self.deps = set()
+
+    def memory(self):
+        if callable(self.mem):
+            return self.mem()
+        return self.mem
+
+    def complete(self):
+        return self.outputs and all(checkfile(x) for x in self.outputs)
+
+class TaskFailed(Exception):
+    pass
+
+class Scheduler(object):
+    def __init__(self, cpus, mem, manifest=None, keep_going=False, profile=None, metrics=None):
+        '''
+        with keep_going a failed task only stops the tasks that depend on
+        it, otherwise nothing new is started and the run exits. Tasks that
+        run are measured by profile (a RunProfile) and published to metrics
+        (a Metrics) if given
+        '''
+        self.cpus = cpus
+        self.mem = mem
+        self.manifest = manifest
+        self.keep_going = keep_going
+        self.profile = profile
+        self.metrics = metrics
+        self.tasks = []
+        self.state = {}
+
+    def add(self, task):
+        self.tasks.append(task)
+        return task
+
+    def resolve(self):
+        '''
+        connect each task to the tasks producing its inputs
+        '''
+        producers = {}
+        names = set()
+        for t in self.tasks:
+            if t.name in names:
+                raise ValueError('duplicate task {:}'.format(t.name))
+            names.add(t.name)
+            for x in t.outputs:
+                producers[x] = t.name
+        for t in self.tasks:
+            t.deps = set([producers[x] for x in t.inputs if x in producers])
+            for x in t.after:
+                if not x in names:
+                    raise ValueError('task {:} waits on unknown task {:}'.format(t.name, x))
+                t.deps.add(x)
+            t.deps.discard(t.name)
+
+    def task_manifest(self, task):
+        return task.manifest or self.manifest
+
+    def up_to_date(self, task):
+        manifest = self.task_manifest(task)
+        if not manifest:
+            return task.complete()
+        if manifest.valid(task):
+            return True
+        if task.outputs and task.key in manifest.data['tasks']:
+            status('AAFTF {:} is out of date: {:}'.format(task.name, manifest.changes(task)))
+        elif task.complete():
+            status('AAFTF {:} output has no checkpoint, rerunning'.format(task.name))
+        return False
+
+    def update_metrics(self, method, *args):
+        '''
+        metrics only report on the run, failing to update them must not
+        fail the stage
+        '''
+        if not self.metrics:
+            return
+        try:
+            getattr(self.metrics, method)(*args)
+        except Exception as e:
+            status('Unable to update metrics: {:}'.format(e))
+
+    def execute(self, task):
+        start = time.time()
+        handle = open(task.log, 'a') if task.log else None
+        set_status_log(handle, task.label, task.key)
+        emit('stage_start', cpus=task.cpus, mem=task.mem, inputs=task.inputs, outputs=task.outputs)
+        self.update_metrics('start_stage', task.key, task.label)
+        success = False
+        try:
+            with pyprofile.stage(task.name):
+                if self.profile:
+                    with self.profile.stage(task.name):
+                        task.func()
+                else:
+                    task.func()
+            missing = [x for x in task.outputs if not checkfile(x)]
+            if missing:
+                raise TaskFailed('output missing: {:}'.format(', '.join(missing)))
+            success = True
+        except BaseException as e:
+            status('AAFTF {:} failed: {:}'.format(task.name, e))
+            raise
+        finally:
+            emit('stage_end', success=success, seconds=round(time.time() - start, 3))
+            self.update_metrics('end_stage', task.key, task.label, success)
+            set_status_log()
+            if handle:
+                handle.close()
+        return time.time() - start
+
+    def dependents(self, name):
+        '''
+        names of all tasks downstream of task name
+        '''
+        found = set()
+        stack = [name]
+        while stack:
+            x = stack.pop()
+            for t in self.tasks:
+                if x in t.deps and not t.name in found:
+                    found.add(t.name)
+                    stack.append(t.name)
+        return found
+
+    def run(self):
+        '''
+        run every task, returns dictionary of task name: seconds (None if
+        skipped), exits if any task fails once running tasks finish unless
+        keep_going is set. The state of every task (done, skipped, failed or
+        not run) is kept in self.state
+        '''
+        self.resolve()
+        pending = list(self.tasks)
+        finished = {}
+        running = {}
+        used_cpus, used_mem = 0, 0
+        failed = []
+        checked = set()
+        self.state = {t.name: ('not run', None) for t in self.tasks}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            while pending or running:
+                if self.keep_going or not failed:
+                    for t in list(pending):
+                        if not t.deps.issubset(finished):
+                            continue
+                        if not t.name in checked and self.up_to_date(t):
+                            status('AAFTF {:} output found: {:}'.format(t.name, ' '.join(t.outputs)))
+                            finished[t.name] = None
+                            self.state[t.name] = ('skipped', None)
+                            pending.remove(t)
+                            continue
+                        if not t.name in checked:
+                            t.mem = t.memory()
+                        checked.add(t.name)
+                        # a task asking for more than the budget runs on its own
+                        cpus = min(t.cpus, self.cpus)
+                        mem = min(t.mem, self.mem)
+                        if running and (used_cpus + cpus > self.cpus or used_mem + mem > self.mem):
+                            continue
+                        used_cpus += cpus
+                        used_mem += mem
+                        running[executor.submit(self.execute, t)] = (t, cpus, mem)
+                        pending.remove(t)
+                    if not running and pending and not any(t.deps.issubset(finished) for t in pending) \
+                            and not failed:
+                        raise ValueError('tasks can not run, check dependencies: {:}'.format(
+                                ', '.join([t.name for t in pending])))
+                if not running:
+                    break
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    t, cpus, mem = running.pop(future)
+                    used_cpus -= cpus
+                    used_mem -= mem
+                    manifest = self.task_manifest(t)
+                    try:
+                        finished[t.name] = future.result()
+                    except BaseException:
+                        failed.append(t.name)
+                        self.state[t.name] = ('failed', None)
+                        if manifest:
+                            manifest.forget(t)
+                        if self.keep_going:
+                            # tasks downstream of a failure can never start
+                            blocked = self.dependents(t.name)
+                            pending = [x for x in pending if not x.name in blocked]
+                        continue
+                    self.state[t.name] = ('done', finished[t.name])
+                    if manifest and t.outputs:
+                        manifest.record(t)
+        if failed and not self.keep_going:
+            sys.exit(1)
+        return finished
@@ -11,7 +11,7 @@ from AAFTF.utility import status
 def run(parser, args):
     status('Sorting sequences by length longest --> shortest')
     AllSeqs = {}
-    with open(args.input, 'rU') as fasta_in:
+    with open(args.input, 'r') as fasta_in:
         for Header, Seq in SimpleFastaParser(fasta_in):
             if not Header in AllSeqs:
                 AllSeqs[Header] = len(Seq)
@@ -1,10 +1,19 @@
-import sys, os, shutil
+import sys, os, shutil, csv
+import importlib.util
 
 from subprocess import call, Popen, PIPE, STDOUT
 import subprocess
 
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import re
+import numpy
 from AAFTF.utility import execute
+from AAFTF.utility import run_traced
+from AAFTF.utility import submit_in_context
+from AAFTF.utility import TracedPopen
 from AAFTF.utility import calcN50
 from AAFTF.utility import fastastats
 from AAFTF.resources import DB_Links
@@ -12,6 +21,262 @@ from AAFTF.utility import status
 from AAFTF.utility import printCMD
 from AAFTF.utility import SafeRemove
 from AAFTF.utility import checkfile
+from AAFTF.utility import countfasta
+from AAFTF.utility import softwrap
+from AAFTF.utility import fasta_hashes
+from AAFTF.metrics import record_contigs
+from AAFTF.taxcache import TaxonomyCache
+import AAFTF.aligncache as aligncache
+from AAFTF.lcaserver import service_running
+from AAFTF.lcaserver import classify_remote
+
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+
+def minhash_hashes(mh):
+    # sourmash >= 4 exposes .hashes, older versions get_mins()
+    if hasattr(mh, 'hashes'):
+        return list(mh.hashes)
+    return list(mh.get_mins())
+
+def sketch_contigs(chunk):
+    '''
+    worker to build scaled MinHash sketches for a chunk of contigs,
+    same settings as sourmash compute -k ksize --scaled=scaled --singleton
+    '''
+    import sourmash
+    records, ksize, scaled = chunk
+    results = []
+    for Header, Seq in records:
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+        mh.add_sequence(Seq, True)
+        results.append((Header, minhash_hashes(mh)))
+    return results
+
+def parallel_sketch(fasta, sigfile, cpus, ksize=31, scaled=1000):
+    '''
+    sketch each contig in a pool of workers and write the merged
+    signatures to sigfile, chunks are balanced by total contig length
+    '''
+    import sourmash
+    records = []
+    with open(fasta, 'r') as infile:
+        for Header, Seq in SimpleFastaParser(infile):
+            records.append((Header, Seq))
+    nchunks = max(1, min(len(records), cpus*4))
+    chunks = [[] for i in range(nchunks)]
+    sizes = [0] * nchunks
+    for record in sorted(records, key=lambda x: len(x[1]), reverse=True):
+        smallest = sizes.index(min(sizes))
+        chunks[smallest].append(record)
+        sizes[smallest] += len(record[1])
+    hashes = {}
+    if cpus > 1:
+        # runs in a thread next to the bwa and samtools pipes of the coverage
+        # branch, forked workers would hold on to those pipes (and any lock
+        # held at the time of the fork), spawned ones start clean
+        with multiprocessing.get_context('spawn').Pool(processes=cpus) as pool:
+            for result in pool.imap_unordered(sketch_contigs, [(x, ksize, scaled) for x in chunks]):
+                hashes.update(result)
+    else:
+        for x in chunks:
+            hashes.update(sketch_contigs((x, ksize, scaled)))
+    # write in the input order so output matches sourmash compute
+    siglist = []
+    for Header, Seq in records:
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+        mh.add_many(hashes[Header])
+        siglist.append(sourmash.SourmashSignature(mh, name=Header,
+                                                  filename=os.path.basename(fasta)))
+    with open(sigfile, 'w') as sigout:
+        sourmash.save_signatures(siglist, sigout)
+    return len(siglist)
+
+def sam_coverage(samfile, lengths, samout=None):
+    '''
+    calculate mean read depth per contig from a stream of SAM lines,
+    counts aligned bases the same way as samtools bedcov over the whole
+    contig (M/D/N/=/X cigar operations, skipping unmapped, secondary,
+    QC fail and duplicate reads). lengths is dictionary of contig: length,
+    lines are optionally copied to samout. returns dictionary of
+    contig: (length, coverage)
+    '''
+    names = list(lengths.keys())
+    index = {x: i for i, x in enumerate(names)}
+    bases = [0] * len(names)
+    skip = 0x4 | 0x100 | 0x200 | 0x400
+    for line in samfile:
+        if samout:
+            samout.write(line)
+        if line.startswith('@'):
+            continue
+        cols = line.split('\t', 6)
+        if int(cols[1]) & skip or not cols[2] in index or cols[5] == '*':
+            continue
+        aligned = 0
+        for length, op in CIGAR_RE.findall(cols[5]):
+            if op in 'MDN=X':
+                aligned += int(length)
+        bases[index[cols[2]]] += aligned
+    depth = numpy.array(bases, dtype=numpy.float64) / numpy.array([lengths[x] for x in names], dtype=numpy.float64)
+    return {x: (lengths[x], float(depth[i])) for i, x in enumerate(names)}
+
+def open_taxcache(args, SOUR):
+    if args.no_taxcache:
+        return None
+    cachefile = args.taxcache
+    if not cachefile:
+        if not os.access(os.path.dirname(SOUR), os.W_OK):
+            return None
+        cachefile = os.path.join(os.path.dirname(SOUR), 'sourpurge-taxonomy.sqlite')
+    return TaxonomyCache(cachefile, SOUR, ksize=31, scaled=1000)
+
+def classify_contigs(args, fasta, SOUR, cpus):
+    '''
+    sketch contigs in the workdir fasta file and classify them with
+    sourmash lca, returns iterator of the CSV lines
+    '''
+    DEVNULL = open(os.devnull, 'w')
+    sour_sketch = os.path.basename(fasta)+'.sig'
+    if importlib.util.find_spec('sourmash'):
+        status('Sketching {:,} contigs using {:} CPUs'.format(countfasta(os.path.join(args.workdir, fasta)), cpus))
+        parallel_sketch(os.path.join(args.workdir, fasta),
+                        os.path.join(args.workdir, sour_sketch), cpus)
+    else:
+        sour_compute = ['sourmash', 'compute', '-k', '31', '--scaled=1000',
+                       '--singleton', fasta]
+        printCMD(sour_compute)
+        run_traced(sour_compute, cwd=args.workdir, stderr=DEVNULL)
+    sour_classify = ['sourmash', 'lca', 'classify', '--db', SOUR,'--query', sour_sketch]
+    sour_socket = args.sour_socket
+    if not sour_socket:
+        sour_socket = os.environ.get('AAFTF_LCA_SOCKET')
+    if service_running(sour_socket):
+        status('Using running LCA classification service: {:}'.format(sour_socket))
+        return classify_remote(sour_socket, os.path.join(args.workdir, sour_sketch))
+    printCMD(sour_classify)
+    return execute(sour_classify, args.workdir)
+
+def taxonomy_branch(args, SOUR, assembly_working, cpus):
+    '''
+    classify contigs with sourmash, returns dictionary of contig: lineage
+    for contigs with a classification and the sourmash csv file
+    '''
+    #now filter for taxonomy with sourmash lca classify, reusing cached classifications
+    status('Running SourMash to get taxonomy classification for each contig')
+    Hashes = fasta_hashes(os.path.join(args.workdir, assembly_working))
+    cache = open_taxcache(args, SOUR)
+    Cached = {}
+    if cache:
+        Cached = cache.lookup(Hashes.values())
+    toClassify = [k for k,v in Hashes.items() if not v in Cached]
+    if cache:
+        status('Found cached taxonomy for {:,} contigs, {:,} contigs to classify'.format(
+            len(Hashes)-len(toClassify), len(toClassify)))
+    Results = {}
+    if toClassify:
+        if len(toClassify) < len(Hashes):
+            classify_working = 'assembly.uncached.fasta'
+            with open(os.path.join(args.workdir, classify_working), 'w') as outfile:
+                with open(os.path.join(args.workdir, assembly_working), 'r') as infile:
+                    for Header, Seq in SimpleFastaParser(infile):
+                        if not Hashes[Header] in Cached:
+                            outfile.write('>{:}\n{:}\n'.format(Header, softwrap(Seq)))
+        else:
+            classify_working = assembly_working
+        for line in classify_contigs(args, classify_working, SOUR, cpus):
+            if not line or line.startswith('\n') or line.startswith('ID') or line.count(',') < 9:
+                continue
+            cols = next(csv.reader([line.strip()]))
+            if cols[0] in Hashes:
+                Results[Hashes[cols[0]]] = (cols[1], cols[2:])
+        if cache:
+            cache.store(Results)
+    if cache:
+        cache.close()
+    Results.update(Cached)
+
+    # output csv: ID,status,superkingdom,phylum,class,order,family,genus,species,strain
+    Taxonomy = {}
+    UniqueTax = []
+    sourmashTSV = os.path.join(args.workdir, 'sourmash.csv')
+    with open(sourmashTSV, 'w') as sour_out:
+        csvout = csv.writer(sour_out)
+        csvout.writerow(['ID', 'status', 'superkingdom', 'phylum', 'class', 'order',
+                         'family', 'genus', 'species', 'strain'])
+        for k,v in Hashes.items():
+            if not v in Results:
+                continue
+            result, lineage = Results[v]
+            csvout.writerow([k, result] + lineage)
+            if result == 'found':
+                Taxonomy[k] = lineage
+                taxClean = [x for x in lineage if x]
+                UniqueTax.append('{:}'.format(';'.join(taxClean)))
+            elif result == 'nomatch':
+                Taxonomy[k] = lineage
+    UniqueTax = set(UniqueTax)
+    status('Found {:} taxonomic classifications for contigs:\n{:}'.
+                format(len(UniqueTax), '\n'.join(UniqueTax)))
+    return Taxonomy, sourmashTSV
+
+def coverage_branch(args, forReads, revReads, assembly_working, cpus, bamthreads):
+    '''
+    map reads to the assembly with BWA, returns dictionary of
+    contig: (length, coverage)
+    '''
+    DEVNULL = open(os.devnull, 'w')
+    blobBAM = 'remapped.bam'  # only written with --write_bam
+    assembly = os.path.join(args.workdir, assembly_working)
+    #stream alignments straight from BWA to get per contig coverage
+    lengths = {}
+    with open(assembly, 'r') as SeqIn:
+        for Header, Seq in SimpleFastaParser(SeqIn):
+            lengths[Header.split()[0]] = len(Seq)
+    bwa_index  = ['bwa','index', assembly_working]
+    status('Building BWA index')
+    printCMD(bwa_index)
+    if run_traced(bwa_index, cwd=args.workdir, stderr=DEVNULL).returncode:
+        status('bwa index of {:} failed'.format(assembly))
+        sys.exit(1)
+    #mapped reads to assembly using BWA
+    bwa_cmd = ['bwa','mem',
+               '-t', str(cpus),
+               assembly_working, # assembly index base
+               forReads]
+    if revReads:
+        bwa_cmd.append(revReads)
+    status('Aligning reads to assembly with BWA and calculating read coverage per contig')
+    printCMD(bwa_cmd)
+    p1 = TracedPopen(bwa_cmd, cwd=args.workdir, stdout=subprocess.PIPE,
+                     stderr=DEVNULL, universal_newlines=True)
+    p2 = None
+    if args.write_bam or args.align_cache:
+        #optionally also save sorted BAM of the alignments
+        p2 = TracedPopen(['samtools', 'sort',
+                          '--threads', str(bamthreads),
+                          '-o', blobBAM, '-'], cwd=args.workdir,
+                         stdout=DEVNULL, stderr=DEVNULL,
+                         stdin=subprocess.PIPE, universal_newlines=True)
+        Coverage = sam_coverage(p1.stdout, lengths, samout=p2.stdin)
+        p2.stdin.close()
+        p2.wait()
+    else:
+        Coverage = sam_coverage(p1.stdout, lengths)
+    p1.stdout.close()
+    p1.wait()
+    # without alignments every contig would look uncovered and be dropped
+    if p1.returncode:
+        status('bwa mem exited with code {:}, unable to calculate coverage'.format(p1.returncode))
+        sys.exit(1)
+    if p2:
+        if p2.returncode or run_traced(['samtools', 'index', blobBAM], cwd=args.workdir).returncode:
+            status('Sorting and indexing {:} failed'.format(blobBAM))
+            sys.exit(1)
+    coverageBed = os.path.join(args.workdir, 'coverage.bed')
+    with open(coverageBed, 'w') as bed_out:
+        for k,v in Coverage.items():
+            bed_out.write('{:}\t{:}\t{:}\t{:.0f}\n'.format(k, 0, v[0], v[0]*v[1]))
+    return Coverage
 
 # logging - we may need to think about whether this has 
 # separate name for the different runfolder
@@ -57,157 +322,98 @@ def run(parser,args):
     # hard coded tmpfile
     assembly_working  = 'assembly.fasta'
     megablast_working = 'megablast.out'
-    blobBAM           = 'remapped.bam'
     shutil.copyfile(args.input, os.path.join(args.workdir,assembly_working))
     numSeqs, assemblySize = fastastats(os.path.join(args.workdir,
                                                     assembly_working))
     status('Assembly is {:,} contigs and {:,} bp'.format(numSeqs, 
                                                               assemblySize))
-    DEVNULL = open(os.devnull, 'w')
-
-    #now filter for taxonomy with sourmash lca classify
-    status('Running SourMash to get taxonomy classification for each contig')
-    sour_sketch = os.path.basename(assembly_working)+'.sig'
-    sour_compute = ['sourmash', 'compute', '-k', '31', '--scaled=1000',
-                   '--singleton', assembly_working]
-    printCMD(sour_compute)
-    subprocess.run(sour_compute, cwd=args.workdir, stderr=DEVNULL)
-    sour_classify = ['sourmash', 'lca', 'classify', '--db', SOUR,'--query', sour_sketch]
-    printCMD(sour_classify)
-    # output csv: ID,status,superkingdom,phylum,class,order,family,genus,species,strain
-    Taxonomy = {}
-    UniqueTax = []
-    sourmashTSV = os.path.join(args.workdir, 'sourmash.csv')
-    with open(sourmashTSV, 'w') as sour_out:
-        for line in execute(sour_classify, args.workdir):
-            sour_out.write(line)
-            if not line or line.startswith('\n') or line.startswith('ID') or line.count(',') < 9:
-                continue
-            line = line.strip()
-            cols = line.split(',')
-            if 'found' in cols:
-                idx = cols.index('found')
-                Taxonomy[cols[0]] = cols[idx+1:]
-                taxClean = [x for x in cols[idx+1:] if x]
-                UniqueTax.append('{:}'.format(';'.join(taxClean)))
-            elif 'nomatch' in cols:
-                idx = cols.index('nomatch')
-                Taxonomy[cols[0]] = cols[idx+1:]
-    UniqueTax = set(UniqueTax)
-    status('Found {:} taxonomic classifications for contigs:\n{:}'.
-                format(len(UniqueTax), '\n'.join(UniqueTax)))
-    if args.taxonomy:
-        sys.exit(1)
-    Tax2Drop = []
-    for k,v in Taxonomy.items():
-        v = [x for x in v if x] #remove empty items from list
-        if args.debug:
-            print('{:}\t{:}'.format(k, v))
-        if len(v) > 0:
-            if not any(i in v for i in args.phylum):
-                Tax2Drop.append(k)
-    
-    #drop contigs from taxonomy before calculating coverage
-    status('Dropping {:} contigs from taxonomy screen'.format(len(Tax2Drop)))
-    sourTax = os.path.join(args.workdir, 'sourmashed-tax-screen.fasta')
-    with open(sourTax, 'w') as outfile:
-        with open(os.path.join(args.workdir,assembly_working), 'rU') as infile:
-            for record in SeqIO.parse(infile, 'fasta'):
-                if not record.id in Tax2Drop:
-                    SeqIO.write(record, outfile, 'fasta')
-        
-    # only do coverage trimming if reads provided
-    Contigs2Drop = [] # this will be empty if no reads given to gather by coverage
-    if forReads:
-        #check if BAM present, if so skip running
-        if not os.path.isfile(os.path.join(args.workdir, blobBAM)):  
-            # index
-            bwa_index  = ['bwa','index', os.path.basename(sourTax)]     
-            status('Building BWA index')
-            printCMD(bwa_index)
-            subprocess.run(bwa_index, cwd=args.workdir, stderr=DEVNULL)
-            #mapped reads to assembly using BWA
-            bwa_cmd = ['bwa','mem',
-                       '-t', str(args.cpus),
-                       os.path.basename(sourTax), # assembly index base
-                       forReads]    
-            if revReads:
-                bwa_cmd.append(revReads)
-
-                #run BWA and pipe to samtools sort
-                status('Aligning reads to assembly with BWA')
-                printCMD(bwa_cmd)
-                p1 = subprocess.Popen(bwa_cmd, cwd=args.workdir,
-                                      stdout=subprocess.PIPE, stderr=DEVNULL)
-                p2 = subprocess.Popen(['samtools', 'sort', 
-                                       '--threads', str(bamthreads),
-                                       '-o', blobBAM, '-'], cwd=args.workdir,
-                                      stdout=subprocess.PIPE, stderr=DEVNULL,
-                                      stdin=p1.stdout)
-                p1.stdout.close()
-                p2.communicate()
-                subprocess.run(['samtools', 'index', blobBAM], cwd=args.workdir)
-
-        #now calculate coverage from BAM file
-        status('Calculating read coverage per contig')
-        FastaBed = os.path.join(args.workdir, 'assembly.bed')
-        lengths = []
-        with open(FastaBed, 'w') as bedout:
-            with open(sourTax, 'rU') as SeqIn:
-                for record in SeqIO.parse(SeqIn, 'fasta'):
-                    bedout.write('{:}\t{:}\t{:}\n'.format(record.id, 0, len(record.seq)))
-                    lengths.append(len(record.seq))
-    
-        N50 = calcN50(lengths)
-        Coverage = {}
-        coverageBed = os.path.join(args.workdir, 'coverage.bed')
-        cov_cmd = ['samtools', 'bedcov', os.path.basename(FastaBed), blobBAM] 
-        printCMD(cov_cmd)
-        with open(coverageBed, 'w') as bed_out:
-            for line in execute(cov_cmd, args.workdir):
-                bed_out.write(line)
-
-                if not line or line.startswith('\n') or line.count('\t') < 3:
-                    continue
-
-                line = line.strip()
-                cols = line.split('\t')
-                cov = int(cols[3]) / float(cols[2])
-                Coverage[cols[0]] = (int(cols[2]), cov)
-    
-        #get average coverage of N50 contigs
-        n50Cov = []
-        for k,v in Coverage.items():
+    #run taxonomy classification and read mapping at the same time, mapping
+    #is to the full assembly and contigs dropped by taxonomy are removed after
+    if forReads and not args.taxonomy:
+        taxcpus = max(1, args.cpus // 4)
+        mapcpus = max(1, args.cpus - taxcpus)
+    else:
+        taxcpus = args.cpus
+        mapcpus = args.cpus
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        taxJob = submit_in_context(executor, taxonomy_branch, args, SOUR, assembly_working, taxcpus)
+        covJob = None
+        if forReads and not args.taxonomy:
+            covJob = submit_in_context(executor, coverage_branch, args, forReads, revReads,
+                                       assembly_working, mapcpus, bamthreads)
+        Taxonomy, sourmashTSV = taxJob.result()
+        if args.taxonomy:
+            sys.exit(1)
+        Tax2Drop = []
+        for k,v in Taxonomy.items():
+            v = [x for x in v if x] #remove empty items from list
             if args.debug:
-                print('{:}; Len: {:}; Cov: {:.2f}'.format(k, v[0], v[1]))
-            if v[0] >= N50:
-                n50Cov.append(v[1])
-        n50AvgCov = sum(n50Cov) / len(n50Cov)
-        minpct = args.mincovpct / 100
-        # should we make this a variable? 5% was something arbitrary
-        min_coverage = float(n50AvgCov * minpct)  
-        status('Average coverage for N50 contigs is {:}X'.format(int(n50AvgCov)))
+                print('{:}\t{:}'.format(k, v))
+            if len(v) > 0:
+                if not any(i in v for i in args.phylum):
+                    Tax2Drop.append(k)
+
+        #drop contigs from taxonomy before calculating coverage
+        status('Dropping {:} contigs from taxonomy screen'.format(len(Tax2Drop)))
+        sourTax = os.path.join(args.workdir, 'sourmashed-tax-screen.fasta')
+        with open(sourTax, 'w') as outfile:
+            with open(os.path.join(args.workdir,assembly_working), 'r') as infile:
+                for record in SeqIO.parse(infile, 'fasta'):
+                    if not record.id in Tax2Drop:
+                        SeqIO.write(record, outfile, 'fasta')
+
+        # only do coverage trimming if reads provided
+        Contigs2Drop = [] # this will be empty if no reads given to gather by coverage
+        if covJob:
+            taxDropped = set([x.split()[0] for x in Tax2Drop])
+            Coverage = {k:v for k,v in covJob.result().items() if not k in taxDropped}
+            N50 = calcN50([v[0] for v in Coverage.values()])
+            #get average coverage of N50 contigs
+            n50Cov = []
+            for k,v in Coverage.items():
+                if args.debug:
+                    print('{:}; Len: {:}; Cov: {:.2f}'.format(k, v[0], v[1]))
+                if v[0] >= N50:
+                    n50Cov.append(v[1])
+            n50AvgCov = sum(n50Cov) / len(n50Cov)
+            minpct = args.mincovpct / 100
+            status('Average coverage for N50 contigs is {:}X'.format(int(n50AvgCov)))
+            # the read k-mer spectrum gives coverage that does not depend
+            # on which contigs are long
+            if getattr(args, 'expected_coverage', None):
+                status('Using expected genome coverage of {:.1f}X for cutoff'.format(args.expected_coverage))
+                n50AvgCov = args.expected_coverage
+            # should we make this a variable? 5% was something arbitrary
+            min_coverage = float(n50AvgCov * minpct)  
         
-        #Start list of contigs to drop  
-        for k,v in Coverage.items():
-            if v[1] <= min_coverage:
-                Contigs2Drop.append(k)
-        status('Found {:,} contigs with coverage less than {:.2f}X ({:}%)'.
-                            format(len(Contigs2Drop), min_coverage, args.mincovpct))
-            
+            #Start list of contigs to drop  
+            for k,v in Coverage.items():
+                if v[1] <= min_coverage:
+                    Contigs2Drop.append(k)
+            status('Found {:,} contigs with coverage less than {:.2f}X ({:}%)'.
+                                format(len(Contigs2Drop), min_coverage, args.mincovpct))
+
     if args.debug:
-        print('Contigs dropped due to coverage: {:,}'.format(','.join(Contigs2Drop)))
-        print('Contigs dropped due to taxonomy: {:,}'.format(','.join(Tax2Drop)))
+        print('Contigs dropped due to coverage: {:}'.format(','.join(Contigs2Drop)))
+        print('Contigs dropped due to taxonomy: {:}'.format(','.join(Tax2Drop)))
         
     DropFinal = Contigs2Drop + Tax2Drop
     DropFinal = set(DropFinal)
     status('Dropping {:,} total contigs based on taxonomy and coverage'.format(len(DropFinal)))
-    with open(args.outfile, 'w') as outfile, open(sourTax, 'rU') as seqin:
+    with open(args.outfile, 'w') as outfile, open(sourTax, 'r') as seqin:
         for record in SeqIO.parse(seqin, 'fasta'):
             if not record.id in DropFinal:
                 SeqIO.write(record, outfile, 'fasta')
                     
+    if covJob and args.align_cache:
+        # later stages may reuse the alignments while they have no other
+        # contigs removed than these
+        aligncache.store(args.align_cache, os.path.join(args.workdir, 'remapped.bam'),
+                         [forReads, revReads], os.path.join(args.workdir, assembly_working),
+                         dropped=DropFinal)
     numSeqs, assemblySize = fastastats(args.outfile)
+    record_contigs('kept', numSeqs)
+    record_contigs('removed', len(DropFinal))
     status('Sourpurged assembly is {:,} contigs and {:,} bp'.
                 format(numSeqs, assemblySize))
     if '_' in args.outfile:
@@ -0,0 +1,80 @@
+# SQLite cache of sourpurge contig taxonomy classifications
+# entries are keyed by the contig sequence hash, the checksum of the
+# sourmash LCA database and the sketch k/scaled so re-running sourpurge
+# only needs to classify contigs which are new or have changed
+
+import os
+import json
+import sqlite3
+from AAFTF.utility import file_checksum
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS taxonomy (
+    seqhash TEXT NOT NULL,
+    dbsum TEXT NOT NULL,
+    ksize INTEGER NOT NULL,
+    scaled INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    lineage TEXT NOT NULL,
+    PRIMARY KEY (seqhash, dbsum, ksize, scaled)
+);
+CREATE TABLE IF NOT EXISTS databases (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+'''
+
+class TaxonomyCache(object):
+    def __init__(self, filename, dbfile, ksize=31, scaled=1000):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.conn.executescript(SCHEMA)
+        self.ksize = ksize
+        self.scaled = scaled
+        self.dbsum = self.database_checksum(dbfile)
+
+    def database_checksum(self, dbfile):
+        '''
+        checksum of the LCA database, the multi-GB file is only hashed
+        again when its size or modification time changes
+        '''
+        dbfile = os.path.abspath(dbfile)
+        st = os.stat(dbfile)
+        row = self.conn.execute('SELECT size, mtime, sha256 FROM databases WHERE path = ?',
+                                (dbfile,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        checksum = file_checksum(dbfile)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO databases VALUES (?, ?, ?, ?)',
+                              (dbfile, st.st_size, st.st_mtime, checksum))
+        return checksum
+
+    def lookup(self, seqhashes):
+        '''
+        return dictionary of seqhash: (status, lineage) for cached hashes
+        '''
+        found = {}
+        seqhashes = list(set(seqhashes))
+        for i in range(0, len(seqhashes), 500):
+            chunk = seqhashes[i:i+500]
+            query = ('SELECT seqhash, status, lineage FROM taxonomy WHERE dbsum = ? AND ksize = ? '
+                     'AND scaled = ? AND seqhash IN ({:})'.format(','.join('?'*len(chunk))))
+            for seqhash, result, lineage in self.conn.execute(query,
+                    [self.dbsum, self.ksize, self.scaled] + chunk):
+                found[seqhash] = (result, json.loads(lineage))
+        return found
+
+    def store(self, results):
+        '''
+        results is dictionary of seqhash: (status, lineage)
+        '''
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?, ?, ?)',
+                [(k, self.dbsum, self.ksize, self.scaled, v[0], json.dumps(v[1]))
+                 for k, v in results.items()])
+
+    def close(self):
+        self.conn.close()
@@ -2,15 +2,17 @@
 # using trimmomatic or other specific trimmer (when written)
 # attemps to remove vector and primer sequences
 
-import sys, os, subprocess
+import sys, os
 from os.path import dirname
 from AAFTF.utility import which_path
 from AAFTF.utility import status
+from AAFTF.utility import run_traced
 from AAFTF.utility import printCMD
 from AAFTF.utility import Fzip_inplace
 from AAFTF.utility import SafeRemove
 from AAFTF.utility import getRAM
 from AAFTF.utility import countfastq
+from AAFTF.metrics import record_reads
 
 # process trimming reads with trimmomatic
 # Homebrew install of trimmomatic uses a shell script
@@ -23,7 +25,7 @@ exec java  -jar /usr/local/Cellar/trimmomatic/0.36/libexec/trimmomatic-0.36.jar
 def find_trimmomatic():
     trim_path = which_path('trimmomatic')
     if trim_path:
-        with open(os.path.abspath(which_path('trimmomatic')), 'rU') as trim_shell:
+        with open(os.path.abspath(which_path('trimmomatic')), 'r') as trim_shell:
             firstLine = trim_shell.readline()
             if '#!/bin/bash' in firstLine: #then homebrew do routine to get jar location
                 for line in trim_shell:         
@@ -53,6 +55,7 @@ def run(parser,args):
     if args.right:
         total = total*2
     status('Loading {:,} total reads'.format(total))
+    record_reads('in', total)
             
     DEVNULL = open(os.devnull, 'w')
     if args.method == 'bbduk':
@@ -73,14 +76,15 @@ def run(parser,args):
         
         printCMD(cmd)
         if args.debug:
-            subprocess.run(cmd)
+            run_traced(cmd)
         else:
-            subprocess.run(cmd, stderr=DEVNULL)
+            run_traced(cmd, stderr=DEVNULL)
 
         if args.right:
             clean = countfastq('{:}_1P.fastq.gz'.format(args.basename))
             clean = clean*2
             status('{:,} reads remaining and writing to file'.format(clean))
+            record_reads('out', clean)
             status('Trimming finished:\n\tFor: {:}\n\tRev {:}'.format(
                         args.basename+'_1P.fastq.gz',
                         args.basename+'_2P.fastq.gz'))
@@ -90,6 +94,7 @@ def run(parser,args):
         else:
             clean = countfastq('{:}_1U.fastq.gz'.format(args.basename))
             status('{:,} reads remaining and writing to file'.format(clean))
+            record_reads('out', clean)
             status('Trimming finished:\n\tSingle: {:}'.format(
                         args.basename+'_1U.fastq.gz'))
             if not args.pipe:
@@ -167,9 +172,9 @@ def run(parser,args):
             status('Running trimmomatic adapter and quality trimming')
             printCMD(cmd)
             if args.debug:
-                subprocess.run(cmd)
+                run_traced(cmd)
             else:
-                subprocess.run(cmd, stderr=DEVNULL)
+                run_traced(cmd, stderr=DEVNULL)
             if args.right:
                 status('Compressing trimmed PE FASTQ files')
                 Fzip_inplace(args.basename+'_1P.fastq', args.cpus)
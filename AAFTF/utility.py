@@ -1,9 +1,16 @@
 import os
 import subprocess
-from Bio.SeqIO.FastaIO import SimpleFastaParser
 import shutil
 import textwrap
 import datetime
+import hashlib
+import threading
+import contextvars
+import time
+import json
+import tempfile
+import contextlib
+from functools import lru_cache
 
 def checkfile(input):
     def _getSize(filename):
@@ -21,18 +28,52 @@ def checkfile(input):
     else:
         return False
 
+def meminfo(field):
+    '''
+    value of field in /proc/meminfo in GB, None if not available
+    '''
+    if os.path.isfile('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as infile:
+            for line in infile:
+                if line.startswith(field+':'):
+                    return int(line.split()[1]) / (1024. * 1024.)
+    return None
+
 def getRAM():
-    import resource
+    '''
+    total system memory in GB
+    '''
+    mem = meminfo('MemTotal')
+    if mem:
+        return mem
     import sys
-    rusage_denom = 1024.
     if sys.platform == 'darwin':
-        # ... it seems that in OSX the output is different units ...
-        rusage_denom = rusage_denom * rusage_denom
-    mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
-    return mem
+        try:
+            return int(subprocess.check_output(['sysctl', '-n', 'hw.memsize'])) / (1024.**3)
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return 4.
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.**3)
+    except (ValueError, OSError, AttributeError):
+        return 4.
+
+def getMemAvailable():
+    '''
+    memory available for new processes in GB, from /proc/meminfo when
+    present otherwise total system memory
+    '''
+    mem = meminfo('MemAvailable')
+    if mem:
+        return mem
+    return getRAM()
 
 def which_path(file_name):
-    for path in os.environ["PATH"].split(os.pathsep):
+    return _which_path(file_name, os.environ["PATH"])
+
+# tools are looked up many times per run, cached for each PATH
+@lru_cache(maxsize=None)
+def _which_path(file_name, search):
+    for path in search.split(os.pathsep):
         full_path = os.path.join(path, file_name)
         if os.path.exists(full_path) and os.access(full_path, os.X_OK):
             return full_path
@@ -47,16 +88,17 @@ def line_count(fname):
 
 def countfasta(input):
     count = 0
-    with open(input, 'rU') as f:
+    with open(input, 'r') as f:
         for line in f:
             if line.startswith (">"):
                 count += 1
     return count
 
 def fastastats(input):
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
     count = 0
     length = 0
-    with open(input, 'rU') as f:
+    with open(input, 'r') as f:
         for Header, Seq in SimpleFastaParser(f):
             count += 1
             length += len(Seq)
@@ -67,6 +109,58 @@ def countfastq(input):
     count = int(lines) // 4
     return count
     
+def seq_hash(seq):
+    '''
+    hash of a sequence, case insensitive so soft-masking does not matter
+    '''
+    return hashlib.sha1(seq.upper().encode('utf-8')).hexdigest()
+
+def fasta_hashes(input):
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    Hashes = {}
+    with open(input, 'r') as f:
+        for Header, Seq in SimpleFastaParser(f):
+            Hashes[Header] = seq_hash(Seq)
+    return Hashes
+
+def file_checksum(input, blocksize=1024*1024):
+    sha = hashlib.sha256()
+    with open(input, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def atomic_write(filename, text):
+    '''
+    write text to filename through a unique temporary file in the same
+    folder, so readers and other writers never see a partial file
+    '''
+    folder = os.path.dirname(filename) or '.'
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.'+os.path.basename(filename)+'.')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+@contextlib.contextmanager
+def file_lock(filename):
+    '''
+    exclusive lock on filename, created if missing, for read-modify-write
+    of files shared by threads and processes
+    '''
+    import fcntl
+    with open(filename, 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
 def softwrap(string, every=80):
     lines = []
     for i in range(0, len(string), every):
@@ -95,19 +189,349 @@ def calcN50(lengths, num=0.5):
             n50 = n
     return n50
 
+# status messages of the current thread can be copied to a log file and
+# labelled, batch mode runs each sample's stages in separate threads. A
+# context variable rather than a thread local, so that submit_in_context
+# can hand it on to threads a stage starts itself
+_status_log = contextvars.ContextVar('status_log', default={})
+
+def set_status_log(handle=None, label=None, stage=None):
+    _status_log.set({'handle': handle, 'label': label, 'stage': stage})
+
+def stage_labels():
+    '''
+    (sample, stage) of the status log of this thread
+    '''
+    current = _status_log.get()
+    return current.get('label'), current.get('stage')
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    '''
+    executor.submit running fn with the status log, sample and stage of
+    the calling thread, pool threads otherwise start without them
+    '''
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# structured event log, status messages, commands, external processes and
+# stages are events written as JSON lines when an event log is open, the
+# terminal output is rendered from the same events
+_events = {'handle': None, 'lock': threading.Lock()}
+
+def open_event_log(filename):
+    _events['handle'] = open(filename, 'a')
+
+def close_event_log():
+    with _events['lock']:
+        if _events['handle']:
+            _events['handle'].close()
+        _events['handle'] = None
+
+def emit(event, **fields):
+    '''
+    record an event, labelled with the sample and stage of this thread,
+    returns the event dictionary
+    '''
+    record = {'time': round(time.time(), 3), 'event': event}
+    for key in ['label', 'stage']:
+        value = _status_log.get().get(key)
+        if value:
+            record['sample' if key == 'label' else key] = value
+    record.update(fields)
+    with _events['lock']:
+        if _events['handle']:
+            _events['handle'].write(json.dumps(record, default=str)+'\n')
+            _events['handle'].flush()
+    return record
+
+def render(record, color=True):
+    '''
+    human readable line of a status, command or failed process event,
+    None for events that are not shown
+    '''
+    green, cyan, end = ('\033[92m', '\033[96m', '\033[00m') if color else ('', '', '')
+    timestamp = datetime.datetime.fromtimestamp(record['time']).strftime('%b %d %I:%M %p')
+    label = '[{:}] '.format(record['sample']) if record.get('sample') and color else ''
+    if record['event'] == 'status':
+        return '{:}[{:}]{:} {:}{:}'.format(green, timestamp, end, label, record['message'])
+    elif record['event'] == 'command':
+        stringcmd = ' '.join(record['argv'])
+        if not color:
+            return 'CMD: '+stringcmd
+        wrapper = textwrap.TextWrapper(initial_indent='{:}CMD:{:} {:}'.format(cyan, end, label), width=80,
+                                       subsequent_indent=' '*8, break_long_words=False)
+        return wrapper.fill(stringcmd)
+    elif record['event'] == 'process' and record['returncode']:
+        message = '{:} exited with code {:} after {:.1f} seconds'.format(
+                os.path.basename(record['argv'][0]), record['returncode'], record['seconds'])
+        if record.get('stderr_tail'):
+            message += ', last lines of stderr:\n'+'\n'.join(record['stderr_tail'])
+        return '{:}[{:}]{:} {:}{:}'.format(green, timestamp, end, label, message)
+    return None
+
+def show(record):
+    line = render(record)
+    if line is None:
+        return
+    handle = _status_log.get().get('handle')
+    if handle:
+        handle.write(render(record, color=False)+'\n')
+        handle.flush()
+    print(line)
+
 def printCMD(cmd):
-    stringcmd = '{:}'.format(' '.join(cmd))
-    prefix = '\033[96mCMD:\033[00m '
-    wrapper = textwrap.TextWrapper(initial_indent=prefix, width=80, subsequent_indent=' '*8, break_long_words=False)
-    print(wrapper.fill(stringcmd))
+    show(emit('command', argv=[str(x) for x in cmd]))
 
 def status(string):
-    print('\033[92m[{:}]\033[00m {:}'.format(datetime.datetime.now().strftime('%b %d %I:%M %p'), string))
+    show(emit('status', message=string))
+
+def is_devnull(handle):
+    return handle is subprocess.DEVNULL or getattr(handle, 'name', None) == os.devnull
+
+# running TracedPopen processes and the (sample, stage) that started them,
+# a stage's processes may be started by worker threads of its own
+_running = {}
+_running_lock = threading.Lock()
+
+def stage_processes(label, stage):
+    '''
+    pids of the running traced processes started in stage of sample
+    label, from whichever thread
+    '''
+    with _running_lock:
+        return [p for p, info in _running.items() if info == (label, stage)]
+
+class TracedPopen(subprocess.Popen):
+    '''
+    subprocess.Popen that emits a process event with its argv, start, end,
+    exit code, duration and the tail of its stderr once it is waited for.
+    stderr sent to DEVNULL is captured to a temporary file for the tail,
+    stderr sent to a file is read back from it
+    '''
+    tail_lines = 20
+
+    def __init__(self, args, **kwargs):
+        self._traced = None
+        self._stderr_file = None
+        self._stderr_name = None
+        stderr = kwargs.get('stderr')
+        if is_devnull(stderr):
+            self._stderr_file = tempfile.TemporaryFile()
+            kwargs['stderr'] = self._stderr_file
+        elif stderr is not None and hasattr(stderr, 'fileno') and isinstance(getattr(stderr, 'name', None), str):
+            self._stderr_name = stderr.name
+        self._start = time.time()
+        self._argv = [str(x) for x in args] if isinstance(args, (list, tuple)) else [str(args)]
+        self._cwd = kwargs.get('cwd')
+        self._stage_info = stage_labels()
+        subprocess.Popen.__init__(self, args, **kwargs)
+        if self._stage_info[1]:
+            with _running_lock:
+                _running[self.pid] = self._stage_info
+
+    @property
+    def returncode(self):
+        return self._traced
+
+    @returncode.setter
+    def returncode(self, value):
+        self._traced = value
+        if value is not None and getattr(self, '_start', None) is not None:
+            start, self._start = self._start, None
+            self._finished(start, value)
+
+    def _stderr_tail(self):
+        '''
+        last lines of the stderr capture, only its end is read
+        '''
+        data = b''
+        try:
+            if self._stderr_file:
+                self._stderr_file.seek(0, os.SEEK_END)
+                self._stderr_file.seek(max(0, self._stderr_file.tell() - 65536))
+                data = self._stderr_file.read()
+                self._stderr_file.close()
+            elif self._stderr_name and os.path.isfile(self._stderr_name):
+                with open(self._stderr_name, 'rb') as infile:
+                    infile.seek(max(0, os.path.getsize(self._stderr_name) - 65536))
+                    data = infile.read()
+        except (IOError, OSError, ValueError):
+            pass
+        lines = [x.rstrip() for x in data.decode('utf-8', 'replace').splitlines() if x.strip()]
+        return lines[-self.tail_lines:]
+
+    def _finished(self, start, returncode):
+        end = time.time()
+        with _running_lock:
+            _running.pop(self.pid, None)
+        fields = {'argv': self._argv, 'pid': self.pid, 'cwd': self._cwd,
+                  'start': round(start, 3), 'end': round(end, 3),
+                  'seconds': round(end - start, 3), 'returncode': returncode,
+                  'stderr_tail': self._stderr_tail()}
+        # may be reaped from another thread, label with the starting one
+        label, stage = self._stage_info
+        if label:
+            fields['sample'] = label
+        if stage:
+            fields['stage'] = stage
+        show(emit('process', **fields))
+
+def run_traced(cmd, **kwargs):
+    '''
+    subprocess.run using TracedPopen, returns CompletedProcess
+    '''
+    with TracedPopen(cmd, **kwargs) as proc:
+        stdout, stderr = proc.communicate()
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def thread_children(tid):
+    '''
+    pids of the processes started by thread tid of this process
+    '''
+    try:
+        with open('/proc/self/task/{:}/children'.format(tid), 'r') as infile:
+            return [int(x) for x in infile.read().split()]
+    except (IOError, OSError, ValueError):
+        return []
+
+def process_tree(pid):
+    '''
+    list of pid (or list of pids) and all of their descendants from /proc
+    '''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', entry, 'stat'), 'r') as infile:
+                ppid = int(infile.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    if isinstance(pid, list):
+        tree = list(pid)
+    else:
+        tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend(children.get(tree[i], []))
+        i += 1
+    return tree
+
+def process_usage(pid):
+    '''
+    resident memory in bytes and cpu seconds (including reaped children)
+    of a process from /proc, (0, 0) if it has exited
+    '''
+    try:
+        with open(os.path.join('/proc', str(pid), 'statm'), 'r') as infile:
+            rss = int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        with open(os.path.join('/proc', str(pid), 'stat'), 'r') as infile:
+            fields = infile.read().rsplit(')', 1)[1].split()
+        ticks = sum([int(x) for x in fields[11:15]])
+        return rss, ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return 0, 0
+
+def process_io(path):
+    '''
+    bytes read and written to storage from an io file in /proc, for a
+    process (/proc/pid/io) or a thread (/proc/self/task/tid/io)
+    '''
+    io = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open(path, 'r') as infile:
+            for line in infile:
+                key, value = line.split(':')
+                if key in io:
+                    io[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+def process_info(pid):
+    '''
+    start time, command, own cpu seconds and io of a process, None if it
+    has exited
+    '''
+    try:
+        with open(os.path.join('/proc', str(pid), 'stat'), 'r') as infile:
+            fields = infile.read().rsplit(')', 1)[1].split()
+        with open(os.path.join('/proc', str(pid), 'cmdline'), 'rb') as infile:
+            command = infile.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    info = {'start': int(fields[19]), 'command': command,
+            'cpu_seconds': sum([int(x) for x in fields[11:13]]) / float(os.sysconf('SC_CLK_TCK'))}
+    info.update(process_io(os.path.join('/proc', str(pid), 'io')))
+    return info
+
+class ProcessSampler(threading.Thread):
+    '''
+    background thread recording RSS and cpu time of a process tree,
+    samples are (seconds since start, rss bytes, cpu seconds, processes).
+    With thread, the trees of the processes started by that thread (native
+    id) are sampled instead of pid, and with stage, a (sample, stage)
+    tuple, also those of the traced processes started in that stage by
+    other threads. Every process seen is kept in processes with its peak
+    RSS and last seen cpu time and io
+    '''
+    def __init__(self, pid=None, interval=2.0, thread=None, stage=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.thread = thread
+        self.stage = stage
+        self.interval = interval
+        self.samples = []
+        self.processes = {}
+        self.peak_rss = 0
+        self.cpu = 0
+        self.start_time = time.time()
+        self._done = threading.Event()
+
+    def sample(self):
+        if not os.path.isdir('/proc'):
+            return
+        if self.thread or self.stage:
+            roots = set(thread_children(self.thread)) if self.thread else set()
+            if self.stage:
+                roots.update(stage_processes(*self.stage))
+            if not roots:
+                return
+            roots = sorted(roots)
+        else:
+            roots = self.pid
+        rss, cpu, procs = 0, 0, 0
+        for p in set(process_tree(roots)):
+            r, c = process_usage(p)
+            if r:
+                procs += 1
+            rss += r
+            cpu += c
+            info = process_info(p)
+            if info:
+                seen = self.processes.setdefault((p, info['start']), {'pid': p, 'peak_rss_bytes': 0})
+                seen.update(info)
+                seen['peak_rss_bytes'] = max(seen['peak_rss_bytes'], r)
+        if not procs:
+            return
+        self.peak_rss = max(self.peak_rss, rss)
+        self.cpu = max(self.cpu, cpu)
+        self.samples.append((round(time.time() - self.start_time, 1), rss, round(cpu, 2), procs))
+
+    def run(self):
+        self.sample()
+        while not self._done.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._done.set()
+        self.join()
 
 #from https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running
 def execute(cmd, dir):
     DEVNULL = open(os.devnull, 'w')
-    popen = subprocess.Popen(cmd, cwd=dir, stdout=subprocess.PIPE, universal_newlines=True, stderr=DEVNULL)
+    popen = TracedPopen(cmd, cwd=dir, stdout=subprocess.PIPE, universal_newlines=True, stderr=DEVNULL)
     for stdout_line in iter(popen.stdout.readline, ""):
         yield stdout_line 
     popen.stdout.close()
@@ -126,7 +550,7 @@ def Fzip_inplace(input, cpus):
     try:
         runSubprocess(cmd, '.', log)
     except NameError:
-        subprocess.call(cmd)
+        run_traced(cmd)
 
 def SafeRemove(input):
     if os.path.isdir(input):
@@ -138,7 +562,10 @@ def SafeRemove(input):
         
 #streaming parallel pigz open via https://github.com/DarkoVeberic/utl/blob/master/futile/futile.py 
 def which(program):
-    import os
+    return _which(program, os.environ["PATH"])
+
+@lru_cache(maxsize=None)
+def _which(program, search):
     def is_exe(fpath):
         return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
     fpath, fname = os.path.split(program)
@@ -146,7 +573,7 @@ def which(program):
         if is_exe(program):
             return program
     else:
-        for path in os.environ["PATH"].split(os.pathsep):
+        for path in search.split(os.pathsep):
             path = path.strip('"')
             exe_file = os.path.join(path, program)
             if is_exe(exe_file):
@@ -169,22 +596,20 @@ def open_pipe(command, mode='r', buff=1024*1024):
 NORMAL = 0
 PROCESS = 1
 PARALLEL = 2
-WHICH_GZIP = which("gzip")
-WHICH_PIGZ = which("pigz")
 
 def open_gz(filename, mode='r', buff=1024*1024, external=PARALLEL):
     if external == None or external == NORMAL:
         import gzip
         return gzip.GzipFile(filename, mode, buff)
     elif external == PROCESS:
-        if not WHICH_GZIP:
+        if not which("gzip"):
             return open_gz(filename, mode, buff, NORMAL)
         if 'r' in mode:
             return open_pipe("gzip -dc " + filename, mode, buff)
         elif 'w' in mode:
             return open_pipe("gzip >" + filename, mode, buff)
     elif external == PARALLEL:
-        if not WHICH_PIGZ:
+        if not which("pigz"):
             return open_gz(filename, mode, buff, PROCESS)
         if 'r' in mode:
             return open_pipe("pigz -dc " + filename, mode, buff)
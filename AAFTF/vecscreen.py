@@ -11,16 +11,18 @@
 import sys, csv, re, operator, os, gzip
 import shutil
 
-from subprocess import call, Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT
 
 import urllib.request
 from AAFTF.resources import SeqDBs
 from AAFTF.resources import DB_Links
 from AAFTF.utility import status
+from AAFTF.utility import run_traced
 from AAFTF.utility import printCMD
 from AAFTF.utility import softwrap
 from AAFTF.utility import countfasta
 from AAFTF.utility import SafeRemove
+from AAFTF.metrics import record_contigs
 
 # biopython needed
 from Bio import SeqIO
@@ -54,10 +56,11 @@ def group(lst, n):
         if len(val) == n:
             yield tuple(val)
 
-def parse_clean_blastn(fastafile, prefix, blastn, stringent):
+def parse_clean_blastn(fastafile, prefix, blastn, stringent, contigs_to_remove={}):
     '''
     Blast header rows:
     qaccver saccver pident length mismatch gapopen qstart qend sstart send evalue score qlen
+    hits to contigs in contigs_to_remove are skipped
     '''
 
     cleaned = prefix + ".clean.fsa"
@@ -181,15 +184,17 @@ def make_blastdb(type,file,name):
     if not os.path.exists(indexfile) or os.path.getctime(indexfile) < os.path.getctime(file):
         cmd = ['makeblastdb','-dbtype',type,'-in',file,'-out',name]
         printCMD(cmd)
-        call(cmd, stdout=DEVNULL, stderr=DEVNULL)
+        run_traced(cmd, stdout=DEVNULL, stderr=DEVNULL)
 
         
-def run(parser,args):
-    if not args.workdir:
-        args.workdir = 'aaftf-vecscreen_'+str(os.getpid())
+def prepare_blastdbs(args):
+    '''
+    download the contaminant libraries and build the BLAST databases
+    in the workdir, existing up to date databases are kept
+    '''
     if not os.path.exists(args.workdir):
-        os.mkdir(args.workdir)
-    
+        os.makedirs(args.workdir)
+
     #parse database locations
     DB = None
     if not args.AAFTF_DB:
@@ -203,23 +208,6 @@ def run(parser,args):
     else:
         DB = args.AAFTF_DB
     
-    if args.percent_id:
-        percentid_cutoff = args.percent_id
-
-    infile = args.infile
-    outfile = os.path.basename(args.outfile)
-    outdir = os.path.dirname(args.outfile)
-    if '.f' in outfile:
-        prefix = outfile.rsplit('.f', 1)[0]
-        print("prefix is ",prefix)
-    else:
-        prefix = str(os.getpid())
-    if not outfile:
-        outfile = "%s.vecscreen.fasta" % prefix
-
-    outfile_vec = os.path.join(args.workdir,
-                               "%s.tmp_vecscreen.fasta" % (prefix))
-
     # Common Euk/Prot contaminats for blastable DB later on
     status('Building BLAST databases for contamination screen.')
     makeblastdblist = []
@@ -249,8 +237,32 @@ def run(parser,args):
             if not os.path.exists(file):
                 urllib.request.urlretrieve(url,file)
             make_blastdb('nucl',file,os.path.join(args.workdir,d))
+
+def run(parser,args):
+    if not args.workdir:
+        args.workdir = 'aaftf-vecscreen_'+str(os.getpid())
+    if not os.path.exists(args.workdir):
+        os.mkdir(args.workdir)
     
-    global contigs_to_remove
+    if args.percent_id:
+        percentid_cutoff = args.percent_id
+
+    infile = args.infile
+    outfile = os.path.basename(args.outfile)
+    outdir = os.path.dirname(args.outfile)
+    if '.f' in outfile:
+        prefix = outfile.rsplit('.f', 1)[0]
+        print("prefix is ",prefix)
+    else:
+        prefix = str(os.getpid())
+    if not outfile:
+        outfile = "%s.vecscreen.fasta" % prefix
+
+    outfile_vec = os.path.join(args.workdir,
+                               "%s.tmp_vecscreen.fasta" % (prefix))
+
+    prepare_blastdbs(args)
+
     contigs_to_remove = {}
     regions_to_trim = {}
     
@@ -267,7 +279,7 @@ def run(parser,args):
                       '-perc_identity',BlastPercent_ID_ContamMatch,
                       '-lcase_masking', '-outfmt', '6', '-out',blastreport]
         printCMD(blastnargs)
-        call(blastnargs)
+        run_traced(blastnargs)
         hits = 0
         with open(blastreport) as report:
             colparser = csv.reader(report, delimiter="\t")
@@ -293,7 +305,7 @@ def run(parser,args):
     eukCleaned = os.path.join(args.workdir, "%s.euk-prot_cleaned.fasta" % (prefix))
     if len(regions_to_trim) > 0:
         with open(eukCleaned, 'w') as cleanout:
-            with open(infile, 'rU') as fastain:
+            with open(infile, 'r') as fastain:
                 for record in SeqIO.parse(fastain, 'fasta'):
                     if not record.id in regions_to_trim:
                         cleanout.write('>{:}\n{:}\n'.format(record.id, softwrap(str(record.seq))))
@@ -327,7 +339,7 @@ def run(parser,args):
                   '-lcase_masking', '-outfmt','6',
                   '-out', blastreport]
     printCMD(blastnargs)
-    call(blastnargs)
+    run_traced(blastnargs)
     with open(blastreport) as report:
         colparser = csv.reader(report, delimiter="\t")
         for row in colparser:
@@ -353,10 +365,10 @@ def run(parser,args):
                   '-num_threads',str(args.cpus),
                   '-query', eukCleaned, '-out', report]
             #logger.info('CMD: {:}'.format(printCMD(cmd,7)))
-            call(cmd)
+            run_traced(cmd)
         # this needs to know/return the new fasta file?
         status("Parsing VecScreen round {:}: {:} for {:}".format(rnd+1, filepref,report))
-        (count, cleanfile) = parse_clean_blastn(eukCleaned, os.path.join(args.workdir,filepref),report, args.stringency)
+        (count, cleanfile) = parse_clean_blastn(eukCleaned, os.path.join(args.workdir,filepref),report, args.stringency, contigs_to_remove)
         status("count is %d cleanfile is %s"%(count, cleanfile))
         if count == 0: # if there are no vector matches < than the pid cutoff
             status("copying %s to %s"%(eukCleaned, outfile_vec))
@@ -379,7 +391,10 @@ def run(parser,args):
                 SeqIO.write(record, output_handle, "fasta")
             elif record.id in mitoHits:
                 SeqIO.write(record, mito_handle, "fasta")
-    status('Writing {:,} cleaned contigs to: {:}'.format(countfasta(args.outfile), args.outfile))
+    kept = countfasta(args.outfile)
+    record_contigs('kept', kept)
+    record_contigs('removed', len(contigs_to_remove))
+    status('Writing {:,} cleaned contigs to: {:}'.format(kept, args.outfile))
     status('Writing {:,} mitochondrial contigs to: {:}'.format(countfasta(mitochondria), mitochondria))
     if '_' in args.outfile:
         nextOut = args.outfile.split('_')[0]+'.sourpurge.fasta'
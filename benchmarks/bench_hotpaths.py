@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# benchmarks of the python hot paths of AAFTF on synthetic data
+# each benchmark runs on data sets of increasing size made by synthetic.py
+# with a fixed seed. The best wall time of --repeat runs and the peak
+# python memory of one run under tracemalloc are reported, and each
+# result is checked against what was planted in the data. Results can be
+# saved with --output and compared with an earlier run with --compare,
+# exits 1 when a check fails or a result regressed past --threshold.
+#
+# python benchmarks/bench_hotpaths.py [--sizes 500,2000] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from argparse import Namespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from AAFTF.utility import countfastq
+from AAFTF.utility import fastastats
+from AAFTF.utility import calcN50
+from AAFTF.version import __version__
+
+# differences smaller than these are noise, not regressions
+NOISE_SECONDS = 0.01
+NOISE_BYTES = 256*1024
+
+def read_fasta(filename):
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+    with open(filename, 'r') as infile:
+        return {h: s for h, s in SimpleFastaParser(infile)}
+
+def bench_countfastq(data, workdir):
+    def run():
+        return countfastq(data['files']['left'])
+    def check(result):
+        return result == data['pairs']
+    return run, check
+
+def bench_fastastats(data, workdir):
+    def run():
+        return fastastats(data['files']['assembly'])
+    def check(result):
+        return result[0] == data['params']['contigs']
+    return run, check
+
+def bench_calcN50(data, workdir):
+    lengths = [len(x) for x in read_fasta(data['files']['assembly']).values()]
+    def run():
+        return calcN50(list(lengths)), calcN50(list(lengths), num=0.9)
+    def check(result):
+        return min(lengths) <= result[1] <= result[0] <= max(lengths)
+    return run, check
+
+def bench_sort(data, workdir):
+    import AAFTF.sort as aaftf_sort
+    out = os.path.join(workdir, 'sorted.fasta')
+    def run():
+        aaftf_sort.run(None, Namespace(input=data['files']['assembly'], out=out, name='scaffold'))
+        return out
+    def check(result):
+        lengths = [len(x) for x in read_fasta(result).values()]
+        return lengths == sorted(lengths, reverse=True) and len(lengths) == data['params']['contigs']
+    return run, check
+
+def bench_assess(data, workdir):
+    import AAFTF.assess as assess
+    def run():
+        return assess.genome_asm_stats(data['files']['assembly'], None)
+    def check(result):
+        return result['contigs'] == data['params']['contigs']
+    return run, check
+
+def bench_parse_clean_blastn(data, workdir):
+    import AAFTF.vecscreen as vecscreen
+    prefix = os.path.join(workdir, 'vecscreen')
+    def run():
+        return vecscreen.parse_clean_blastn(data['files']['assembly'], prefix, data['files']['blastn'], 'high', {})
+    def check(result):
+        # no planted vector end survives
+        piece = data['vector'][:30]
+        cleaned = read_fasta(result[1])
+        for name, (end, length) in data['vectors'].items():
+            seq = cleaned.get(name)
+            if seq and (seq.startswith(piece) or seq.endswith(data['vector'][length-30:length])):
+                return False
+        return result[0] >= len(data['vectors'])
+    return run, check
+
+def bench_sam_coverage(data, workdir):
+    import AAFTF.sourpurge as sourpurge
+    lengths = {k: len(v) for k, v in read_fasta(data['files']['assembly']).items()}
+    def run():
+        with open(data['files']['sam'], 'r') as samfile:
+            return sourpurge.sam_coverage(samfile, lengths)
+    def check(result):
+        low = set(data['low_coverage'])
+        lowCov = [v[1] for k, v in result.items() if k in low]
+        otherCov = [v[1] for k, v in result.items() if not k in low]
+        return sum(lowCov) / max(1, len(lowCov)) < sum(otherCov) / max(1, len(otherCov))
+    return run, check
+
+def bench_rmdup_decision(data, workdir):
+    import AAFTF.rmdup as rmdup
+    queries = {}
+    with open(data['files']['paf'], 'r') as infile:
+        for line in infile:
+            queries.setdefault(line.split('\t', 1)[0], []).append(line)
+    def run():
+        return set([q for q, lines in queries.items() if rmdup.duplicated(lines, 95, 95)])
+    def check(result):
+        return result == set(data['duplicates'])
+    return run, check
+
+BENCHMARKS = [('countfastq', bench_countfastq),
+              ('fastastats', bench_fastastats),
+              ('calcN50', bench_calcN50),
+              ('sort', bench_sort),
+              ('assess', bench_assess),
+              ('parse_clean_blastn', bench_parse_clean_blastn),
+              ('sam_coverage', bench_sam_coverage),
+              ('rmdup_decision', bench_rmdup_decision)]
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            yield
+
+def measure(run, repeat):
+    '''
+    best wall time of repeat runs, peak traced memory of one more run and
+    the result of the last run
+    '''
+    times = []
+    with quiet():
+        for i in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            result = run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), peak, result
+
+def compare(results, baseline, threshold):
+    '''
+    ratios of each result to the same benchmark and size in baseline,
+    returns the regressions past threshold
+    '''
+    previous = {(x['size'], x['benchmark']): x for x in baseline['results']}
+    regressions = []
+    print('\n{:<8}{:<22}{:>10}{:>10}'.format('size', 'benchmark', 'time', 'memory'))
+    for x in results:
+        old = previous.get((x['size'], x['benchmark']))
+        if not old:
+            continue
+        timeRatio = x['seconds'] / max(old['seconds'], 1e-6)
+        memRatio = x['peak_bytes'] / max(old['peak_bytes'], 1)
+        print('{:<8}{:<22}{:>9.2f}x{:>9.2f}x'.format(x['size'], x['benchmark'], timeRatio, memRatio))
+        if timeRatio > threshold and x['seconds'] - old['seconds'] > NOISE_SECONDS:
+            regressions.append('{:} at {:} contigs is {:.2f}x slower'.format(x['benchmark'], x['size'], timeRatio))
+        if memRatio > threshold and x['peak_bytes'] - old['peak_bytes'] > NOISE_BYTES:
+            regressions.append('{:} at {:} contigs uses {:.2f}x the memory'.format(x['benchmark'], x['size'], memRatio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='AAFTF hot path benchmarks on synthetic data',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', default='500,2000', help='Comma separated numbers of contigs, 50 read pairs per contig')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic data')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark')
+    parser.add_argument('--only', help='Comma separated benchmarks to run, default all')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'aaftf-bench'),
+                        help='Folder for the synthetic data, reused between runs')
+    parser.add_argument('-o', '--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Ratio of time or memory to --compare counted as a regression')
+    args = parser.parse_args()
+
+    selected = BENCHMARKS
+    if args.only:
+        names = args.only.split(',')
+        selected = [x for x in BENCHMARKS if x[0] in names]
+    results = []
+    print('{:<8}{:<22}{:>10}{:>12}  {:}'.format('size', 'benchmark', 'seconds', 'peak MB', 'check'))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        folder = os.path.join(args.workdir, '{:}-seed{:}'.format(size, args.seed))
+        data = synthetic.generate(folder, contigs=size, seed=args.seed)
+        for name, bench in selected:
+            run, check = bench(data, folder)
+            seconds, peak, result = measure(run, args.repeat)
+            ok = bool(check(result))
+            results.append({'size': size, 'benchmark': name, 'seconds': round(seconds, 4),
+                            'peak_bytes': peak, 'ok': ok})
+            print('{:<8}{:<22}{:>10.4f}{:>12.1f}  {:}'.format(size, name, seconds, peak / 1024**2,
+                                                             'ok' if ok else 'FAIL'))
+            sys.stdout.flush()
+
+    failed = ['{:} at {:} contigs gave a wrong result'.format(x['benchmark'], x['size']) for x in results if not x['ok']]
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            failed += compare(results, json.load(infile), args.threshold)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump({'aaftf': __version__, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'seed': args.seed, 'repeat': args.repeat,
+                       'results': results}, outfile, indent=2)
+    for x in failed:
+        print('FAIL: '+x)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# startup time of the AAFTF command line
+# workflow managers call AAFTF thousands of times, so --version, --help
+# and argument errors should not pay for Biopython, numpy or the stage
+# modules. Each command is run --runs times in a fresh interpreter, the
+# median time over a bare python start is compared with --budget and the
+# modules that must stay deferred are checked. Exits 1 when over budget.
+#
+# python benchmarks/bench_startup.py [--runs 20] [--budget 0.1]
+
+import os
+import sys
+import time
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [('version', ['-m', 'AAFTF.AAFTF_main', '--version']),
+            ('help', ['-m', 'AAFTF.AAFTF_main', '--help']),
+            ('pipeline help', ['-m', 'AAFTF.AAFTF_main', 'pipeline', '--help']),
+            ('argument error', ['-m', 'AAFTF.AAFTF_main', 'assess'])]
+
+# imported by the entry point or the pipeline these would be loaded on
+# every call, the stages import them when they run
+DEFERRED = ['Bio', 'numpy', 'AAFTF.trim', 'AAFTF.filter', 'AAFTF.assemble', 'AAFTF.vecscreen',
+            'AAFTF.sourpurge', 'AAFTF.rmdup', 'AAFTF.pilon', 'AAFTF.assess', 'AAFTF.sort']
+CHECKS = [('AAFTF.AAFTF_main', DEFERRED + ['AAFTF.pipeline', 'AAFTF.pyprofile']),
+          ('AAFTF.pipeline', DEFERRED)]
+
+def timed(args, runs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [x for x in [env.get('PYTHONPATH')] if x])
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, env=env, cwd=ROOT)
+        times.append(time.perf_counter() - start)
+    return times
+
+def loaded_modules(module, deferred):
+    '''
+    modules from deferred that importing module loads
+    '''
+    code = 'import sys, json, {:}; print(json.dumps(sorted(sys.modules)))'.format(module)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [x for x in [env.get('PYTHONPATH')] if x])
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                         universal_newlines=True, env=env, cwd=ROOT, check=True).stdout
+    modules = json.loads(out)
+    return [x for x in deferred if x in modules or any(m.startswith(x+'.') for m in modules)]
+
+def main():
+    parser = argparse.ArgumentParser(description='AAFTF command line startup benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20, help='Runs of each command')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='Seconds allowed over a bare python start for the median run')
+    args = parser.parse_args()
+
+    base = statistics.median(timed(['-c', 'pass'], args.runs))
+    print('{:<16}{:>10}{:>10}{:>10}'.format('command', 'median', 'max', 'overhead'))
+    print('{:<16}{:>10.3f}'.format('python', base))
+    failed = []
+    for name, cmd in COMMANDS:
+        times = timed(cmd, args.runs)
+        median = statistics.median(times)
+        print('{:<16}{:>10.3f}{:>10.3f}{:>10.3f}'.format(name, median, max(times), median - base))
+        if median - base > args.budget:
+            failed.append('{:} took {:.3f}s over python, budget {:.3f}s'.format(name, median - base, args.budget))
+    for module, deferred in CHECKS:
+        early = loaded_modules(module, deferred)
+        if early:
+            failed.append('importing {:} loads {:}'.format(module, ', '.join(early)))
+    for x in failed:
+        print('FAIL: '+x)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
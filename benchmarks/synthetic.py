@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# seeded synthetic data for the AAFTF benchmarks
+# an assembly with SPAdes style contig names and log-normal lengths, with
+# planted duplicate contigs (near identical copies of part of a larger
+# contig), contigs with vector sequence at one end and low coverage
+# contigs. From the same random state come paired FASTQ reads, the SAM
+# alignments of those reads to their contigs, a vecscreen blastn table
+# and minimap2 PAF lines of contigs against the rest of the assembly. What
+# was planted is written to truth.json so benchmarks can check results.
+#
+# python benchmarks/synthetic.py -o DIR [--contigs 2000] [--seed 1]
+
+import os
+import sys
+import gzip
+import json
+import random
+import argparse
+
+BASES = 'ACGT'
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+# fraction of contigs planted as duplicates, with vector ends and with low coverage
+DUPLICATES = 0.05
+VECTORS = 0.03
+LOW_COVERAGE = 0.05
+
+def random_seq(rng, length):
+    return ''.join(rng.choices(BASES, k=length))
+
+def mutate(rng, seq, rate):
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < rate:
+            seq[i] = rng.choice(BASES)
+    return ''.join(seq)
+
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def wrap(seq, every=80):
+    return '\n'.join([seq[i:i+every] for i in range(0, len(seq), every)])
+
+def contig_lengths(rng, count, median=1500, sigma=1.0, minlen=200, maxlen=200000):
+    return [min(maxlen, max(minlen, int(rng.lognormvariate(0, sigma) * median))) for x in range(count)]
+
+def make_assembly(rng, count):
+    '''
+    list of [name, sequence] and the names planted in each class
+    '''
+    lengths = contig_lengths(rng, count)
+    seqs = [random_seq(rng, x) for x in lengths]
+    order = list(range(count))
+    rng.shuffle(order)
+    nDup = int(count * DUPLICATES)
+    nVec = int(count * VECTORS)
+    nLow = int(count * LOW_COVERAGE)
+    dups = order[:nDup]
+    vecs = order[nDup:nDup+nVec]
+    lows = set(order[nDup+nVec:nDup+nVec+nLow])
+    vector = random_seq(rng, 60)
+    # duplicates are 99% identical copies of part of a longer contig
+    sources = sorted(set(range(count)) - set(dups), key=lambda x: lengths[x], reverse=True)[:max(1, count // 10)]
+    duplicateOf = {}
+    for i in dups:
+        src = rng.choice(sources)
+        length = min(lengths[i], lengths[src] - 1)
+        start = rng.randint(0, lengths[src] - length)
+        seqs[i] = mutate(rng, seqs[src][start:start+length], 0.01)
+        if rng.random() < 0.5:
+            seqs[i] = revcomp(seqs[i])
+        duplicateOf[i] = (src, start)
+    vectorEnds = {}
+    for i in vecs:
+        piece = vector[:rng.randint(30, 60)]
+        if rng.random() < 0.5:
+            seqs[i] = piece + seqs[i]
+            vectorEnds[i] = ('5', len(piece))
+        else:
+            seqs[i] = seqs[i] + piece
+            vectorEnds[i] = ('3', len(piece))
+    names = []
+    for i, s in enumerate(seqs):
+        cov = rng.uniform(1, 4) if i in lows else rng.uniform(20, 60)
+        names.append('NODE_{:}_length_{:}_cov_{:.3f}'.format(i+1, len(s), cov))
+    contigs = [[names[i], seqs[i]] for i in range(count)]
+    truth = {'duplicates': {names[i]: names[src] for i, (src, start) in duplicateOf.items()},
+             'vectors': {names[i]: v for i, v in vectorEnds.items()},
+             'low_coverage': sorted([names[i] for i in lows]),
+             'vector': vector}
+    return contigs, truth
+
+def write_fasta(filename, contigs):
+    with open(filename, 'w') as outfile:
+        for name, seq in contigs:
+            outfile.write('>{:}\n{:}\n'.format(name, wrap(seq)))
+
+def write_reads(rng, prefix, contigs, truth, pairs, read_length=150, insert=350, error=0.005):
+    '''
+    paired reads sampled by contig length, low coverage contigs 1/20th as
+    often, and the SAM lines of each pair at its true position
+    '''
+    low = set(truth['low_coverage'])
+    weights = [len(s) * (0.05 if n in low else 1.0) for n, s in contigs]
+    picks = rng.choices(range(len(contigs)), weights=weights, k=pairs)
+    quality = 'I' * read_length
+    with gzip.open(prefix+'_R1.fastq.gz', 'wt', compresslevel=1) as r1, \
+            gzip.open(prefix+'_R2.fastq.gz', 'wt', compresslevel=1) as r2, \
+            open(prefix+'.sam', 'w') as sam:
+        sam.write('@HD\tVN:1.6\tSO:unsorted\n')
+        for name, seq in contigs:
+            sam.write('@SQ\tSN:{:}\tLN:{:}\n'.format(name, len(seq)))
+        for n, c in enumerate(picks):
+            name, seq = contigs[c]
+            fragment = min(insert, len(seq))
+            start = rng.randint(0, len(seq) - fragment)
+            length = min(read_length, fragment)
+            left = mutate(rng, seq[start:start+length], error)
+            rightStart = start + fragment - length
+            right = revcomp(mutate(rng, seq[rightStart:rightStart+length], error))
+            read = 'read{:}'.format(n+1)
+            r1.write('@{:}/1\n{:}\n+\n{:}\n'.format(read, left, quality[:length]))
+            r2.write('@{:}/2\n{:}\n+\n{:}\n'.format(read, right, quality[:length]))
+            roll = rng.random()
+            if roll < 0.02:
+                # unmapped pair
+                sam.write('{:}\t77\t*\t0\t0\t*\t*\t0\t0\t{:}\t*\n'.format(read, left))
+                sam.write('{:}\t141\t*\t0\t0\t*\t*\t0\t0\t{:}\t*\n'.format(read, right))
+                continue
+            clip = rng.randint(5, 30) if roll > 0.9 else 0
+            cigar = '{:}S{:}M'.format(clip, length - clip) if clip else '{:}M'.format(length)
+            sam.write('{:}\t99\t{:}\t{:}\t60\t{:}\t=\t{:}\t{:}\t{:}\t*\n'.format(
+                read, name, start + clip + 1, cigar, rightStart + 1, fragment, left))
+            sam.write('{:}\t147\t{:}\t{:}\t60\t{:}M\t=\t{:}\t{:}\t{:}\t*\n'.format(
+                read, name, rightStart + 1, length, start + 1, -fragment, right))
+            if roll < 0.04:
+                other = contigs[rng.randrange(len(contigs))]
+                sam.write('{:}\t355\t{:}\t1\t0\t{:}M\t=\t1\t0\t{:}\t*\n'.format(read, other[0], length, left))
+
+def write_blastn(rng, filename, contigs, truth):
+    '''
+    vecscreen blastn rows: strong terminal hits for the vector contigs,
+    a few strong internal hits that split contigs and weak hits that are
+    ignored
+    '''
+    lengths = dict(contigs)
+    with open(filename, 'w') as outfile:
+        def row(q, qstart, qend, score):
+            length = qend - qstart + 1
+            outfile.write('\t'.join(map(str, [q, 'gnl|uv|SYNTH:1-60', 100.0, length, 0, 0, qstart, qend,
+                                               1, length, 1e-10, round(score * 1.98, 1), score,
+                                               len(lengths[q])]))+'\n')
+        for q, (end, length) in sorted(truth['vectors'].items()):
+            if end == '5':
+                row(q, 1, length, length)
+            else:
+                row(q, len(lengths[q]) - length + 1, len(lengths[q]), length)
+        for name, seq in contigs:
+            if len(seq) < 2000 or name in truth['vectors']:
+                continue
+            roll = rng.random()
+            if roll < 0.01:
+                start = rng.randint(500, len(seq) - 500)
+                row(name, start, start + 39, 40)
+            elif roll < 0.1:
+                start = rng.randint(500, len(seq) - 500)
+                row(name, start, start + 19, 20)
+
+def write_paf(rng, filename, contigs, truth):
+    '''
+    minimap2 PAF lines of contigs against the rest of the assembly, full
+    length near identical hits for the duplicates, partial or divergent
+    hits for others
+    '''
+    lengths = {n: len(s) for n, s in contigs}
+    names = [n for n, s in contigs]
+    with open(filename, 'w') as outfile:
+        def line(q, t, qstart, qend, identity):
+            aln = qend - qstart
+            outfile.write('\t'.join(map(str, [q, lengths[q], qstart, qend, '+', t, lengths[t], 0, aln,
+                                               int(aln * identity), aln, 60, 'tp:A:P']))+'\n')
+        for name in names:
+            hits = []
+            if name in truth['duplicates']:
+                hits.append((truth['duplicates'][name], 0, lengths[name], rng.uniform(0.97, 0.995)))
+            for x in range(rng.randint(0, 4)):
+                t = rng.choice(names)
+                qend = rng.randint(1, lengths[name])
+                qstart = rng.randint(0, qend - 1)
+                hits.append((t, qstart, qend, rng.uniform(0.8, 0.94)))
+            rng.shuffle(hits)
+            for t, qstart, qend, identity in hits:
+                line(name, t, qstart, qend, identity)
+
+def generate(outdir, contigs=2000, pairs=None, seed=1):
+    '''
+    write the synthetic data set to outdir, reused when the same one is
+    already there, returns the dictionary of files and planted contigs
+    '''
+    if pairs is None:
+        pairs = contigs * 50
+    params = {'contigs': contigs, 'pairs': pairs, 'seed': seed}
+    truthFile = os.path.join(outdir, 'truth.json')
+    if os.path.isfile(truthFile):
+        with open(truthFile, 'r') as infile:
+            truth = json.load(infile)
+        if truth['params'] == params:
+            return truth
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    rng = random.Random(seed)
+    assembly, truth = make_assembly(rng, contigs)
+    files = {'assembly': os.path.join(outdir, 'assembly.fasta'),
+             'left': os.path.join(outdir, 'reads_R1.fastq.gz'),
+             'right': os.path.join(outdir, 'reads_R2.fastq.gz'),
+             'sam': os.path.join(outdir, 'reads.sam'),
+             'blastn': os.path.join(outdir, 'vecscreen.blastn.tsv'),
+             'paf': os.path.join(outdir, 'rmdup.paf')}
+    write_fasta(files['assembly'], assembly)
+    write_reads(rng, os.path.join(outdir, 'reads'), assembly, truth, pairs)
+    write_blastn(rng, files['blastn'], assembly, truth)
+    write_paf(rng, files['paf'], assembly, truth)
+    truth['params'] = params
+    truth['files'] = files
+    truth['pairs'] = pairs
+    with open(truthFile, 'w') as outfile:
+        json.dump(truth, outfile, indent=2)
+    return truth
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a seeded synthetic assembly and reads',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--outdir', required=True, help='Output folder')
+    parser.add_argument('--contigs', type=int, default=2000, help='Number of contigs')
+    parser.add_argument('--pairs', type=int, help='Read pairs, default 50 per contig')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+    truth = generate(args.outdir, contigs=args.contigs, pairs=args.pairs, seed=args.seed)
+    for k, v in sorted(truth['files'].items()):
+        sys.stdout.write('{:}\t{:}\n'.format(k, v))
+
+if __name__ == '__main__':
+    main()
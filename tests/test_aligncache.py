@@ -0,0 +1,96 @@
+import os
+import sys
+
+import AAFTF.aligncache as aligncache
+
+# stands in for samtools: view -h prints a SAM, view -b writes part of
+# its input to -o and fails when FAIL is set, index writes a .bai
+FAKE_SAMTOOLS = '''#!{python}
+import os, sys
+args = sys.argv[1:]
+if args[0] == 'index':
+    open(args[1]+'.bai', 'w').close()
+elif '-h' in args:
+    sys.stdout.write(open(args[-1]).read())
+else:
+    out = args[args.index('-o')+1]
+    with open(out, 'w') as outfile:
+        outfile.write(sys.stdin.readline())
+    sys.stdin.read()
+    sys.exit(1 if os.environ.get('FAIL') else 0)
+'''
+
+SAM = '@SQ\tSN:c1\tLN:8\nr1\t0\tc1\t1\t60\t4M\t*\t0\t0\tACGT\t*\n'
+
+def setup_cache(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    fake = bindir / 'samtools'
+    fake.write_text(FAKE_SAMTOOLS.format(python=sys.executable))
+    fake.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    with open('assembly.fasta', 'w') as outfile:
+        outfile.write('>c1\nACGTACGT\n')
+    with open('aligned.bam', 'w') as outfile:
+        outfile.write(SAM)
+    open('aligned.bam.bai', 'w').close()
+    # relative, as the pipeline passes it
+    aligncache.store('sample.aligncache', 'aligned.bam', ['reads.fq'], 'assembly.fasta')
+    os.mkdir('work')
+
+def test_lookup_is_absolute(tmp_path, monkeypatch):
+    setup_cache(tmp_path, monkeypatch)
+    cached = aligncache.lookup('sample.aligncache', ['reads.fq'], 'assembly.fasta')
+    assert os.path.isabs(cached) and os.path.isfile(cached)
+    # no temporary files left behind
+    assert not [x for x in os.listdir('sample.aligncache') if x.startswith('.')]
+
+def test_reuse_relative_cache(tmp_path, monkeypatch):
+    setup_cache(tmp_path, monkeypatch)
+    assert aligncache.reuse('sample.aligncache', ['reads.fq'], 'assembly.fasta', 'pilon.bam', 'work')
+    assert os.path.isfile('work/pilon.bam')
+
+def test_reuse_failure_removes_partial_bam(tmp_path, monkeypatch):
+    setup_cache(tmp_path, monkeypatch)
+    monkeypatch.setenv('FAIL', '1')
+    assert not aligncache.reuse('sample.aligncache', ['reads.fq'], 'assembly.fasta', 'pilon.bam', 'work')
+    assert not os.path.exists('work/pilon.bam')
+
+def two_contigs(tmp_path, monkeypatch, dropped):
+    setup_cache(tmp_path, monkeypatch)
+    with open('full.fasta', 'w') as outfile:
+        outfile.write('>c1\nACGTACGT\n>c2 dup\nTTTTGGGG\n')
+    aligncache.store('full.aligncache', 'aligned.bam', ['reads.fq'], 'full.fasta', dropped=dropped)
+
+def test_reuse_without_stage_drops(tmp_path, monkeypatch):
+    two_contigs(tmp_path, monkeypatch, ['c2 dup'])
+    assert aligncache.lookup('full.aligncache', ['reads.fq'], 'assembly.fasta')
+
+def test_no_reuse_without_other_contigs(tmp_path, monkeypatch):
+    # reads on c2 would align to c1 if c2 was a removed duplicate
+    two_contigs(tmp_path, monkeypatch, [])
+    assert aligncache.lookup('full.aligncache', ['reads.fq'], 'assembly.fasta') is None
+    assert aligncache.lookup('full.aligncache', ['reads.fq'], 'full.fasta')
+
+def test_concurrent_stores(tmp_path, monkeypatch):
+    import threading
+    setup_cache(tmp_path, monkeypatch)
+    errors = []
+    def store(n):
+        try:
+            with open('assembly{:}.fasta'.format(n), 'w') as outfile:
+                outfile.write('>c{:}\nACGTACGT\n'.format(n))
+            for i in range(10):
+                aligncache.store('shared.aligncache', 'aligned.bam', ['reads.fq'], 'assembly{:}.fasta'.format(n))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=store, args=(n,)) for n in range(6)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    assert errors == []
+    assert len(aligncache.load_manifest('shared.aligncache')) == 6
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+from argparse import Namespace
+
+import AAFTF.assemble as assemble
+
+# stands in for megahit: records its arguments and writes one contig
+FAKE_MEGAHIT = '''#!{python}
+import os, sys
+with open(os.environ['MEGAHIT_ARGS'], 'a') as outfile:
+    outfile.write(' '.join(sys.argv[1:])+'\\n')
+out = sys.argv[sys.argv.index('-o')+1]
+if '--continue' not in sys.argv:
+    if os.path.isdir(out):
+        sys.exit('output folder exists')
+    os.makedirs(out)
+with open(os.path.join(out, 'checkpoints.txt'), 'w') as outfile:
+    outfile.write('done\\n')
+with open(os.path.join(out, 'final.contigs.fa'), 'w') as outfile:
+    outfile.write('>k21_1\\nACGTACGTACGT\\n')
+'''
+
+def setup(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    exe = bindir / 'megahit'
+    exe.write_text(FAKE_MEGAHIT.format(python=sys.executable))
+    exe.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir)+os.pathsep+os.environ['PATH'])
+    monkeypatch.setenv('MEGAHIT_ARGS', str(tmp_path / 'calls.txt'))
+    monkeypatch.chdir(tmp_path)
+
+def assemble_args(reads):
+    return Namespace(method='megahit', workdir='megahit', left=reads, right=None,
+                     out='megahit.fasta', cpus=1, memory='1', spades_tmpdir=None,
+                     kmers=None, debug=False, pipe=True)
+
+def calls(tmp_path):
+    return (tmp_path / 'calls.txt').read_text().splitlines()
+
+def test_resume_same_inputs(tmp_path, monkeypatch):
+    setup(tmp_path, monkeypatch)
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    assemble.run(None, assemble_args('reads.fq'))
+    assemble.run(None, assemble_args('reads.fq'))
+    first, second = calls(tmp_path)
+    assert '--continue' not in first
+    assert '--continue' in second
+
+def test_no_checkpoint_starts_over(tmp_path, monkeypatch):
+    setup(tmp_path, monkeypatch)
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    assemble.run(None, assemble_args('reads.fq'))
+    # killed before the first checkpoint
+    os.remove('megahit/checkpoints.txt')
+    os.remove('megahit/final.contigs.fa')
+    assemble.run(None, assemble_args('reads.fq'))
+    first, second = calls(tmp_path)
+    assert '--continue' not in second
+    assert os.path.isfile('megahit/final.contigs.fa')
+
+def test_changed_inputs_start_over(tmp_path, monkeypatch):
+    setup(tmp_path, monkeypatch)
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    assemble.run(None, assemble_args('reads.fq'))
+    with open('megahit/stale.txt', 'w') as outfile:
+        outfile.write('from the first run\n')
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r2\nTTTT\n+\nIIII\n')
+    assemble.run(None, assemble_args('reads.fq'))
+    first, second = calls(tmp_path)
+    assert '--continue' not in second
+    assert not os.path.exists('megahit/stale.txt')
+    with open('megahit.inputs.json') as infile:
+        assert json.load(infile) == assemble.input_signature(assemble.ENGINES['megahit'],
+                                                             assemble_args('reads.fq'),
+                                                             [os.path.abspath('reads.fq')])
+
+def test_profile_is_of_the_assembler(tmp_path, monkeypatch):
+    import subprocess
+    setup(tmp_path, monkeypatch)
+    with open('reads.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    # an earlier, larger child of the same process
+    subprocess.run([sys.executable, '-c', 'x = bytearray(300*1024*1024)'], check=True)
+    assemble.run(None, assemble_args('reads.fq'))
+    with open('megahit.assembly-profile.json') as infile:
+        profile = json.load(infile)
+    assert profile['process_wide_rusage']['children_maxrss_bytes'] >= 300*1024*1024
+    assert profile['peak_rss_bytes'] < 100*1024*1024
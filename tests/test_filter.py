@@ -0,0 +1,107 @@
+import os
+import json
+import urllib.error
+
+import pytest
+
+import AAFTF.filter as aaftf_filter
+
+
+def test_fetch_accessions_failed_batch(tmp_path, monkeypatch):
+    calls = []
+    def fetch(batch, url):
+        calls.append(batch)
+        if 'BAD1' in batch:
+            raise urllib.error.HTTPError(url, 500, 'server error', None, None)
+        return {acc: '>{:}.1\nACGT\n'.format(acc) for acc in batch}
+    monkeypatch.setattr(aaftf_filter, 'fetch_accession_batch', fetch)
+    monkeypatch.setattr(aaftf_filter, 'RETRY_WAIT', 0)
+    cache = str(tmp_path / 'cache')
+    # screening without a requested contaminant is an error
+    with pytest.raises(SystemExit):
+        aaftf_filter.fetch_accessions(['NC_1', 'NC_2', 'BAD1', 'NC_3'], cache,
+                                      'https://example.org/%s', batch_size=1, threads=2)
+    assert calls.count(['BAD1']) == 3
+    # the accessions that did download are kept in the cache
+    with open(os.path.join(cache, 'manifest.json')) as infile:
+        manifest = json.load(infile)
+    assert sorted(manifest) == ['NC_1', 'NC_2', 'NC_3']
+
+def test_concurrent_manifest_saves(tmp_path):
+    import threading
+    cache = str(tmp_path)
+    errors = []
+    def save(n):
+        try:
+            for i in range(50):
+                aaftf_filter.save_accession_manifest(cache, {'acc{:}_{:}'.format(n, i): {'file': 'x.fna'}})
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=save, args=(n,)) for n in range(6)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    assert errors == []
+    assert len(aaftf_filter.load_accession_manifest(cache)) == 300
+    assert sorted(os.listdir(cache)) == ['manifest.json', 'manifest.json.lock']
+
+
+class EfetchServer(object):
+    '''
+    efetch stand-in on localhost, returns a versioned FASTA record for
+    every id asked for and fails the first request for any id in flaky
+    '''
+    def __init__(self, flaky=()):
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from urllib.parse import urlparse, parse_qs
+        self.requests = []
+        self.flaky = set(flaky)
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                ids = parse_qs(urlparse(self.path).query)['id'][0].split(',')
+                server.requests.append(ids)
+                if server.flaky.intersection(ids):
+                    server.flaky.difference_update(ids)
+                    self.send_error(503)
+                    return
+                body = ''.join(['>{:}.1 synthetic\nACGT{:}\n'.format(x, 'A'*n) for n, x in enumerate(ids)])
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+            def log_message(self, format, *args):
+                pass
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{:}/efetch.fcgi?db=nucleotide&id=%s&rettype=fasta'.format(
+            self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def test_fetch_accessions_from_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(aaftf_filter, 'RETRY_WAIT', 0)
+    server = EfetchServer(flaky=['NC_5'])
+    try:
+        cache = str(tmp_path / 'cache')
+        accessions = ['NC_{:}'.format(x) for x in range(1, 6)]
+        found = aaftf_filter.fetch_accessions(accessions, cache, server.url, batch_size=2, threads=2)
+        assert sorted(found) == accessions
+        # 3 batches and the retry of the one that failed
+        assert sorted([len(x) for x in server.requests]) == [1, 1, 2, 2]
+        with open(found['NC_1']) as infile:
+            assert infile.read() == '>NC_1.1 synthetic\nACGT\n'
+        manifest = aaftf_filter.load_accession_manifest(cache)
+        assert sorted(manifest) == accessions
+        for acc, path in found.items():
+            assert os.path.basename(path) == manifest[acc]['file']
+        # cached accessions are not downloaded again
+        del server.requests[:]
+        again = aaftf_filter.fetch_accessions(accessions+['NC_9'], cache, server.url, batch_size=2)
+        assert server.requests == [['NC_9']]
+        assert all(again[x] == found[x] for x in accessions)
+    finally:
+        server.close()
@@ -0,0 +1,71 @@
+import gzip
+import random
+
+import numpy
+
+import AAFTF.kmers as kmers
+
+def naive_canonical(seq, k):
+    encode = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+    result = []
+    for i in range(len(seq) - k + 1):
+        kmer = seq[i:i+k]
+        if any(x not in encode for x in kmer):
+            continue
+        rc = ''.join(complement[x] for x in reversed(kmer))
+        codes = [sum(encode[x] << 2*(k-1-j) for j, x in enumerate(y)) for y in [kmer, rc]]
+        result.append(min(codes))
+    return result
+
+def test_canonical_kmers():
+    rng = random.Random(3)
+    seq = ''.join(rng.choices('ACGT', k=200)) + 'N' + ''.join(rng.choices('acgt', k=50))
+    for k in [5, 21, 31]:
+        assert kmers.canonical_kmers(seq.encode(), k).tolist() == naive_canonical(seq.upper(), k)
+
+def test_reverse_complement_same_kmers():
+    rng = random.Random(4)
+    seq = ''.join(rng.choices('ACGT', k=500))
+    rc = seq.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+    fwd = kmers.canonical_kmers(seq.encode(), 21)
+    rev = kmers.canonical_kmers(rc.encode(), 21)
+    assert sorted(fwd.tolist()) == sorted(rev.tolist())
+
+def test_merge_counts():
+    parts = [(numpy.array([1, 5, 9], dtype=numpy.uint64), numpy.array([1, 2, 3])),
+             (numpy.array([2, 5], dtype=numpy.uint64), numpy.array([4, 5])),
+             (numpy.array([], dtype=numpy.uint64), numpy.array([], dtype=numpy.int64)),
+             (numpy.array([9], dtype=numpy.uint64), numpy.array([6]))]
+    keys, counts = kmers.merge_counts(parts)
+    assert keys.tolist() == [1, 2, 5, 9]
+    assert counts.tolist() == [1, 4, 7, 9]
+
+def write_reads(filename, genome, pairs, rng, length=100, error=0.002):
+    with gzip.open(filename, 'wt') as outfile:
+        for n in range(pairs):
+            start = rng.randint(0, len(genome) - length)
+            read = list(genome[start:start+length])
+            for i in range(length):
+                if rng.random() < error:
+                    read[i] = rng.choice('ACGT')
+            read = ''.join(read)
+            if rng.random() < 0.5:
+                read = read.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+            outfile.write('@r{:}\n{:}\n+\n{:}\n'.format(n, read, 'I'*length))
+
+def test_genome_size_estimate(tmp_path):
+    rng = random.Random(5)
+    size = 200000
+    genome = ''.join(rng.choices('ACGT', k=size))
+    reads = str(tmp_path / 'reads.fq.gz')
+    # 40X in reads of 100, 32X k-mer coverage at k 21
+    write_reads(reads, genome, size * 40 // 100, rng)
+    # small batches so the counts are merged many times
+    hist, nreads, nbases = kmers.count_kmers([reads], k=21, sample=4, batch=64*1024)
+    whole, _, _ = kmers.count_kmers([reads], k=21, sample=4, batch=1024**3)
+    assert hist.tolist() == whole.tolist()
+    result = kmers.estimate(hist, 21, 100, sample=4)
+    assert abs(result['genome_size'] - size) < 0.1 * size
+    assert 28 <= result['kmer_coverage'] <= 36
+    assert 35 <= result['coverage'] <= 45
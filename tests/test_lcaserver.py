@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import random
+import subprocess
+import threading
+from argparse import Namespace
+
+import pytest
+
+import AAFTF.lcaserver as lcaserver
+
+TAXONOMY = '''ident,superkingdom,phylum,class,order,family,genus,species
+g1,Bacteria,Proteobacteria,Gammaproteobacteria,Enterobacterales,Enterobacteriaceae,Escherichia,Escherichia coli
+g2,Eukaryota,Ascomycota,Eurotiomycetes,Eurotiales,Aspergillaceae,Aspergillus,Aspergillus niger
+g3,Bacteria,Firmicutes,Bacilli,Bacillales,Bacillaceae,Bacillus,Bacillus subtilis
+'''
+
+def sourmash(*args, **kwargs):
+    return subprocess.run([sys.executable, '-m', 'sourmash', '-q'] + list(args), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          universal_newlines=True, **kwargs).stdout
+
+@pytest.fixture
+def tiny_db(tmp_path):
+    '''
+    LCA database of three random genomes and contig signatures of parts of
+    two of them plus one unrelated contig
+    '''
+    pytest.importorskip('sourmash')
+    rng = random.Random(1)
+    genomes = {}
+    for name in ['g1', 'g2', 'g3']:
+        genomes[name] = ''.join(rng.choices('ACGT', k=20000))
+        with open(str(tmp_path / (name+'.fa')), 'w') as outfile:
+            outfile.write('>{:}\n{:}\n'.format(name, genomes[name]))
+        sourmash('sketch', 'dna', '-p', 'k=31,scaled=100', '--name', name, name+'.fa',
+                 '-o', name+'.sig', cwd=str(tmp_path))
+    with open(str(tmp_path / 'taxonomy.csv'), 'w') as outfile:
+        outfile.write(TAXONOMY)
+    sourmash('lca', 'index', 'taxonomy.csv', 'db.lca.json', 'g1.sig', 'g2.sig', 'g3.sig',
+             '--scaled', '100', cwd=str(tmp_path))
+    with open(str(tmp_path / 'contigs.fa'), 'w') as outfile:
+        outfile.write('>c1\n{:}\n>c2\n{:}\n>c3\n{:}\n'.format(
+            genomes['g1'][:8000], genomes['g2'][5000:15000], ''.join(rng.choices('ACGT', k=8000))))
+    sourmash('sketch', 'dna', '-p', 'k=31,scaled=100', '--singleton', 'contigs.fa',
+             '-o', 'contigs.sig', cwd=str(tmp_path))
+    return tmp_path
+
+def test_server_matches_lca_classify(tiny_db):
+    db = str(tiny_db / 'db.lca.json')
+    query = str(tiny_db / 'contigs.sig')
+    sock = str(tiny_db / 'lca.sock')
+    server = threading.Thread(target=lcaserver.run, daemon=True,
+                              args=(None, Namespace(socket=sock, shutdown=False, sourdb=db, AAFTF_DB=None)))
+    server.start()
+    try:
+        for i in range(300):
+            if lcaserver.service_running(sock):
+                break
+            time.sleep(0.1)
+        assert lcaserver.service_running(sock)
+        remote = ''.join(lcaserver.classify_remote(sock, query))
+    finally:
+        lcaserver.run(None, Namespace(socket=sock, shutdown=True))
+        server.join(10)
+    expected = sourmash('lca', 'classify', '--db', db, '--query', query)
+    assert remote == expected
+    # the database does classify the planted contigs
+    assert 'c1,found,Bacteria' in remote and 'c2,found,Eukaryota' in remote
+    assert not server.is_alive()
+    assert not os.path.exists(sock)
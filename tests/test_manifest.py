@@ -0,0 +1,80 @@
+from AAFTF.manifest import Manifest
+from AAFTF.scheduler import Scheduler, Task
+
+def pipeline(tmp_path, runs, params={}):
+    '''
+    source -> a -> b -> c, every task copies its input with its name and
+    params added and counts its runs
+    '''
+    def step(name, src, dest):
+        def run():
+            runs.append(name)
+            with open(src) as infile:
+                text = infile.read()
+            with open(dest, 'w') as outfile:
+                outfile.write(text+name+''.join([' {:}={:}'.format(k, v) for k, v in
+                                                  sorted(params.get(name, {}).items())])+'\n')
+        return run
+    files = {x: str(tmp_path / (x+'.txt')) for x in ['source', 'a', 'b', 'c']}
+    scheduler = Scheduler(2, 2, manifest=Manifest(str(tmp_path / 'manifest.json')))
+    for name, src in [('a', 'source'), ('b', 'a'), ('c', 'b')]:
+        scheduler.add(Task(name, step(name, files[src], files[name]), inputs=[files[src]],
+                           outputs=[files[name]], params=params.get(name, {})))
+    return scheduler, files
+
+def setup_source(tmp_path, text='reads\n'):
+    with open(str(tmp_path / 'source.txt'), 'w') as outfile:
+        outfile.write(text)
+
+def test_up_to_date_skipped(tmp_path):
+    setup_source(tmp_path)
+    runs = []
+    pipeline(tmp_path, runs)[0].run()
+    assert runs == ['a', 'b', 'c']
+    runs = []
+    scheduler = pipeline(tmp_path, runs)[0]
+    scheduler.run()
+    assert runs == []
+    assert all(scheduler.state[x][0] == 'skipped' for x in 'abc')
+
+def test_changed_param_reruns_downstream(tmp_path):
+    setup_source(tmp_path)
+    pipeline(tmp_path, [], params={'b': {'minlen': 500}})[0].run()
+    runs = []
+    pipeline(tmp_path, runs, params={'b': {'minlen': 1000}})[0].run()
+    # b's output changed, so c reruns too, a is untouched
+    assert runs == ['b', 'c']
+
+def test_changed_input_reruns_everything(tmp_path):
+    setup_source(tmp_path)
+    pipeline(tmp_path, [])[0].run()
+    setup_source(tmp_path, 'other reads\n')
+    runs = []
+    scheduler, files = pipeline(tmp_path, runs)
+    scheduler.run()
+    assert runs == ['a', 'b', 'c']
+    with open(files['c']) as infile:
+        assert infile.read() == 'other reads\na\nb\nc\n'
+
+def test_truncated_output_rebuilt(tmp_path):
+    setup_source(tmp_path)
+    files = pipeline(tmp_path, [])[1]
+    pipeline(tmp_path, [])[0].run()
+    with open(files['b'], 'r+') as outfile:
+        outfile.truncate(3)
+    runs = []
+    pipeline(tmp_path, runs)[0].run()
+    # b is rebuilt with the same content, so c is still up to date
+    assert runs == ['b']
+    with open(files['b']) as infile:
+        assert infile.read() == 'reads\na\nb\n'
+
+def test_changes_explains_rerun(tmp_path):
+    setup_source(tmp_path)
+    scheduler, files = pipeline(tmp_path, [])
+    scheduler.run()
+    setup_source(tmp_path, 'other reads\n')
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    task = [x for x in scheduler.tasks if x.name == 'a'][0]
+    assert not manifest.valid(task)
+    assert manifest.changes(task) == 'input {:} changed'.format(files['source'])
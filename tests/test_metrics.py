@@ -0,0 +1,68 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from AAFTF import utility
+from AAFTF.metrics import Metrics
+
+SLEEP = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+def test_refresh_counts_worker_thread_processes(tmp_path):
+    metrics = Metrics(textfile=str(tmp_path / 'aaftf.prom'), interval=3600)
+    rss = []
+    def stage():
+        utility.set_status_log(None, 'sample1', 'sourpurge')
+        metrics.start_stage('sourpurge', 'sample1')
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                proc = utility.submit_in_context(executor, utility.TracedPopen, SLEEP).result()
+            try:
+                metrics.refresh()
+                key = ('aaftf_child_rss_bytes', (('sample', 'sample1'), ('stage', 'sourpurge')))
+                rss.append(metrics.values[key])
+            finally:
+                proc.kill()
+                proc.wait()
+        finally:
+            metrics.end_stage('sourpurge', 'sample1')
+            utility.set_status_log()
+    thread = threading.Thread(target=stage)
+    thread.start()
+    thread.join()
+    metrics.close()
+    assert rss[0] > 0
+
+def test_concurrent_stage_writes(tmp_path):
+    textfile = str(tmp_path / 'aaftf.prom')
+    metrics = Metrics(textfile=textfile, interval=0.001)
+    errors = []
+    def stage(n):
+        try:
+            for i in range(50):
+                metrics.start_stage('stage{:}'.format(n), 'sample1')
+                metrics.end_stage('stage{:}'.format(n), 'sample1')
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=stage, args=(n,)) for n in range(8)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+    metrics.close()
+    assert errors == []
+    with open(textfile) as infile:
+        text = infile.read()
+    for n in range(8):
+        assert 'aaftf_stage_success{{sample="sample1",stage="stage{:}"}} 1'.format(n) in text
+
+def test_metrics_errors_do_not_fail_stage(tmp_path):
+    from AAFTF.scheduler import Scheduler, Task
+    metrics = Metrics(textfile=str(tmp_path / 'missing' / 'aaftf.prom'), interval=3600)
+    out = str(tmp_path / 'out.txt')
+    def write():
+        with open(out, 'w') as outfile:
+            outfile.write('done\n')
+    scheduler = Scheduler(1, 1, metrics=metrics)
+    scheduler.add(Task('write', write, outputs=[out]))
+    scheduler.run()
+    assert scheduler.state['write'][0] == 'done'
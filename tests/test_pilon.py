@@ -0,0 +1,84 @@
+import os
+import sys
+import gzip
+from argparse import Namespace
+
+import pytest
+
+import AAFTF.pilon as pilon
+
+def write_fastq(filename, pairs, mate):
+    with gzip.open(filename, 'wt') as outfile:
+        for n in range(pairs):
+            outfile.write('@read{:}/{:}\n{:}\n+\n{:}\n'.format(n, mate, 'ACGT'*25, 'I'*100))
+
+def test_subsample_reads_relative_workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('sub1')
+    write_fastq('R1.fastq.gz', 1000, 1)
+    write_fastq('R2.fastq.gz', 1000, 2)
+    args = Namespace(workdir='sub1', max_coverage=20, seed=42)
+    # 200 kb of reads on a 2 kb assembly is 100X
+    reads = pilon.subsample_reads(args, ['R1.fastq.gz', 'R2.fastq.gz'], 2000)
+    assert len(reads) == 2
+    for x in reads:
+        # the aligner opens the reads from inside the workdir
+        assert os.path.isfile(os.path.join(args.workdir, x))
+        assert os.path.samefile(x, os.path.join('sub1', os.path.basename(x)))
+    with open(reads[0]) as r1, open(reads[1]) as r2:
+        names1 = [x.split('/')[0] for x in r1.readlines()[::4]]
+        names2 = [x.split('/')[0] for x in r2.readlines()[::4]]
+    assert names1 == names2
+    assert 0 < len(names1) < 1000
+
+# stands in for pilon: polishes the targets of a shard by appending _pilon
+# to their names, exits 1 without output when a target is named bad
+FAKE_PILON = '''#!{python}
+import sys
+opts = {{x: sys.argv[i+1] for i, x in enumerate(sys.argv[:-1]) if x.startswith('--')}}
+targets = open(opts['--targets']).read().split()
+if 'bad' in targets:
+    sys.exit(1)
+seqs, name = {{}}, None
+for line in open(opts['--genome']):
+    if line.startswith('>'):
+        name = line[1:].split()[0]
+        seqs[name] = ''
+    else:
+        seqs[name] += line.strip()
+with open(opts['--output']+'.fasta', 'w') as out:
+    for x in targets:
+        out.write('>{{}}_pilon\\n{{}}\\n'.format(x, seqs[x]))
+open(opts['--output']+'.changes', 'w').close()
+'''
+
+def fake_pilon(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    fake = bindir / 'pilon'
+    fake.write_text(FAKE_PILON.format(python=sys.executable))
+    fake.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('work')
+
+def test_run_pilon_shards(tmp_path, monkeypatch):
+    fake_pilon(tmp_path, monkeypatch)
+    with open('work/genome.fasta', 'w') as outfile:
+        outfile.write('>small\n{:}\n>large\n{:}\n>medium\n{:}\n'.format('A'*500, 'C'*2000, 'G'*1000))
+    args = Namespace(workdir='work', shards=2, memory=2, cpus=2)
+    pilon.run_pilon(args, 'genome.fasta', 'genome.bam', 'pilon1')
+    # merged back in the order of the genome
+    with open('work/pilon1.fasta') as infile:
+        names = [x[1:].strip() for x in infile if x.startswith('>')]
+    assert names == ['small_pilon', 'large_pilon', 'medium_pilon']
+
+def test_run_pilon_failed_shard(tmp_path, monkeypatch):
+    fake_pilon(tmp_path, monkeypatch)
+    with open('work/genome.fasta', 'w') as outfile:
+        outfile.write('>good\n{:}\n>bad\n{:}\n'.format('A'*1000, 'C'*1000))
+    args = Namespace(workdir='work', shards=2, memory=2, cpus=2)
+    # fails the same as a single Pilon process would
+    with pytest.raises(SystemExit):
+        pilon.run_pilon(args, 'genome.fasta', 'genome.bam', 'pilon1')
+    assert not os.path.exists('work/pilon1.fasta')
@@ -0,0 +1,65 @@
+import os
+import sys
+import stat
+from argparse import Namespace
+
+import AAFTF.rmdup as rmdup
+
+# stands in for minimap2: a full length exact hit for every query contig
+# found inside a reference contig
+FAKE_MINIMAP2 = '''#!{python}
+import sys
+def read(fasta):
+    seqs, name = {{}}, None
+    for line in open(fasta):
+        line = line.strip()
+        if line.startswith('>'):
+            name = line[1:]
+            seqs[name] = ''
+        elif name:
+            seqs[name] += line
+    return seqs
+reference, query = read(sys.argv[-2]), read(sys.argv[-1])
+for q, qseq in query.items():
+    for t, tseq in reference.items():
+        if qseq in tseq:
+            n = len(qseq)
+            print('\\t'.join(map(str, [q, n, 0, n, '+', t, len(tseq), 0, n, n, n, 60])))
+'''
+
+def write_fasta(filename, seqs):
+    with open(filename, 'w') as outfile:
+        for name, seq in seqs:
+            outfile.write('>{:}\n{:}\n'.format(name, seq))
+
+def read_names(filename):
+    with open(filename) as infile:
+        return [x[1:].strip() for x in infile if x.startswith('>')]
+
+def test_duplicated_without_debug():
+    lines = ['c1\t1000\t0\t990\t+\tc2\t5000\t0\t990\t985\t990\t60\n']
+    hit = rmdup.duplicated(lines, 95, 95)
+    assert hit[0] == 'c1' and hit[2] == 'c2'
+    assert rmdup.duplicated(lines, 95, 99.5) is None
+
+def test_run_removes_duplicates(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    fake = bindir / 'minimap2'
+    fake.write_text(FAKE_MINIMAP2.format(python=sys.executable))
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+
+    a = 'ACGT' * 1250
+    b = 'TTGCA' * 800
+    # contig_1 is part of contig_2, contig_10 is unique but its name
+    # contains contig_1
+    seqs = [('contig_2', a), ('contig_3', b), ('contig_1', a[100:1100]),
+            ('contig_10', 'GGCAT' * 240)]
+    write_fasta('assembly.fasta', seqs)
+    args = Namespace(input='assembly.fasta', out='clean.fasta', workdir='work', cpus=1,
+                     debug=False, minlen=500, percent_id=95, percent_cov=95,
+                     exhaustive=False, pipe=True)
+    rmdup.run(None, args)
+    assert read_names('clean.fasta') == ['contig_2', 'contig_3', 'contig_10']
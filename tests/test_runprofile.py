@@ -0,0 +1,25 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from AAFTF import utility
+from AAFTF.runprofile import RunProfile
+
+SLEEP = [sys.executable, '-c', 'import time; time.sleep(1.5)']
+
+def test_stage_samples_worker_thread_processes():
+    run = RunProfile(interval=0.1)
+    def stage():
+        utility.set_status_log(None, 'sample1', 'sourpurge')
+        try:
+            with run.stage('sourpurge'):
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    utility.submit_in_context(executor, utility.run_traced, SLEEP).result()
+        finally:
+            utility.set_status_log()
+    thread = threading.Thread(target=stage)
+    thread.start()
+    thread.join()
+    record = run.report()['stages'][0]
+    assert [x for x in record['processes'] if 'time.sleep' in x['command']]
+    assert record['child_peak_rss_bytes'] > 0
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+
+import pytest
+
+from AAFTF.scheduler import Scheduler, Task
+
+def writer(filename, text='done\n', seconds=0, log=None, lock=None):
+    '''
+    task writing filename, optionally recording when it ran in log
+    '''
+    def run():
+        if log is not None:
+            with lock:
+                log.append(('start', os.path.basename(filename), time.time()))
+        time.sleep(seconds)
+        with open(filename, 'w') as outfile:
+            outfile.write(text)
+        if log is not None:
+            with lock:
+                log.append(('end', os.path.basename(filename), time.time()))
+    return run
+
+def failing():
+    raise RuntimeError('task failed')
+
+def max_running(log):
+    running, peak = 0, 0
+    for event, name, when in sorted(log, key=lambda x: (x[2], x[0] == 'start')):
+        running += 1 if event == 'start' else -1
+        peak = max(peak, running)
+    return peak
+
+def test_dependency_order(tmp_path):
+    a, b, c = [str(tmp_path / x) for x in ['a.txt', 'b.txt', 'c.txt']]
+    log, lock = [], threading.Lock()
+    scheduler = Scheduler(4, 4)
+    # added out of order, the inputs decide when each runs
+    scheduler.add(Task('c', writer(c, log=log, lock=lock), inputs=[b], outputs=[c]))
+    scheduler.add(Task('b', writer(b, log=log, lock=lock), inputs=[a], outputs=[b]))
+    scheduler.add(Task('a', writer(a, seconds=0.1, log=log, lock=lock), outputs=[a]))
+    scheduler.run()
+    starts = [x[1] for x in sorted(log, key=lambda x: x[2]) if x[0] == 'start']
+    assert starts == ['a.txt', 'b.txt', 'c.txt']
+    assert all(scheduler.state[x][0] == 'done' for x in 'abc')
+
+def test_cpu_budget(tmp_path):
+    log, lock = [], threading.Lock()
+    scheduler = Scheduler(4, 100)
+    for n in range(4):
+        scheduler.add(Task('t{:}'.format(n), writer(str(tmp_path / 't{:}'.format(n)), seconds=0.2,
+                                                    log=log, lock=lock), cpus=2))
+    scheduler.run()
+    assert max_running(log) == 2
+
+def test_memory_budget(tmp_path):
+    log, lock = [], threading.Lock()
+    scheduler = Scheduler(8, 10)
+    for n in range(3):
+        scheduler.add(Task('t{:}'.format(n), writer(str(tmp_path / 't{:}'.format(n)), seconds=0.2,
+                                                    log=log, lock=lock), mem=6))
+    scheduler.run()
+    assert max_running(log) == 1
+
+def test_oversized_task_runs_alone(tmp_path):
+    out = str(tmp_path / 'big.txt')
+    scheduler = Scheduler(2, 2)
+    scheduler.add(Task('big', writer(out), outputs=[out], cpus=16, mem=64))
+    scheduler.run()
+    assert scheduler.state['big'][0] == 'done'
+
+def test_failure_exits(tmp_path):
+    out = str(tmp_path / 'after.txt')
+    scheduler = Scheduler(2, 2)
+    scheduler.add(Task('bad', failing, outputs=[str(tmp_path / 'bad.txt')]))
+    scheduler.add(Task('after', writer(out), outputs=[out], after=['bad']))
+    with pytest.raises(SystemExit):
+        scheduler.run()
+    assert scheduler.state['bad'][0] == 'failed'
+    assert scheduler.state['after'][0] == 'not run'
+    assert not os.path.exists(out)
+
+def test_keep_going_blocks_dependents(tmp_path):
+    bad, child, grandchild, other = [str(tmp_path / x) for x in ['bad', 'child', 'grandchild', 'other']]
+    scheduler = Scheduler(2, 2, keep_going=True)
+    scheduler.add(Task('bad', failing, outputs=[bad]))
+    scheduler.add(Task('child', writer(child), inputs=[bad], outputs=[child]))
+    scheduler.add(Task('grandchild', writer(grandchild), inputs=[child], outputs=[grandchild]))
+    scheduler.add(Task('other', writer(other), outputs=[other]))
+    scheduler.run()
+    assert scheduler.state['bad'][0] == 'failed'
+    assert scheduler.state['child'][0] == 'not run'
+    assert scheduler.state['grandchild'][0] == 'not run'
+    assert scheduler.state['other'][0] == 'done'
+
+def test_missing_output_fails(tmp_path):
+    scheduler = Scheduler(1, 1, keep_going=True)
+    scheduler.add(Task('lazy', lambda: None, outputs=[str(tmp_path / 'never.txt')]))
+    scheduler.run()
+    assert scheduler.state['lazy'][0] == 'failed'
+
+def test_unknown_dependency(tmp_path):
+    scheduler = Scheduler(1, 1)
+    scheduler.add(Task('a', lambda: None, after=['missing']))
+    with pytest.raises(ValueError):
+        scheduler.run()
@@ -0,0 +1,49 @@
+import os
+import sys
+from argparse import Namespace
+
+import pytest
+
+import AAFTF.sourpurge as sourpurge
+
+# stands in for bwa: index succeeds, mem writes a header and fails
+FAKE_BWA = '''#!{python}
+import sys
+if sys.argv[1] == 'mem':
+    sys.stdout.write('@SQ\\tSN:contig_1\\tLN:8\\n')
+    sys.exit(1)
+'''
+
+def test_coverage_branch_failed_alignment(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    exe = bindir / 'bwa'
+    exe.write_text(FAKE_BWA.format(python=sys.executable))
+    exe.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir)+os.pathsep+os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('work')
+    with open('work/assembly.fasta', 'w') as outfile:
+        outfile.write('>contig_1\nACGTACGT\n')
+    with open('R1.fq', 'w') as outfile:
+        outfile.write('@r1\nACGT\n+\nIIII\n')
+    args = Namespace(workdir='work', write_bam=False, align_cache=None)
+    # all contigs would otherwise look uncovered and be dropped
+    with pytest.raises(SystemExit):
+        sourpurge.coverage_branch(args, os.path.abspath('R1.fq'), None, 'assembly.fasta', 1, 1)
+
+def test_parallel_sketch_matches_serial(tmp_path):
+    import random
+    pytest.importorskip('sourmash')
+    rng = random.Random(1)
+    fasta = str(tmp_path / 'assembly.fasta')
+    with open(fasta, 'w') as outfile:
+        for n in range(6):
+            outfile.write('>contig_{:}\n{:}\n'.format(n, ''.join(rng.choices('ACGT', k=5000))))
+    serial = str(tmp_path / 'serial.sig')
+    parallel = str(tmp_path / 'parallel.sig')
+    assert sourpurge.parallel_sketch(fasta, serial, 1) == 6
+    # the pool is spawned, workers run in fresh interpreters
+    assert sourpurge.parallel_sketch(fasta, parallel, 2) == 6
+    with open(serial) as a, open(parallel) as b:
+        assert a.read() == b.read()
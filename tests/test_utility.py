@@ -0,0 +1,67 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from AAFTF import utility
+
+def in_stage(func, logfile):
+    '''
+    run func in its own thread the way the scheduler runs a stage
+    '''
+    result = []
+    def stage():
+        with open(logfile, 'a') as handle:
+            utility.set_status_log(handle, 'sample1', 'sourpurge')
+            try:
+                result.append(func())
+            finally:
+                utility.set_status_log()
+    thread = threading.Thread(target=stage)
+    thread.start()
+    thread.join()
+    return result[0]
+
+def read_events(filename):
+    with open(filename) as infile:
+        return [json.loads(x) for x in infile]
+
+def test_status_in_stage_worker_threads(tmp_path):
+    events = str(tmp_path / 'events.jsonl')
+    logfile = str(tmp_path / 'sample1.log')
+    utility.open_event_log(events)
+    try:
+        def branches():
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                jobs = [utility.submit_in_context(executor, utility.status, 'branch {:}'.format(x))
+                        for x in range(2)]
+                for x in jobs:
+                    x.result()
+        in_stage(branches, logfile)
+        utility.status('after the stage')
+    finally:
+        utility.close_event_log()
+    records = {x['message']: x for x in read_events(events)}
+    for x in ['branch 0', 'branch 1']:
+        assert records[x]['sample'] == 'sample1'
+        assert records[x]['stage'] == 'sourpurge'
+    assert 'sample' not in records['after the stage']
+    with open(logfile) as infile:
+        lines = sorted([x.split('] ', 1)[1] for x in infile.read().splitlines()])
+    assert lines == ['branch 0', 'branch 1']
+
+def test_process_events_in_stage_worker_threads(tmp_path):
+    events = str(tmp_path / 'events.jsonl')
+    utility.open_event_log(events)
+    try:
+        def branch():
+            return utility.run_traced(['true']).returncode
+        def branches():
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                return utility.submit_in_context(executor, branch).result()
+        assert in_stage(branches, str(tmp_path / 'sample1.log')) == 0
+    finally:
+        utility.close_event_log()
+    process = [x for x in read_events(events) if x['event'] == 'process']
+    assert len(process) == 1
+    assert process[0]['sample'] == 'sample1'
+    assert process[0]['stage'] == 'sourpurge'